@@ -4,9 +4,10 @@ import sys
 import csv
 import logging
 import argparse
-import multiprocessing as mp
 
 import util
+import instrument
+import shmtransport
 
 csv.field_size_limit(sys.maxsize)
 
@@ -23,26 +24,58 @@ if __name__ == "__main__":
     help="Delimiter to use for lists within a field (; by default)")
   parser.add_argument("--unique", "-u", action="store_true",
     help="If specified, remove duplicate values before processing each input row.")
+  parser.add_argument("--transform", "-t", choices=("asn",) + util.GEOIP_FIELDS,
+    default="asn", help="Map IPs to ASNs (with the ASN database of each "
+    "row's date, the default), or to their country, region or usage type "
+    "with util.geoip.")
+  parser.add_argument("--geoip-db", "-gdb", default=util.GEOIP_DB,
+    help="IP2Location SQLite database for --transform country, region or "
+    "usage (default={})".format(util.GEOIP_DB))
+  parser.add_argument("--geoip-cache", "-gc", default=None,
+    help="If specified, cache looked up locations in this SQLite file, "
+    "shared by the workers and reused by later runs.")
     
   parser.add_argument("--concurrency", "-j", type=int, default=util.DEFAULT_CONCURRENCY,
     help="Number of MP workers to use for reading scanfiles concurrently."
     " (default={})".format(util.DEFAULT_CONCURRENCY))
+  parser.add_argument("--shm", action="store_true",
+    help="If specified, workers sort their rows and return them through "
+    "shared memory instead of pickling them through a pipe, and they're "
+    "written out without decoding.")
+  instrument.add_argument(parser)
 
   ARGS = parser.parse_args()
+  instrument.setup(ARGS.instrument, "agg_ip2asn")
+  util.GEOIP_DB = ARGS.geoip_db
+  util.GEOIP_CACHE = ARGS.geoip_cache
+  if ARGS.transform != "asn":
+    try:
+      util.check_geoip_db()
+    except FileNotFoundError as e:
+      parser.error(str(e))
 
   def process_row(row, keyfunc=lambda r: r[0], valuefunc=lambda r: r[1].strip()):
-    key = keyfunc(row)
-    logging.info("Processing row key %s", key)
-    values = valuefunc(row)
-    valuelist = values.strip(ARGS.inner_delimiter).split(ARGS.inner_delimiter)
-    if ARGS.unique:
-      valuelist = set(valuelist)
-
-    # transform IP addresses using the selected transformation and remove any
-    # that transform to a None value (e.g. un-announced IPs)
-    # e.g. IP -> ASN or IP -> /24 prefix etc
-    valuelist = list(map(lambda v: str(util.ip2asn(v, key)), valuelist))
-    return key, valuelist
+    with instrument.stage("process_row"):
+      key = keyfunc(row)
+      logging.info("Processing row key %s", key)
+      values = valuefunc(row)
+      valuelist = values.strip(ARGS.inner_delimiter).split(ARGS.inner_delimiter)
+      instrument.count(rows=1, nodes=len(valuelist))
+      if ARGS.unique:
+        valuelist = set(valuelist)
+
+      # transform IP addresses using the selected transformation and remove any
+      # that transform to a None value (e.g. un-announced IPs)
+      # e.g. IP -> ASN or IP -> /24 prefix etc
+      if ARGS.transform == "asn":
+        valuelist = list(map(lambda v: str(util.ip2asn(v, key)), valuelist))
+      else:
+        locations = util.geoip_many(valuelist, ARGS.transform)
+        valuelist = [str(locations[v]) for v in valuelist]
+      if ARGS.shm:
+        return key, shmtransport.SharedStrings.put(sorted(valuelist),
+                                                   ARGS.inner_delimiter)
+      return key, valuelist
 
   writer = csv.writer(sys.stdout, delimiter=ARGS.delimiter, 
       lineterminator="\n")
@@ -50,13 +83,21 @@ if __name__ == "__main__":
   # Read input files into data structure
   for infile in ARGS.infiles:
     logging.info("Reading input file %s", infile.name)
-    with infile as inf:
+    with infile as inf, instrument.stage("read_file"):
       reader = csv.reader(inf, delimiter=ARGS.delimiter)
       
-      with mp.Pool(ARGS.concurrency) as p:
+      with util.make_pool(ARGS.concurrency) as p:
         rows = p.map(process_row, reader)
 
+    with instrument.stage("write"):
       for (date, nodelist) in rows:
+        if ARGS.shm:
+          sys.stdout.write(date + ARGS.delimiter)
+          nodelist.write_to(sys.stdout)
+          sys.stdout.write("\n")
+          instrument.count(rows=1)
+          continue
         nodelist = sorted(nodelist)
         nodelist = ARGS.inner_delimiter.join(nodelist)
         writer.writerow((date, nodelist,))
+        instrument.count(rows=1)
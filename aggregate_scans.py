@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
+import os
 import re
 import sys
 import csv
+import json
 import lzma
 import glob
 import logging
@@ -10,17 +12,270 @@ import datetime
 import argparse
 import functools
 import collections
-import multiprocessing as mp
 
 from datetime import datetime
 from os import path
 
 import util
+import extsort
+import nodedict
+import prefetch
+import instrument
 import load_scan
+import shmtransport
 
 # Takes a list of scans on stdin or from a file, outputs in TSV format:
 # date,nodes
 
+def read_date_scanfiles(infiles, delimiter="\t", inner_delimiter=";"):
+    """
+    Reads TSV input in the format date,list_of_scanfiles (see select_scans.py)
+    and returns a dict {date -> set of scanfiles}.
+    """
+    date_scanfiles = collections.defaultdict(set)
+    for inf in infiles:
+        reader = csv.reader(inf, delimiter=delimiter)
+        # Each row is in format: date,list_of_scanfiles
+        for (date, scanfiles) in reader:
+            scanfiles = set(scanfiles.split(inner_delimiter))
+            date_scanfiles[date] = date_scanfiles[date].union(scanfiles)
+            instrument.count(rows=1)
+    return date_scanfiles
+
+def read_output_rows(fname, delimiter="\t"):
+    """
+    Reads a previous output file and returns a dict {date -> raw output line}
+    """
+    rows = {}
+    if not path.isfile(fname):
+        return rows
+    with open(fname, "r") as f:
+        for line in f:
+            rows[line.split(delimiter, 1)[0]] = line
+    return rows
+
+def read_state(fname):
+    """
+    Reads the sidecar state of an incremental aggregation, in the format
+    {"options": {...}, "dates": {date -> sorted list of scanfiles}}, plus
+    "node_dict_fingerprint" if the output is encoded with a node dictionary
+    """
+    if not path.isfile(fname):
+        return None
+    with open(fname, "r") as f:
+        return json.load(f)
+
+def write_state(fname, state):
+    tmpfname = fname + ".tmp"
+    with open(tmpfname, "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmpfname, fname)
+
+def read_journal(fname):
+    """
+    Reads the checkpoint journal of an interrupted run. It starts with a JSON
+    header line {"options": {...}, "dates": {date -> sorted list of
+    scanfiles}}, followed by a line date<TAB>offset for each row written, in
+    output order, where offset is the size of the output after the row, or
+    date<TAB>offset<TAB>failed for a date which failed. Returns (header,
+    [(date, offset), ...]) for the rows before the first failed date, which
+    are the ones a resumed run keeps, or None if there's no journal.
+    """
+    if not path.isfile(fname):
+        return None
+    done = []
+    with open(fname, "r") as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            return None
+        for line in f:
+            # The last line may be incomplete if we were interrupted
+            if not line.endswith("\n"):
+                break
+            date, offset, *failed = line.rstrip("\n").split("\t")
+            if failed:
+                break
+            done.append((date, int(offset)))
+    return header, done
+
+# What to aggregate for each date
+MODES = ("confirmed", "uncontactable", "both")
+
+def load_nodes(loader_cls, scanfile: str, keep_ipv6=False, only_ipv6=False,
+               uncontactable=False, buffers=None, failures=None):
+    """
+    Loads nodes from a given scanfile using a given Loader class. Returns a
+    tuple (confirmed nodes, uncontactable nodes), where uncontactable nodes
+    are None unless uncontactable is True. buffers are any prefetched files
+    of the scan (see LoadScan). If the scan fails to load or the integrity
+    check, (scanfile, reason) is appended to the list failures, if given.
+    """
+    # Filter address families while parsing the scan
+    if only_ipv6:
+        family = 6
+    elif not keep_ipv6:
+        family = 4
+    else:
+        family = None
+    with instrument.stage("load"):
+        loader = loader_cls(scanfile, family=family, buffers=buffers)
+        # Both node sets come from the same loader, so e.g. BTC-style scans
+        # are only read once. Scans failing the integrity check are treated
+        # as having no uncontactable nodes.
+        if uncontactable and loader.integrity_pass:
+            loader.load_uncontactable()
+        instrument.count(scans=1, nodes=len(loader.nodes))
+    if failures is not None and not loader.integrity_pass:
+        failures.append((scanfile, loader.integrity_err))
+    if uncontactable:
+        return loader.nodes, loader.uncontactable_nodes or []
+    return loader.nodes, None
+
+def format_nodes(loader_cls, nodeset, omit_nodeid=False, omit_ip=False,
+                 omit_port=False, dedupe_output_nodes=False):
+    """Returns a sorted list of formatted nodes"""
+    with instrument.stage("format"):
+        nodelist = [
+            loader_cls.format_node(n, 
+                                   omit_nodeid=omit_nodeid, 
+                                   omit_ip=omit_ip, 
+                                   omit_port=omit_port)
+            for n in nodeset
+        ]
+        if dedupe_output_nodes:
+            nodelist = set(nodelist)
+        # Sort to return a deterministic ordering of nodes
+        nodelist = sorted(nodelist)
+        instrument.count(nodes=len(nodelist))
+    return nodelist
+
+# Separates formatted nodes from the full nodes they were formatted from in
+# lines spilled to disk, and the parts of full nodes from each other. "\x00"
+# sorts before any other character, so lines sort by formatted node first.
+SPILL_KEY_SEP = "\x00"
+SPILL_PART_SEP = "\x01"
+
+def spill_nodelist(loader_cls, scanfiles, keep_ipv6=False, only_ipv6=False,
+                   mode="confirmed", buffers=None, memory_budget=0,
+                   spill_dir=None, omit_nodeid=False, omit_ip=False,
+                   omit_port=False, dedupe_output_nodes=False, failures=None):
+    """
+    Like build_nodelist, but holds at most about memory_budget bytes of nodes
+    (per node set) in memory, spilling sorted runs to files in spill_dir, and
+    returns extsort.SpillFile(s) instead of lists.
+    """
+    buffers = buffers or {}
+    sorters = {}
+    if mode != "uncontactable":
+        sorters["confirmed"] = extsort.ExternalSorter(memory_budget, spill_dir)
+    if mode != "confirmed":
+        sorters["uncontactable"] = extsort.ExternalSorter(memory_budget, spill_dir)
+
+    def add(sorter, nodes):
+        for n in nodes:
+            line = loader_cls.format_node(n, omit_nodeid=omit_nodeid,
+                                          omit_ip=omit_ip, omit_port=omit_port)
+            # Unless deduping formatted nodes, keep distinct nodes which
+            # format the same, as build_nodelist does
+            if not dedupe_output_nodes:
+                line += SPILL_KEY_SEP + SPILL_PART_SEP.join(n)
+            sorter.add(line)
+
+    for sf in scanfiles:
+        nodes, uncontactable_nodes = load_nodes(loader_cls, sf,
+            keep_ipv6=keep_ipv6, only_ipv6=only_ipv6,
+            uncontactable=(mode != "confirmed"), buffers=buffers.get(sf),
+            failures=failures)
+        with instrument.stage("union"):
+            if mode != "uncontactable":
+                add(sorters["confirmed"], nodes)
+            if mode != "confirmed":
+                add(sorters["uncontactable"], uncontactable_nodes)
+
+    strip_key = None if dedupe_output_nodes else (
+        lambda line: line.split(SPILL_KEY_SEP, 1)[0])
+    spilled = {kind: sorter.finish(strip_key) for kind, sorter in sorters.items()}
+    if mode == "both":
+        return spilled["confirmed"], spilled["uncontactable"]
+    return spilled[mode]
+
+def build_nodelist(loader_cls, scanfiles, keep_ipv6=False, only_ipv6=False,
+                   mode="confirmed", buffers=None, memory_budget=None,
+                   spill_dir=None, failures=None, **format_kwargs):
+    """
+    Returns the sorted list of formatted nodes in the union of the given
+    scans. mode is one of MODES; if it is "both", returns a tuple of
+    (confirmed nodelist, uncontactable nodelist). buffers is an optional dict
+    {scanfile -> prefetched files} (see prefetch.py). If memory_budget is
+    given, node lists are spilled to disk (see spill_nodelist). Scans which
+    fail to load are skipped, and listed in failures if given (see
+    load_nodes). See format_nodes for format_kwargs.
+    """
+    if memory_budget is not None:
+        return spill_nodelist(loader_cls, scanfiles, keep_ipv6=keep_ipv6,
+                              only_ipv6=only_ipv6, mode=mode, buffers=buffers,
+                              memory_budget=memory_budget, spill_dir=spill_dir,
+                              failures=failures, **format_kwargs)
+    buffers = buffers or {}
+    nodeset = set()
+    uncontactable_nodeset = set()
+
+    for sf in scanfiles:
+      nodes, uncontactable_nodes = load_nodes(loader_cls, sf,
+          keep_ipv6=keep_ipv6, only_ipv6=only_ipv6,
+          uncontactable=(mode != "confirmed"), buffers=buffers.get(sf),
+          failures=failures)
+      with instrument.stage("union"):
+        if mode != "uncontactable":
+          nodeset = nodeset.union(set(nodes))
+        if mode != "confirmed":
+          uncontactable_nodeset.update(uncontactable_nodes)
+    
+    if mode == "confirmed":
+        return format_nodes(loader_cls, nodeset, **format_kwargs)
+    if mode == "uncontactable":
+        return format_nodes(loader_cls, uncontactable_nodeset, **format_kwargs)
+    return (format_nodes(loader_cls, nodeset, **format_kwargs),
+            format_nodes(loader_cls, uncontactable_nodeset, **format_kwargs))
+
+def build_nodelist_for_date(date_scanfiles: tuple, **kwargs):
+    """
+    Takes a tuple (date, scanfiles) or (date, scanfiles, buffers) and returns
+    (date, nodelist, failures), see build_nodelist for buffers, failures and
+    kwargs.
+    """
+    date, scanfiles, *buffers = date_scanfiles
+    failures = []
+    nodelist = build_nodelist(scanfiles=scanfiles,
+                              buffers=buffers[0] if buffers else None,
+                              failures=failures, **kwargs)
+    return date, nodelist, failures
+
+def share_nodelist_for_date(date_scanfiles: tuple, inner_delimiter=";", **kwargs):
+    """
+    Like build_nodelist_for_date, but returns node lists as
+    shmtransport.SharedStrings joined by inner_delimiter, so that workers
+    don't pickle them back.
+    """
+    date, nodelist, failures = build_nodelist_for_date(date_scanfiles, **kwargs)
+    if isinstance(nodelist, tuple):
+        return date, tuple(shmtransport.SharedStrings.put(n, inner_delimiter)
+                           for n in nodelist), failures
+    return date, shmtransport.SharedStrings.put(nodelist, inner_delimiter), failures
+
+def discard_nodelist(result: tuple):
+    """
+    Frees the spill files or shared memory of an unused result of
+    build_nodelist_for_date or share_nodelist_for_date.
+    """
+    _, nodelist, _ = result
+    for n in (nodelist if isinstance(nodelist, tuple) else (nodelist,)):
+        if isinstance(n, extsort.SpillFile):
+            n.remove()
+        elif isinstance(n, shmtransport.SharedStrings):
+            n.take()
+
 if __name__ == "__main__":
     # Configure logging module
     logging.basicConfig(#filename="aggregate_scans.log", 
@@ -42,6 +297,27 @@ if __name__ == "__main__":
     parser.add_argument("--concurrency", "-j", type=int, default=util.DEFAULT_CONCURRENCY,
       help="Number of MP workers to use for reading scanfiles concurrently."
       " (default={})".format(util.DEFAULT_CONCURRENCY))
+    parser.add_argument("--executor", "-x", choices=util.EXECUTORS, default="process",
+      help="Run workers as processes or threads (default=process)")
+    parser.add_argument("--memory-budget", "-mb", type=int, default=None,
+      metavar="MB", help="If specified, each worker holds at most about this "
+           "many MB of nodes per date in memory, spilling sorted runs to "
+           "temporary files and merging them, and output rows are streamed "
+           "from the merged files. For dates too large to aggregate in memory.")
+    parser.add_argument("--spill-dir", default=None,
+      help="Directory for files spilled with --memory-budget (the system "
+           "temporary directory by default).")
+    prefetch.add_argument(parser)
+    parser.add_argument("--shm", action="store_true",
+      help="If specified, workers return node lists through shared memory "
+           "instead of pickling them through a pipe, and they're written out "
+           "without decoding. Only useful with process workers.")
+    util.add_task_arguments(parser)
+    parser.add_argument("--failure-report", "-fr", default=None,
+      help="If specified, write date, scan file and reason for each scan "
+           "which failed to load or the integrity check, or whose date failed "
+           "(e.g. timed out), to this TSV file. Failed dates are left out of "
+           "the output, and make the exit status 1.")
 
     # Output options
     parser.add_argument("--omit-ip", "-oip", action="store_true", 
@@ -53,6 +329,30 @@ if __name__ == "__main__":
 
     parser.add_argument("--dedupe-output-nodes", "-dd", action="store_true", 
       help="If specified, output nodes will appear uniquely in each aggregation.")
+    parser.add_argument("--mode", "-m", choices=MODES, default="confirmed",
+      help="Which nodes to aggregate (confirmed by default). If both, each "
+           "output row contains date, confirmed nodes, uncontactable nodes, "
+           "number of confirmed nodes, number of uncontactable nodes and "
+           "the ratio of confirmed nodes to all nodes.")
+    parser.add_argument("--node-dict", "-nd", default=None,
+      help="If specified, output nodes are encoded as integer IDs from this "
+           "node dictionary file, which is created or appended to as needed. "
+           "Requires --output; the dictionary's fingerprint is recorded in "
+           "<output>.state.")
+    parser.add_argument("--output", "-o", default=None,
+      help="If specified, write output to this file instead of stdout.")
+    parser.add_argument("--incremental", "-inc", action="store_true",
+      help="If specified, reuse rows from an existing --output file for "
+           "dates whose scan files are unchanged since the previous run, and "
+           "only aggregate new or changed dates. Other rows of the existing "
+           "output are kept. Requires <output>.state, which is written "
+           "whenever --output is given.")
+    parser.add_argument("--resume", "-r", action="store_true",
+      help="If specified, continue an interrupted run with the same --output, "
+           "input and options, keeping the rows it had written. Requires "
+           "<output>.journal, which is written while --output is given. The "
+           "output is identical to that of an uninterrupted run.")
+    instrument.add_argument(parser)
 
     # Required args
     parser.add_argument("--format", "-f", choices=list(load_scan.FORMAT_LOADERS.keys()), 
@@ -66,66 +366,250 @@ if __name__ == "__main__":
 
     ARGS = parser.parse_args()
     logging.debug("Parsed args: %s", str(ARGS))
+    instrument.setup(ARGS.instrument, "aggregate_scans")
+    if ARGS.incremental and ARGS.output is None:
+        parser.error("--incremental requires --output")
+    if ARGS.resume and ARGS.output is None:
+        parser.error("--resume requires --output")
+    if ARGS.node_dict and ARGS.output is None:
+        parser.error("--node-dict requires --output")
+    if ARGS.shm and ARGS.memory_budget is not None:
+        parser.error("--shm can't be combined with --memory-budget")
 
     # Read all scan file paths from all input files
-    date_scanfiles = collections.defaultdict(set)
-    for inf in ARGS.infile:
-        reader = csv.reader(inf, delimiter=ARGS.delimiter)
-        # Each row is in format: date,list_of_scanfiles
-        for (date, scanfiles) in reader:
-            scanfiles = set(scanfiles.split(ARGS.inner_delimiter))
-            date_scanfiles[date] = date_scanfiles[date].union(scanfiles)
+    with instrument.stage("read_input"):
+        date_scanfiles = read_date_scanfiles(ARGS.infile, ARGS.delimiter,
+                                             ARGS.inner_delimiter)
 
-    # Initialize TSV output writer
-    writer = csv.writer(sys.stdout, delimiter=ARGS.delimiter,
-        lineterminator="\n")
-    
     # Get correct loader for selected scanfile type
     loader_cls = load_scan.FORMAT_LOADERS[ARGS.format]
 
-    # Mutex for file writing
-    lock = mp.Lock()
-
-    # Loads confirmed nodes from a given scanfile using a given Loader class
-    # NOTE: function is defined here because it wraps ARGS and loader_cls
-    # local vars
-    def load(scanfile: str):
-        loader = loader_cls(scanfile)
-        if not ARGS.keep_ipv6 and not ARGS.only_ipv6:
-            loader.drop_ipv6()
-        if ARGS.only_ipv6:
-            loader.drop_ipv4()
-        return loader.nodes
-
-    def writerow(row):
-        with lock:
-          writer.writerow(row)
-
-    def build_nodelist_for_date(date_scanfiles: tuple):
-        date, scanfiles = date_scanfiles
-
-        nodeset_for_date = set()
-
-        for sf in scanfiles:
-          nodes = load(sf)
-          nodeset_for_date = nodeset_for_date.union(set(nodes))
-        
-        nodelist_for_date = [
-            loader_cls.format_node(n, 
-                                   omit_nodeid=ARGS.omit_nodeid, 
-                                   omit_ip=ARGS.omit_ip, 
-                                   omit_port=ARGS.omit_port)
-            for n in nodeset_for_date
-        ]
-        if ARGS.dedupe_output_nodes:
-            nodelist_for_date = set(nodelist_for_date)
-        # Sort to return a deterministic ordering of nodes
-        nodelist_for_date = sorted(nodelist_for_date)
-        nodelist_for_date = ARGS.inner_delimiter.join(nodelist_for_date)
-        writerow((date, nodelist_for_date,))
+    # Shared node dictionary, if we're encoding output nodes
+    node_dict = nodedict.NodeDict(ARGS.node_dict) if ARGS.node_dict else None
+
+    # Builds the formatted node list for one (date, scanfiles) tuple
+    build_kwargs = {"inner_delimiter": ARGS.inner_delimiter} if ARGS.shm else {}
+    build = functools.partial(share_nodelist_for_date if ARGS.shm
+                                  else build_nodelist_for_date,
+                              **build_kwargs,
+                              loader_cls=loader_cls,
+                              keep_ipv6=ARGS.keep_ipv6,
+                              only_ipv6=ARGS.only_ipv6,
+                              omit_nodeid=ARGS.omit_nodeid,
+                              omit_ip=ARGS.omit_ip,
+                              omit_port=ARGS.omit_port,
+                              dedupe_output_nodes=ARGS.dedupe_output_nodes,
+                              mode=ARGS.mode,
+                              memory_budget=(ARGS.memory_budget * 1024**2
+                                  if ARGS.memory_budget is not None else None),
+                              spill_dir=ARGS.spill_dir)
+
+    # Options which must match for rows of a previous run to be reused
+    options = {k: getattr(ARGS, k) for k in ("format", "keep_ipv6", "only_ipv6",
+        "omit_nodeid", "omit_ip", "omit_port", "dedupe_output_nodes",
+        "node_dict", "delimiter", "inner_delimiter", "mode")}
+    date_scanfiles = {date: sorted(sfs) for date, sfs in date_scanfiles.items()}
+
+    # Rows of a previous run, which we reuse for unchanged dates
+    reused_rows = {}
+    state = {"options": options, "dates": {}}
+    if ARGS.incremental:
+        prev_state = read_state(ARGS.output + ".state")
+        reused_rows = read_output_rows(ARGS.output, ARGS.delimiter)
+        # Rows encoded with another node dictionary can't be reused either
+        prev_fingerprint = prev_state and prev_state.get("node_dict_fingerprint")
+        if (prev_state is None or prev_state["options"] != options or
+                (node_dict is not None and (prev_fingerprint is None or
+                                            not node_dict.matches(prev_fingerprint)))):
+            logging.warning("No matching state for %s, aggregating all dates",
+                            ARGS.output)
+            reused_rows = {}
+        else:
+            state["dates"] = prev_state["dates"]
+            for date, scanfiles in date_scanfiles.items():
+                if state["dates"].get(date) != scanfiles:
+                    reused_rows.pop(date, None)
+            # Keep state only for dates we still have rows for
+            state["dates"] = {d: sfs for d, sfs in state["dates"].items()
+                              if d in reused_rows}
+        logging.info("Reusing %s of %s dates", 
+                     len(reused_rows.keys() & date_scanfiles.keys()),
+                     len(date_scanfiles))
+
+    # Rows written by an interrupted run, which we keep if resuming. As rows
+    # are written in date order, they are for the first dates.
+    journal_header = {"options": options, "dates": date_scanfiles}
+    resumed = []
+    if ARGS.resume:
+        journal = read_journal(ARGS.output + ".journal")
+        if journal is None or journal[0] != journal_header:
+            logging.warning("No matching journal for %s, starting over",
+                            ARGS.output)
+        elif not path.isfile(ARGS.output + ".tmp"):
+            logging.warning("Partial output %s.tmp is missing, starting over",
+                            ARGS.output)
+        else:
+            resumed = journal[1]
+            logging.info("Resuming after %s written dates", len(resumed))
+    resumed_dates = {date for date, _ in resumed}
+
+    # Dates we need to aggregate, and all dates we will output
+    todo = sorted((date, sfs) for date, sfs in date_scanfiles.items()
+                  if date not in reused_rows and date not in resumed_dates)
+    all_dates = sorted(reused_rows.keys() | date_scanfiles.keys())
+
+    # Read ahead the scans we need to aggregate
+    prefetcher = None
+    tasks = todo
+    if ARGS.prefetch:
+        prefetcher = prefetch.Prefetcher(todo,
+            lambda date_sfs: {sf: loader_cls.data_files(sf,
+                                  uncontactable=(ARGS.mode != "confirmed"))
+                              for sf in date_sfs[1]},
+            max_bytes=ARGS.prefetch * 1024**2)
+        tasks = ((date, sfs, buffers)
+                 for ((date, sfs), buffers) in prefetcher)
+
+    # Initialize TSV output writer, and the journal of rows written to it
+    journalf = None
+    if ARGS.output and resumed:
+        # Drop anything written after the last journaled row
+        os.truncate(ARGS.output + ".tmp", resumed[-1][1])
+        outf = open(ARGS.output + ".tmp", "a")
+        journalf = open(ARGS.output + ".journal", "a")
+    elif ARGS.output:
+        outf = open(ARGS.output + ".tmp", "w")
+        journalf = open(ARGS.output + ".journal", "w")
+        journalf.write(json.dumps(journal_header, sort_keys=True) + "\n")
+        journalf.flush()
+    else:
+        outf = sys.stdout
+    writer = csv.writer(outf, delimiter=ARGS.delimiter,
+        lineterminator="\n")
+
+    def encode(nodelist):
+        # Encoding happens in this process, so that IDs are assigned
+        # consistently across all workers
+        if node_dict is not None:
+            nodelist = map(str, sorted(node_dict.encode_many(nodelist)))
+        return ARGS.inner_delimiter.join(nodelist)
+
+    def write_streamed(fields):
+        # Writes a row whose node lists are extsort.SpillFiles or
+        # shmtransport.SharedStrings, streaming them instead of building the
+        # whole row in memory
+        for i, field in enumerate(fields):
+            if i > 0:
+                outf.write(ARGS.delimiter)
+            if isinstance(field, shmtransport.SharedStrings):
+                if node_dict is not None:
+                    outf.write(encode(field.take()))
+                else:
+                    field.write_to(outf)
+            elif not isinstance(field, extsort.SpillFile):
+                outf.write(str(field))
+            elif node_dict is not None:
+                outf.write(encode(field))
+            else:
+                for j, node in enumerate(field):
+                    if j > 0:
+                        outf.write(ARGS.inner_delimiter)
+                    outf.write(node)
+        outf.write("\n")
+        for field in fields:
+            if isinstance(field, extsort.SpillFile):
+                field.remove()
+
+    def writerow(date_nodelist: tuple):
+        date, nodelist = date_nodelist
+        with instrument.stage("write"):
+            if ARGS.mode == "both":
+                confirmed, uncontactable = nodelist
+                total = len(confirmed) + len(uncontactable)
+                ratio = round(len(confirmed) / total, 6) if total else ""
+                row = (date, confirmed, uncontactable,
+                       len(confirmed), len(uncontactable), ratio,)
+            else:
+                row = (date, nodelist,)
+            if ARGS.memory_budget is not None or ARGS.shm:
+                write_streamed(row)
+            else:
+                writer.writerow(tuple(encode(f) if isinstance(f, list) else f
+                                      for f in row))
+            instrument.count(rows=1)
+
+    def checkpoint(date, failed=False):
+        # Makes the row of date durable and records it in the journal. Node
+        # IDs it uses are saved first, so a resumed run assigns the same IDs.
+        if journalf is None:
+            return
+        outf.flush()
+        os.fsync(outf.fileno())
+        if node_dict is not None:
+            node_dict.save()
+        journalf.write("{}\t{}{}\n".format(date, outf.tell(),
+                                            "\tfailed" if failed else ""))
+        journalf.flush()
+        os.fsync(journalf.fileno())
+
+    # (date, scanfile, reason) of scans and dates which failed
+    failure_rows = []
+    failed_dates = []
+
+    # Load scans for each date, writing out rows in date order (merged with
+    # any reused rows)
+    with instrument.stage("aggregate"):
+        results = util.supervised_imap(
+            lambda: util.make_pool(ARGS.concurrency, ARGS.executor,
+                                   ARGS.max_tasks_per_child),
+            build, tasks, ARGS.concurrency, timeout=ARGS.task_timeout,
+            speculate=ARGS.speculate, discard=discard_nodelist)
+        for date in all_dates:
+            if date in resumed_dates:
+                if date not in reused_rows:
+                    state["dates"][date] = date_scanfiles[date]
+                continue
+            if date in reused_rows:
+                outf.write(reused_rows[date])
+            else:
+                result = next(results)
+                if prefetcher is not None:
+                    prefetcher.release()
+                if isinstance(result, util.TaskFailure):
+                    logging.error("Couldn't aggregate %s: %s", date, result.reason)
+                    failed_dates.append(date)
+                    failure_rows.extend((date, sf, result.reason)
+                                        for sf in date_scanfiles[date])
+                    checkpoint(date, failed=True)
+                    continue
+                _, nodelist, failures = result
+                failure_rows.extend((date, sf, reason) for sf, reason in failures)
+                writerow((date, nodelist))
+                state["dates"][date] = date_scanfiles[date]
+            checkpoint(date)
+        results.close()
+
+    if node_dict is not None:
+        node_dict.save()
+        # Lets readers of the output check they decode it with this
+        # dictionary (see NodeDict.check_output)
+        state["node_dict_fingerprint"] = node_dict.fingerprint()
+
+    if ARGS.output:
+        outf.close()
+        os.replace(ARGS.output + ".tmp", ARGS.output)
+        # Record which scans each date was built from, for --incremental
+        write_state(ARGS.output + ".state", state)
+        journalf.close()
+        os.remove(ARGS.output + ".journal")
 
-    # Load scans for each date
-    with mp.Pool(ARGS.concurrency) as p:
-        p.map(build_nodelist_for_date, sorted(date_scanfiles.items()))
+    if ARGS.failure_report:
+        with open(ARGS.failure_report, "w") as f:
+            csv.writer(f, delimiter=ARGS.delimiter,
+                       lineterminator="\n").writerows(failure_rows)
 
     logging.debug("===FINISH===")
+    if failed_dates:
+        logging.error("%s dates failed and were left out: %s",
+                      len(failed_dates), ", ".join(failed_dates))
+        sys.exit(1)
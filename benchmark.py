@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+import tempfile
+import subprocess
+
+from os import path
+
+import util
+import synth_scans
+
+csv.field_size_limit(sys.maxsize)
+
+# Benchmarks the hot paths of the tools against a synthetic scan corpus (see
+# synth_scans.py). Each stage runs in a forked child process, so that CPU time
+# and peak RSS can be measured per stage from the child's resource usage.
+# Results are written as JSON, and can be compared against the results of a
+# previous revision with --baseline.
+
+STAGES = ("startup", "select_scans", "load_scan", "aggregate_scans", "compare",
+          "rolling_core")
+
+# CLIs whose startup (interpreter and import) time is measured by the startup
+# stage, by running them with --help
+STARTUP_SCRIPTS = ("load_scan.py", "select_scans.py", "aggregate_scans.py",
+                   "compare.py", "integrity_check_scans.py")
+STARTUP_REPEATS = 10
+
+def run_in_child(func, *args):
+    """
+    Runs func(*args) in a forked child process. func must return a dict of
+    JSON-serialisable counters (e.g. {"scans": 10}). Returns the counters
+    together with wall time, CPU time and peak RSS of the child.
+    """
+    rfd, wfd = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        status = 0
+        try:
+            counters = func(*args)
+        except Exception as ex:
+            logging.exception("Benchmark stage failed")
+            counters = {"error": str(ex)}
+            status = 1
+        with os.fdopen(wfd, "w") as w:
+            json.dump(counters, w)
+        os._exit(status)
+    os.close(wfd)
+    with os.fdopen(rfd, "r") as r:
+        counters = json.load(r)
+    _, _, rusage = os.wait4(pid, 0)
+    result = {
+        "wall_s": time.perf_counter() - start,
+        "cpu_s": rusage.ru_utime + rusage.ru_stime,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_kb": rusage.ru_maxrss,
+    }
+    result.update(counters)
+    return result
+
+def run_script(script, args, stdout=None):
+    """Runs one of our CLI scripts as a subprocess, raising on failure."""
+    cmd = [sys.executable, path.join(util.SCRIPT_DIR, script)] + list(args)
+    logging.info("Running %s", " ".join(cmd))
+    subprocess.run(cmd, stdout=stdout, check=True)
+
+def nb_rows(fname):
+    with open(fname) as f:
+        return sum(1 for _ in f)
+
+def bench_startup(scripts=STARTUP_SCRIPTS, repeats=STARTUP_REPEATS):
+    counters = {"invocations": 0}
+    with open(os.devnull, "w") as devnull:
+        for script in scripts:
+            start = time.perf_counter()
+            for _ in range(repeats):
+                run_script(script, ["--help"], stdout=devnull)
+            name = path.splitext(script)[0]
+            counters[name + "_ms"] = 1000 * (time.perf_counter() - start) / repeats
+            counters["invocations"] += repeats
+    return counters
+
+def bench_select_scans(fmt, corpus):
+    import select_scans
+    loader = select_scans.FORMAT_LOADERS[fmt](corpus)
+    nb_scans = len(loader.scanfiles)
+    loader.downsample(targets=("06:00:00", "18:00:00"))
+    loader.sort()
+    loader.scanfiles_by_date()
+    return {"scans": nb_scans}
+
+def bench_load_scan(fmt, scanfiles):
+    import load_scan
+    loader_cls = load_scan.FORMAT_LOADERS[fmt]
+    nb_nodes = 0
+    for sf in scanfiles:
+        nb_nodes += len(loader_cls(sf).nodes)
+    return {"scans": len(scanfiles), "nodes": nb_nodes}
+
+def bench_aggregate_scans(fmt, selection, outfile, concurrency):
+    with open(outfile, "w") as outf:
+        run_script("aggregate_scans.py", ["--format", fmt, "-j", str(concurrency),
+                                          "--omit-nodeid", "--omit-port",
+                                          selection], stdout=outf)
+    with open(selection) as f:
+        nb_scans = sum(len(sfs.split(";")) for (_, sfs) in csv.reader(f, delimiter="\t"))
+    return {"scans": nb_scans, "dates": nb_rows(outfile)}
+
+def bench_compare(aggregates, concurrency):
+    with open(os.devnull, "w") as devnull:
+        run_script("compare.py", ["-j", str(concurrency)] + list(aggregates),
+                   stdout=devnull)
+    return {"dates": sum(nb_rows(a) for a in aggregates)}
+
+def bench_rolling_core(aggregate, backcheck):
+    import corenodes
+    with open(aggregate) as f:
+        date_nodes = {date: nodes.split(";")
+                      for (date, nodes) in csv.reader(f, delimiter="\t")}
+    cn = corenodes.CoreNodes(date_nodes)
+    nb_windows = 0
+    for _ in cn.rolling_core(backcheck):
+        nb_windows += 1
+    return {"dates": len(date_nodes), "windows": nb_windows}
+
+def add_throughput(result):
+    """Adds items/sec for every counter in a stage result."""
+    for counter in ("scans", "nodes", "dates", "windows", "invocations"):
+        if counter in result and result["wall_s"] > 0:
+            result[counter + "_per_s"] = result[counter] / result["wall_s"]
+    return result
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=util.SCRIPT_DIR,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_selection(fmt, corpus, target, outfile):
+    with open(outfile, "w") as outf:
+        run_script("select_scans.py", ["--format", fmt, "--downsample", target,
+                                       corpus], stdout=outf)
+
+def run_benchmarks(fmt, corpus, workdir, stages, concurrency, backcheck):
+    import select_scans
+    results = {}
+    scanfiles = select_scans.FORMAT_LOADERS[fmt](corpus).scanfiles
+
+    if "startup" in stages:
+        results["startup"] = run_in_child(bench_startup)
+    if "select_scans" in stages:
+        results["select_scans"] = run_in_child(bench_select_scans, fmt, corpus)
+    if "load_scan" in stages:
+        results["load_scan"] = run_in_child(bench_load_scan, fmt, scanfiles)
+
+    # The remaining stages work on aggregates of two selections (using two
+    # downsampling targets), which are compared with each other
+    if not set(stages) & {"aggregate_scans", "compare", "rolling_core"}:
+        return {stage: add_throughput(r) for stage, r in results.items()}
+    selections = [path.join(workdir, "select-{}.tsv".format(i)) for i in range(2)]
+    aggregates = [path.join(workdir, "aggregate-{}.tsv".format(i)) for i in range(2)]
+    for target, selection in zip(("06:00:00", "18:00:00"), selections):
+        write_selection(fmt, corpus, target, selection)
+    agg_result = run_in_child(bench_aggregate_scans, fmt, selections[0],
+                              aggregates[0], concurrency)
+    if "aggregate_scans" in stages:
+        results["aggregate_scans"] = agg_result
+    if "compare" in stages:
+        bench_aggregate_scans(fmt, selections[1], aggregates[1], concurrency)
+        results["compare"] = run_in_child(bench_compare, aggregates, concurrency)
+    if "rolling_core" in stages:
+        results["rolling_core"] = run_in_child(bench_rolling_core, aggregates[0],
+                                               backcheck)
+    return {stage: add_throughput(r) for stage, r in results.items()}
+
+def print_results(results, baseline=None):
+    writer = csv.writer(sys.stdout, delimiter="\t", lineterminator="\n")
+    header = ["stage", "wall_s", "cpu_s", "peak_rss_kb"]
+    if baseline is not None:
+        header += ["wall_vs_baseline", "rss_vs_baseline"]
+    writer.writerow(header)
+    for stage, r in results.items():
+        row = [stage, "%.3f" % r["wall_s"], "%.3f" % r["cpu_s"], r["peak_rss_kb"]]
+        if baseline is not None:
+            b = baseline["results"].get(stage)
+            if b is None:
+                row += ["", ""]
+            else:
+                row += ["%.2f" % (r["wall_s"] / b["wall_s"]),
+                        "%.2f" % (r["peak_rss_kb"] / b["peak_rss_kb"])]
+        writer.writerow(row)
+
+if __name__ == "__main__":
+    # Configure logging module
+    logging.basicConfig(format=util.LOG_FMT, level=util.LOG_LEVEL)
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--format", "-f", default="Yethi",
+      choices=sorted(synth_scans.DEFAULT_PORTS.keys()),
+      help="Format of scans to benchmark (Yethi by default).")
+    parser.add_argument("--corpus", "-c", default=None,
+      help="Existing scan directory to benchmark against. If not given, a "
+           "synthetic corpus is generated in a temporary directory.")
+    parser.add_argument("--days", "-n", type=int, default=14,
+      help="Days of synthetic scans to generate (14 by default)")
+    parser.add_argument("--scans-per-day", "-spd", type=int, default=4,
+      help="Synthetic scans per day (4 by default)")
+    parser.add_argument("--nodes", "-N", type=int, default=5000,
+      help="Nodes in the synthetic network (5000 by default)")
+    parser.add_argument("--seed", type=int, default=0,
+      help="Random seed for the synthetic corpus (0 by default)")
+    parser.add_argument("--like", "-l", default=None,
+      help="Real btccrawlgo scan directory whose layout synthetic BTC-style "
+           "scans copy (see synth_scans.py --like)")
+    parser.add_argument("--stages", "-s", default=",".join(STAGES),
+      help="Comma-separated list of stages to run (default: all of {})".format(
+        ",".join(STAGES)))
+    parser.add_argument("--backcheck", "-b", type=int, default=7,
+      help="Backcheck for the rolling_core stage (7 by default)")
+    parser.add_argument("--concurrency", "-j", type=int, default=util.DEFAULT_CONCURRENCY,
+      help="Number of MP workers for the aggregate_scans and compare stages."
+      " (default={})".format(util.DEFAULT_CONCURRENCY))
+    parser.add_argument("--output", "-o", default=None,
+      help="Write results as JSON to this file.")
+    parser.add_argument("--baseline", "-B", default=None,
+      help="JSON results of a previous run to compare against.")
+
+    ARGS = parser.parse_args()
+
+    btc_layout = None
+    if ARGS.like is not None:
+        if ARGS.format == "Yethi":
+            parser.error("--like is only supported by BTC-style formats")
+        try:
+            btc_layout = synth_scans.BtcLayout.from_scan(ARGS.like)
+        except (OSError, ValueError) as e:
+            parser.error("Can't copy the layout of {}: {}".format(ARGS.like, e))
+
+    stages = ARGS.stages.split(",")
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error("Unknown stage {}".format(stage))
+
+    with tempfile.TemporaryDirectory(prefix="bc-bench-") as workdir:
+        corpus = ARGS.corpus
+        params = {"format": ARGS.format, "corpus": corpus}
+        if corpus is None:
+            corpus = path.join(workdir, "scans")
+            params.update(days=ARGS.days, scans_per_day=ARGS.scans_per_day,
+                          nodes=ARGS.nodes, seed=ARGS.seed)
+            logging.info("Generating synthetic corpus in %s", corpus)
+            scan_dirs = synth_scans.generate(corpus, fmt=ARGS.format, days=ARGS.days,
+                                             scans_per_day=ARGS.scans_per_day,
+                                             nb_nodes=ARGS.nodes, seed=ARGS.seed,
+                                             btc_layout=btc_layout)
+            if ARGS.format != "Yethi":
+                # Record whether the synthetic BTC-style scans are known to
+                # load like real ones, so results aren't mistaken for numbers
+                # on the real format
+                params.update(like=ARGS.like,
+                              btc_layout_checked=synth_scans.check_btc_scan(scan_dirs[0]))
+        results = run_benchmarks(ARGS.format, corpus, workdir, stages,
+                                 ARGS.concurrency, ARGS.backcheck)
+
+    output = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "params": params,
+        "results": results,
+    }
+    if ARGS.output:
+        with open(ARGS.output, "w") as outf:
+            json.dump(output, outf, indent=2)
+
+    baseline = None
+    if ARGS.baseline:
+        with open(ARGS.baseline) as inf:
+            baseline = json.load(inf)
+    print_results(results, baseline)
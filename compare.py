@@ -1,15 +1,23 @@
 #!/usr/bin/env python3
 
+import os
+import re
 import sys
 import csv
+import json
+import socket
 import logging
 import argparse
 import ipaddress
 import itertools
 import collections
-import multiprocessing as mp
 
 import util
+import sketch
+import nodedict
+import rowindex
+import instrument
+import shmtransport
 
 csv.field_size_limit(sys.maxsize)
 
@@ -25,11 +33,239 @@ csv.field_size_limit(sys.maxsize)
 IP_TRANSFORMS = {
   "ip": lambda x: x,  # do nothing
   "asn": util.ip2asn, # map IP to ASN
-  "geo": util.geoip,  # map IP to geo
+  "geo": util.geoip,  # map IP to country code
+  "geo-region": lambda ip: util.geoip(ip, "region"), # map IP to country/region
+  "geo-usage": lambda ip: util.geoip(ip, "usage"), # map IP to usage type
   "24prefix": lambda ip: util.ip_prefix(ip, 24), # map IP to /24 prefix
   "16prefix": lambda ip: util.ip_prefix(ip, 16), # map IP to /16 prefix
 }
 
+# Levels which --rollup computes in addition to "<n>prefix" for IPv4 prefix
+# lengths n, as functions of (IP, date)
+ROLLUP_TRANSFORMS = {
+  "ip": lambda ip, date: ip,
+  "asn": util.ip2asn, # with the ASN database of the row's date
+  "geo": lambda ip, date: util.geoip(ip),
+  "geo-region": lambda ip, date: util.geoip(ip, "region"),
+  "geo-usage": lambda ip, date: util.geoip(ip, "usage"),
+}
+
+# Transforms and rollup levels which look up util.geoip, and whose row values
+# are resolved in one batch
+GEO_TRANSFORMS = ("geo", "geo-region", "geo-usage")
+DEFAULT_ROLLUP = "ip,24prefix,16prefix,asn"
+
+# Row keys which are dates, for date-dependent transforms
+DATE_KEY = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+def parse_rollup(spec: str):
+  """
+  Parses a comma-separated list of rollup levels.
+  >>> parse_rollup("ip,24prefix,16prefix,asn")
+  ['ip', '24prefix', '16prefix', 'asn']
+  >>> parse_rollup("ip,33prefix")
+  Traceback (most recent call last):
+  ...
+  ValueError: Unknown rollup level 33prefix
+  """
+  levels = spec.split(",")
+  for level in levels:
+    if level in ROLLUP_TRANSFORMS:
+      continue
+    if level.endswith("prefix") and level[:-6].isdigit() and 0 < int(level[:-6]) <= 32:
+      continue
+    raise ValueError("Unknown rollup level {}".format(level))
+  return levels
+
+def ipv4_prefixes(ip: str, lengths):
+  """
+  Returns the IPv4 supernets of ip with the given prefix lengths, formatted
+  as util.ip_prefix does, parsing ip only once.
+  >>> ipv4_prefixes("8.8.8.8", [24, 16])
+  ['8.8.8.0/24', '8.8.0.0/16']
+  """
+  addr = int.from_bytes(socket.inet_aton(ip), "big")
+  return ["{}/{}".format(socket.inet_ntoa(
+            (addr & (0xffffffff << (32 - n))).to_bytes(4, "big")), n)
+          for n in lengths]
+
+def rollup_values(valuelist, levels, date=None, unique=False):
+  """
+  Returns {level -> Counter of the values transformed for that level}, see
+  parse_rollup. Each distinct value is transformed once per level, and
+  IPv4 addresses are parsed once for all prefix levels. Prefix levels only
+  count IPv4 addresses.
+  >>> r = rollup_values(["8.8.8.8", "8.8.4.4", "8.8.8.8"], ["ip", "24prefix"])
+  >>> r["ip"]["8.8.8.8"], sorted(r["24prefix"].items())
+  (2, [('8.8.4.0/24', 1), ('8.8.8.0/24', 2)])
+  """
+  instrument.count(rows=1, nodes=len(valuelist))
+  counts = collections.Counter(set(valuelist) if unique else valuelist)
+  prefix_levels = [l for l in levels if l not in ROLLUP_TRANSFORMS]
+  lengths = [int(l[:-6]) for l in prefix_levels]
+  other_levels = [l for l in levels if l in ROLLUP_TRANSFORMS]
+  result = {level: collections.Counter() for level in levels}
+  if any(level in GEO_TRANSFORMS for level in levels):
+    util.geoip_many(counts.keys())
+  for value, n in counts.items():
+    for level in other_levels:
+      v = ROLLUP_TRANSFORMS[level](value, date)
+      if v is not None:
+        result[level][v] += n
+    if prefix_levels and util.ip_family(value) == 4:
+      for level, prefix in zip(prefix_levels, ipv4_prefixes(value, lengths)):
+        result[level][prefix] += n
+  return result
+
+def rollup_field(level, combo_field):
+  """Name of the output field of a combination at a rollup level"""
+  return level + ":" + combo_field
+
+def rollup_cardinality_row(groups, key, combos, levels, inner_delimiter=";"):
+  """
+  Like cardinality_row, but groups maps to {level -> counter} instead of
+  counters, and the row has a group of fields for each level.
+  """
+  rowvalues = {'key': key}
+  for level in levels:
+    level_groups = {fname: {key: table[key][level]}
+                    for fname, table in groups.items()}
+    row = cardinality_row(level_groups, key, combos, inner_delimiter)
+    for combo in combos:
+      field = inner_delimiter.join(combo)
+      rowvalues[rollup_field(level, field)] = row[field]
+  return rowvalues
+
+def count_values(valuelist, transform, unique=False):
+  """
+  Transforms each value in valuelist and returns a Counter of the transformed
+  values.
+  """
+  instrument.count(rows=1, nodes=len(valuelist))
+  if unique:
+    valuelist = set(valuelist)
+
+  # transform IP addresses using the selected transformation and remove any
+  # that transform to a None value (e.g. un-announced IPs)
+  # e.g. IP -> ASN or IP -> /24 prefix etc
+  valuelist = filter(lambda v: v is not None, map(transform, valuelist))
+  return collections.Counter(valuelist)
+
+def sketch_values(valuelist, transform, k=sketch.DEFAULT_K):
+  """
+  Transforms each value in valuelist and returns a sketch.KMVSketch of the
+  set of transformed values.
+  """
+  instrument.count(rows=1, nodes=len(valuelist))
+  valuelist = filter(lambda v: v is not None, map(transform, valuelist))
+  return sketch.KMVSketch.from_values(valuelist, k)
+
+def error_field(combo_field):
+  """Name of the output field with the error bound of an approximate count"""
+  return combo_field + "_err95"
+
+def approximate_cardinality_row(groups, key, combos, inner_delimiter=";"):
+  """
+  Like cardinality_row, but groups maps to sketches instead of counters, and
+  the row includes the 95% error bound of each estimate.
+  """
+  rowvalues = {'key': key}
+  for combo in combos:
+    estimate, err = sketch.intersection([groups[fname][key] for fname in combo])
+    field = inner_delimiter.join(combo)
+    rowvalues[field] = estimate
+    rowvalues[error_field(field)] = round(err)
+  return rowvalues
+
+def cardinality_row(groups, key, combos, inner_delimiter=";"):
+  """
+  Produce row-wise intersections for the same key for all possible
+  combinations of input files. groups is a mapping of
+  {input-filename -> {key -> counter of identifiers}}.
+  """
+  rowvalues = {'key': key}
+  logging.debug("cardinality_row: computing intersections for key = %s", key)
+  for combo in combos:
+    isect = None
+    for fname in combo:
+      if isect is None:
+        isect = groups[fname][key].keys()
+      else:
+        isect &= groups[fname][key].keys()
+    rowvalues[inner_delimiter.join(combo)] = len(isect)
+  return rowvalues
+
+class Checkpoint:
+  """
+  Checkpoint journal of the rows processed by a compare.py run, so that an
+  interrupted run can be resumed. It is kept in a directory holding a pickle
+  of the result of each processed row, and a file "journal" with a JSON
+  header line {"options": {...}, "files": {name -> stamp}} followed by a line
+  name<TAB>key<TAB>pickle for each processed row.
+  """
+  JOURNAL = "journal"
+  PICKLE_PREFIX = "row-"
+
+  def __init__(self, dirname, options, stamps, resume=False):
+    self.dirname = dirname
+    # Compare headers as they read back from JSON
+    self.header = json.loads(json.dumps({"options": options, "files": stamps}))
+    self.done = {}
+    os.makedirs(dirname, exist_ok=True)
+    journal = os.path.join(dirname, self.JOURNAL)
+    if resume:
+      self.done = self._read(journal)
+    if not self.done:
+      self.remove()
+      with open(journal, "w") as f:
+        f.write(json.dumps(self.header, sort_keys=True) + "\n")
+    self.journalf = open(journal, "a")
+    self.n = len(self.done)
+
+  def _read(self, journal):
+    # Returns {(name, key) -> pickle} of the rows done, if the journal is for
+    # the same options and unchanged input files
+    if not os.path.isfile(journal):
+      logging.warning("No checkpoint journal in %s, starting over", self.dirname)
+      return {}
+    done = {}
+    with open(journal, "r") as f:
+      try:
+        header = json.loads(f.readline())
+      except ValueError:
+        header = None
+      if header != self.header or None in self.header["files"].values():
+        logging.warning("Checkpoint in %s is for other options or inputs, "
+                        "starting over", self.dirname)
+        return {}
+      for line in f:
+        # The last line may be incomplete if we were interrupted
+        if not line.endswith("\n"):
+          break
+        name, key, pickle_fname = line.rstrip("\n").split("\t")
+        done[(name, key)] = pickle_fname
+    logging.info("Resuming after %s processed rows", len(done))
+    return done
+
+  def results(self, name):
+    """Returns {key -> result} of the rows of input file name done."""
+    return {key: util.read_pickle(os.path.join(self.dirname, fname))
+            for (n, key), fname in self.done.items() if n == name}
+
+  def add(self, name, key, result):
+    fname = "{}{}.pickle".format(self.PICKLE_PREFIX, self.n)
+    self.n += 1
+    util.write_pickle(result, os.path.join(self.dirname, fname))
+    self.journalf.write("{}\t{}\t{}\n".format(name, key, fname))
+    self.journalf.flush()
+    os.fsync(self.journalf.fileno())
+
+  def remove(self):
+    """Removes the journal and pickles."""
+    for fname in os.listdir(self.dirname):
+      if fname == self.JOURNAL or fname.startswith(self.PICKLE_PREFIX):
+        os.remove(os.path.join(self.dirname, fname))
+
 if __name__ == "__main__":
   # Configure logging module
   logging.basicConfig(#filename="aggregate_scans.log", 
@@ -45,36 +281,158 @@ if __name__ == "__main__":
     help="If set, missing keys will be ignored instead of causing an exception.")
   parser.add_argument("--compare", "-c", choices=sorted(IP_TRANSFORMS.keys()),
       default="ip", help="What to compare.")
+  parser.add_argument("--rollup", "-ru", nargs="?", type=parse_rollup,
+    const=parse_rollup(DEFAULT_ROLLUP), default=None,
+    help="If specified, compare at several levels in one pass over the "
+    "inputs, instead of --compare, with a group of output fields "
+    "<level>:<combo> for each level. Levels are comma-separated: ip, asn "
+    "(with the ASN database of each date key), geo, geo-region, geo-usage "
+    "and <n>prefix for IPv4 /n prefixes (default={}).".format(DEFAULT_ROLLUP))
   parser.add_argument("--explore", "-e", default=None,
     help="Explore one intersection of a specific date/key. Format: key=combo "
     "where combo is an --inner-delimiter separated list of input filenames.")
+  parser.add_argument("--keys", "-k", default=None,
+    help="If specified, only compare rows with these keys (comma-separated).")
   parser.add_argument("--no-grouping", "-ng", action="store_true",
     help="If specified, counts are shown for each set in output of --explore.")
   parser.add_argument("--unique", "-u", action="store_true",
     help="If specified, remove duplicate values before processing each input row.")
+  parser.add_argument("--approximate", "-a", action="store_true",
+    help="If specified, estimate cardinalities from sketches of each row "
+    "instead of exact sets, and output the 95%% error bound of each estimate "
+    "in a <combo>_err95 field. Not supported with --explore.")
+  parser.add_argument("--sketch-size", "-ss", type=int, default=sketch.DEFAULT_K,
+    help="Number of hashes kept per sketch with --approximate; errors shrink "
+    "with the square root of this (default={})".format(sketch.DEFAULT_K))
+  parser.add_argument("--sketches", "-sk", default=None,
+    help="If specified with --approximate, reuse sketches of unchanged input "
+    "files from this file, and save new sketches to it.")
+  parser.add_argument("--checkpoint", "-cp", default=None,
+    help="If specified, record the result of each processed row in this "
+    "directory, so that an interrupted run can be continued with --resume. "
+    "It is cleared when the run completes.")
+  parser.add_argument("--resume", "-r", action="store_true",
+    help="If specified with --checkpoint, reuse the rows processed by an "
+    "interrupted run with the same options and unchanged input files. The "
+    "output is identical to that of an uninterrupted run.")
+  parser.add_argument("--node-dict", "-nd", default=None,
+    help="If specified, input values are integer node IDs from this node "
+    "dictionary file (see aggregate_scans.py --node-dict). IDs are only "
+    "decoded for transforms other than ip and for --explore output. All "
+    "inputs must have been encoded with this dictionary, as recorded in "
+    "their <input>.state.")
     
   parser.add_argument("--concurrency", "-j", type=int, default=util.DEFAULT_CONCURRENCY,
     help="Number of MP workers to use for reading scanfiles concurrently."
     " (default={})".format(util.DEFAULT_CONCURRENCY))
+  parser.add_argument("--shm", action="store_true",
+    help="If specified, workers return the counts of each row through shared "
+    "memory instead of pickling them through a pipe. Ignored with "
+    "--approximate, whose sketches are small.")
+  parser.add_argument("--server", "-s", default=None,
+    help="If specified, compute cardinalities with the query_server.py "
+    "instance at this URL (e.g. http://localhost:8642), which keeps parsed "
+    "rows loaded between queries. Not supported with --explore, "
+    "--approximate or --node-dict.")
+  parser.add_argument("--geoip-db", "-gdb", default=util.GEOIP_DB,
+    help="IP2Location SQLite database for the geo transforms and rollup "
+    "levels (default={})".format(util.GEOIP_DB))
+  parser.add_argument("--geoip-cache", "-gc", default=None,
+    help="If specified, cache the locations looked up by the geo transforms "
+    "in this SQLite file, shared by the workers and reused by later runs.")
+  instrument.add_argument(parser)
 
   ARGS = parser.parse_args()
+  instrument.setup(ARGS.instrument, "compare")
+  util.GEOIP_DB = ARGS.geoip_db
+  util.GEOIP_CACHE = ARGS.geoip_cache
+  if ARGS.approximate and ARGS.explore:
+    parser.error("--explore is not supported with --approximate")
+  if ARGS.sketches and not ARGS.approximate:
+    parser.error("--sketches requires --approximate")
+  if ARGS.resume and not ARGS.checkpoint:
+    parser.error("--resume requires --checkpoint")
+  if ARGS.rollup and (ARGS.explore or ARGS.approximate or ARGS.server):
+    parser.error("--rollup is not supported with --explore, --approximate "
+                 "or --server")
+  if not ARGS.server and (ARGS.compare in GEO_TRANSFORMS or
+      any(level in GEO_TRANSFORMS for level in ARGS.rollup or [])):
+    try:
+      util.check_geoip_db()
+    except FileNotFoundError as e:
+      parser.error(str(e))
+
+  # If a query server is given, let it do the work
+  if ARGS.server:
+    if ARGS.explore or ARGS.approximate or ARGS.node_dict:
+      parser.error("--server is not supported with --explore, --approximate "
+                   "or --node-dict")
+    for infile in ARGS.infiles:
+      infile.close()
+      if not rowindex.indexable(infile):
+        parser.error("--server needs input files, not {}".format(infile.name))
+    result = util.server_query(ARGS.server, "compare", {
+      "files": [(infile.name, os.path.abspath(infile.name))
+                for infile in ARGS.infiles],
+      "keys": ARGS.keys.split(",") if ARGS.keys else None,
+      "compare": ARGS.compare,
+      "unique": ARGS.unique,
+      "ignore_missing_keys": ARGS.ignore_missing_keys,
+    })
+    writer = csv.DictWriter(sys.stdout, fieldnames=result["fields"],
+        delimiter=ARGS.delimiter,  lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(result["rows"])
+    sys.exit(0)
   
   # Function to transform input IP addresses to comparable format
   transform = IP_TRANSFORMS[ARGS.compare]
 
+  # Node dictionary for integer-encoded inputs. Loaded before the worker pools
+  # are created so that forked workers share it.
+  node_dict = nodedict.NodeDict(ARGS.node_dict) if ARGS.node_dict else None
+  if node_dict is not None:
+    # IDs of inputs encoded with another dictionary would decode to the wrong
+    # nodes
+    for infile in ARGS.infiles:
+      try:
+        node_dict.check_output(infile.name)
+      except ValueError as e:
+        parser.error(str(e))
+    if ARGS.compare == "ip":
+      # Compare the integer IDs directly
+      transform = lambda i: int(i) if i else None
+    else:
+      ip_transform = transform
+      transform = lambda i: ip_transform(node_dict.decode(i)) if i else None
+
   def process_row(row, keyfunc=lambda r: r[0], valuefunc=lambda r: r[1].strip()):
-    key = keyfunc(row)
-    logging.info("Processing row key %s", key)
-    values = valuefunc(row)
-    valuelist = values.strip(ARGS.inner_delimiter).split(ARGS.inner_delimiter)
-    if ARGS.unique:
-      valuelist = set(valuelist)
-
-    # transform IP addresses using the selected transformation and remove any
-    # that transform to a None value (e.g. un-announced IPs)
-    # e.g. IP -> ASN or IP -> /24 prefix etc
-    valuelist = filter(lambda v: v is not None, map(transform, valuelist))
-    return key, collections.Counter(valuelist)
+    with instrument.stage("process_row"):
+      key = keyfunc(row)
+      logging.info("Processing row key %s", key)
+      values = valuefunc(row)
+      valuelist = values.strip(ARGS.inner_delimiter).split(ARGS.inner_delimiter)
+      if ARGS.approximate:
+        return key, sketch_values(valuelist, transform, ARGS.sketch_size)
+      if ARGS.rollup:
+        if node_dict is not None:
+          valuelist = [node_dict.decode(v) for v in valuelist if v]
+        date = key if DATE_KEY.match(key) else None
+        counters = rollup_values(valuelist, ARGS.rollup, date, ARGS.unique)
+        if ARGS.shm:
+          return key, {level: shmtransport.SharedCounter.put(c)
+                       for level, c in counters.items()}
+        return key, counters
+      if ARGS.compare in GEO_TRANSFORMS:
+        # Resolve the row's distinct IPs in one batch
+        ips = set(valuelist)
+        if node_dict is not None:
+          ips = {node_dict.decode(v) for v in ips if v}
+        util.geoip_many(ips)
+      counter = count_values(valuelist, transform, ARGS.unique)
+      if ARGS.shm:
+        return key, shmtransport.SharedCounter.put(counter)
+      return key, counter
 
   # A mapping of {input-filename -> {date -> counter of identifiers}}
   groups = {}
@@ -85,12 +443,17 @@ if __name__ == "__main__":
   keys_seen = set()
   keys = []
 
+  # Keys to read, if --explore or --keys is given. Rows with these keys are
+  # read using the row index of each input file (see rowindex.py).
+  wanted_keys = None
+  if ARGS.explore:
+    wanted_keys = {ARGS.explore.split("=")[0]}
+  elif ARGS.keys:
+    wanted_keys = set(ARGS.keys.split(","))
+
   def row_filter(row):
-    # If --explore is given, ignore rows that don't match the key
-    if ARGS.explore:
-      exkey = ARGS.explore.split("=")[0]
-      return row[0] == exkey
-    return True
+    # Ignore rows that don't match wanted keys
+    return wanted_keys is None or row[0] in wanted_keys
   
   def infile_filter(infile):
     if ARGS.explore:
@@ -98,23 +461,115 @@ if __name__ == "__main__":
       return infile.name in exfnames
     return True
 
+  # Saved sketches of input files, in the format {"options": {...}, "files":
+  # {filename -> {"stamp": (size, mtime), "complete": bool, "sketches":
+  # {key -> sketch}}}}. "complete" is False if only some keys were read.
+  sketch_options = {"compare": ARGS.compare, "sketch_size": ARGS.sketch_size,
+                    "node_dict": ARGS.node_dict, "geoip_db": ARGS.geoip_db}
+  saved_sketches = {"options": sketch_options, "files": {}}
+  if ARGS.sketches and os.path.isfile(ARGS.sketches):
+    saved = util.read_pickle(ARGS.sketches)
+    if saved["options"] == sketch_options:
+      saved_sketches = saved
+    else:
+      logging.warning("Ignoring sketches in %s made with other options",
+                      ARGS.sketches)
+
+  def file_stamp(infile):
+    if not rowindex.indexable(infile):
+      return None
+    st = os.stat(infile.name)
+    return st.st_size, st.st_mtime_ns
+
+  def reusable_sketches(infile):
+    # Returns saved sketches of infile if they are up to date and include
+    # every key we need, otherwise None
+    saved = saved_sketches["files"].get(infile.name)
+    if saved is None or saved["stamp"] != file_stamp(infile):
+      return None
+    if wanted_keys is None and not saved["complete"]:
+      return None
+    if wanted_keys is not None and not wanted_keys <= saved["sketches"].keys():
+      return None
+    return saved["sketches"]
+
+  # Journal of processed rows, for --resume
+  checkpoint = None
+  if ARGS.checkpoint:
+    checkpoint = Checkpoint(ARGS.checkpoint,
+      {k: getattr(ARGS, k) for k in ("compare", "unique", "approximate",
+        "sketch_size", "node_dict", "rollup", "delimiter", "inner_delimiter",
+        "geoip_db")},
+      {infile.name: file_stamp(infile) for infile in ARGS.infiles},
+      resume=ARGS.resume)
+
   # Read input files into data structure
   for infile in filter(infile_filter, ARGS.infiles):
+    if ARGS.sketches:
+      reused = reusable_sketches(infile)
+      if reused is not None:
+        logging.info("Reusing sketches of input file %s", infile.name)
+        infile.close()
+        table = {k: v for k, v in reused.items()
+                 if wanted_keys is None or k in wanted_keys}
+        for key in table:
+          if key not in keys_seen:
+            keys_seen.add(key)
+            keys.append(key)
+        groups[infile.name] = table
+        continue
     logging.info("Reading input file %s", infile.name)
-    with infile as inf:
-      reader = csv.reader(inf, delimiter=ARGS.delimiter)
+    with infile as inf, instrument.stage("read_file"):
+      if wanted_keys is not None and rowindex.indexable(inf):
+        index = rowindex.load_index(inf.name, ARGS.delimiter)
+        inrows = rowindex.read_rows(inf.name, wanted_keys, index, ARGS.delimiter)
+      else:
+        inrows = filter(row_filter, csv.reader(inf, delimiter=ARGS.delimiter))
       table = {}
-      
-      with mp.Pool(ARGS.concurrency) as p:
-        rows = p.map(process_row, filter(row_filter, reader))
 
-      for (key, valueset) in rows:
+      def add_row(key, valueset, record=True):
         if key not in keys_seen:
           keys_seen.add(key)
           keys.append(key)
-        table[key] = valueset
+        if ARGS.rollup:
+          table[key] = {level: shmtransport.take(c) for level, c in valueset.items()}
+        else:
+          table[key] = shmtransport.take(valueset)
+        if record and checkpoint is not None:
+          checkpoint.add(infile.name, key, table[key])
+
+      if checkpoint is not None:
+        # Reuse rows processed by an interrupted run
+        for key, result in checkpoint.results(infile.name).items():
+          if wanted_keys is None or key in wanted_keys:
+            add_row(key, result, record=False)
+        done_keys = set(table.keys())
+        inrows = (row for row in inrows if row[0] not in done_keys)
+
+      if wanted_keys is not None and len(wanted_keys) == 1:
+        # Not worth starting a pool for one row
+        for row in map(process_row, inrows):
+          add_row(*row)
+      else:
+        with util.make_pool(ARGS.concurrency) as p:
+          for row in p.imap(process_row, inrows):
+            add_row(*row)
 
       groups[infile.name] = table
+
+    stamp = file_stamp(infile)
+    if ARGS.sketches and stamp is not None:
+      saved = saved_sketches["files"].get(infile.name)
+      if saved is not None and saved["stamp"] == stamp:
+        # Add to the sketches of other keys of the same file
+        saved["sketches"].update(table)
+        saved["complete"] |= wanted_keys is None
+      else:
+        saved_sketches["files"][infile.name] = {"stamp": stamp,
+          "complete": wanted_keys is None, "sketches": dict(table)}
+
+  if ARGS.sketches:
+    util.write_pickle(saved_sketches, ARGS.sketches)
     
   # Generate all possible combinations of the input files
   combos = util.all_combinations(groups.keys())
@@ -147,20 +602,12 @@ if __name__ == "__main__":
       raise Exception("Key mismatch in input files")
 
   def make_cardinality_outputrow(key):
-    # Produce row-wise intersections for the same key for all possible
-    # combinations of input files
-    rowvalues = {'key': key}
-    logging.debug("make_cardinality_outputrow: computing intersections "
-                  "for key = %s", key)
-    for combo in combos:
-      isect = None
-      for fname in combo:
-        if isect is None:
-          isect = groups[fname][key].keys()
-        else:
-          isect &= groups[fname][key].keys()
-      rowvalues[ARGS.inner_delimiter.join(combo)] = len(isect)
-    return rowvalues
+    if ARGS.approximate:
+      return approximate_cardinality_row(groups, key, combos, ARGS.inner_delimiter)
+    if ARGS.rollup:
+      return rollup_cardinality_row(groups, key, combos, ARGS.rollup,
+                                    ARGS.inner_delimiter)
+    return cardinality_row(groups, key, combos, ARGS.inner_delimiter)
   
   def make_intersection_outputrows(key, combo, group=True):
     isect = None
@@ -197,17 +644,32 @@ if __name__ == "__main__":
     key, combo = ARGS.explore.split("=")
     combo = sorted(combo.split(ARGS.inner_delimiter))
     logging.info("Writing intersection data for key=%s combo=%s", key, combo)
-    for row in make_intersection_outputrows(key, combo, group=(not ARGS.no_grouping)):
-      writer.writerow(row)
+    with instrument.stage("explore"):
+      for row in make_intersection_outputrows(key, combo, group=(not ARGS.no_grouping)):
+        if node_dict is not None and ARGS.compare == "ip":
+          # Node is the second-last field in both grouped and ungrouped output
+          row = row[:-2] + (node_dict.decode(row[-2]), row[-1])
+        writer.writerow(row)
+        instrument.count(rows=1)
 
   # Write intersection cardinalities
   else:
     outfields = ["key"]+[ARGS.inner_delimiter.join(combo) for combo in combos]
+    if ARGS.rollup:
+      outfields = ["key"] + [rollup_field(level, f) for level in ARGS.rollup
+                             for f in outfields[1:]]
+    if ARGS.approximate:
+      outfields += [error_field(f) for f in outfields[1:]]
     writer = csv.DictWriter(sys.stdout, fieldnames=outfields,
         delimiter=ARGS.delimiter,  lineterminator="\n")
     writer.writeheader()
 
     # Loop over keys (e.g. dates) in order 
-    for key in sorted(keys):
-      rowvalues = make_cardinality_outputrow(key)
-      writer.writerow(rowvalues)
+    with instrument.stage("intersect"):
+      for key in sorted(keys):
+        rowvalues = make_cardinality_outputrow(key)
+        writer.writerow(rowvalues)
+        instrument.count(rows=1)
+
+  if checkpoint is not None:
+    checkpoint.remove()
@@ -9,6 +9,7 @@ import argparse
 import collections
 
 import util
+import presence_index
 
 csv.field_size_limit(sys.maxsize)
 
@@ -23,7 +24,6 @@ class CoreNodes:
     # self.backcheck_t = backcheck_t
     # # first date in our rolling range will be 
     # self.start_rolling_date = util.str2dt(self.scandates[0]) + datetime.timedelta(days=backcheck_t-1)
-    # self._build_node_scanmap()
 
   def scans_in_range(self, start_date, end_date):
     """
@@ -122,13 +122,54 @@ class CoreNodes:
       core_start += datetime.timedelta(days=1)
       core_end += datetime.timedelta(days=1)
 
-  # def _build_node_scanmap(self):
-    # logging.info("Building node -> scans map")
-    # node_scanmap = collections.defaultdict(list)
-    # for date, nodes in self.data.items():
-    #   logging.debug("Building node -> scans map for key={}".format(date))
-    #   for node in nodes:
-    #     bisect.insort(node_scanmap[node], seld.__scan_ids[date])
+  def _window_cutoffs(self, totals, nscans, percentiles):
+    """
+    Sorts the nodes in a window once by descending count, and returns the
+    sorted node list together with, for each percentile, the number of leading
+    nodes which meet that percentile (i.e. the position of the cut).
+    """
+    ordered = sorted(totals, key=lambda n: (-totals[n], n))
+    # negated counts are ascending, so we can bisect on them
+    neg_counts = [-totals[n] for n in ordered]
+    cutoffs = {}
+    for percentile in percentiles:
+      # smallest count satisfying the same test as core() uses
+      min_count = next((c for c in range(1, nscans + 1)
+                        if c/nscans >= percentile), nscans + 1)
+      cutoffs[percentile] = bisect.bisect_right(neg_counts, -min_count)
+    return ordered, cutoffs
+
+  def sweep(self, backchecks, percentiles, invert: bool = False):
+    """
+    Generator that computes rolling_core for every combination of the given
+    backcheck lengths and percentiles. Node counts are computed once per
+    window and nodes are sorted by count once per window, so that each
+    percentile is just a cut of the sorted window.
+    Yields tuples of the format:
+    (backcheck:int, percentile:float, start_date:datetime, end_date:datetime,
+     total_number_of_nodes_in_window:int, sorted_list_of_nodes:list)
+    """
+    percentiles = list(percentiles)
+    for backcheck in backchecks:
+      for (core_start, core_end, _, _) in self.rolling_core(backcheck,
+                                                            dates_only=True):
+        start_date = core_start.date().isoformat()
+        end_date = core_end.date().isoformat()
+        nscans = len(self.scans_in_range(start_date, end_date))
+        totals = self._range_totals(start_date, end_date)
+        ordered, cutoffs = self._window_cutoffs(totals, nscans, percentiles)
+        for percentile in percentiles:
+          cut = cutoffs[percentile]
+          nodes = ordered[cut:] if invert else ordered[:cut]
+          yield (backcheck, percentile, core_start, core_end, len(totals),
+                 sorted(nodes))
+
+  def presence_index(self):
+    """
+    Returns a PresenceIndex mapping each node to the run-length encoded
+    intervals of scans (indices into self.scandates) it was present in.
+    """
+    return presence_index.PresenceIndex.from_date_nodes(self.data)
 
 # if __name__ == "__main__":
 #   # Configure logging module
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import os
+import heapq
+import logging
+import tempfile
+
+import instrument
+
+# External sorting of large sets of strings (e.g. formatted nodes) within a
+# memory budget: lines are collected in memory until they exceed the budget,
+# then written out as a sorted run to a temporary file. The runs are merged
+# into one sorted, deduplicated file, which can be streamed by the caller (or
+# by another process) without ever holding all lines in memory.
+
+# Approximate memory used per line held in memory, besides its characters
+# (str object header and set slot)
+LINE_OVERHEAD = 80
+
+TMP_PREFIX = "bc-spill-"
+
+# Maximum number of runs merged at once, to stay well within open file limits
+MAX_MERGE_RUNS = 128
+
+class SpillFile:
+    """
+    A sorted file of lines written by ExternalSorter.finish(). Iterating
+    yields the lines (without newlines). count is the number of lines. Can be
+    passed between processes; call remove() once done with it.
+    """
+    def __init__(self, fname, count):
+        self.fname = fname
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        with open(self.fname, "r", encoding="utf-8", newline="\n") as f:
+            for line in f:
+                yield line[:-1]
+
+    def remove(self):
+        os.remove(self.fname)
+
+class ExternalSorter:
+    """
+    Collects lines (strings without newlines), and writes them sorted and
+    deduplicated to a SpillFile, spilling sorted runs to temporary files in
+    tmp_dir whenever lines held in memory take more than max_bytes.
+
+    >>> s = ExternalSorter(max_bytes=100)
+    >>> for line in ["b", "a", "c", "a", "b"]:
+    ...     s.add(line)
+    >>> len(s.runs)
+    2
+    >>> out = s.finish()
+    >>> list(out), len(out)
+    (['a', 'b', 'c'], 3)
+    >>> out.remove()
+    """
+    def __init__(self, max_bytes, tmp_dir=None):
+        self.max_bytes = max_bytes
+        self.tmp_dir = tmp_dir
+        self.lines = set()
+        self.nbytes = 0
+        # File names of sorted runs spilled so far
+        self.runs = []
+
+    def add(self, line: str):
+        if line not in self.lines:
+            self.lines.add(line)
+            self.nbytes += len(line) + LINE_OVERHEAD
+            if self.nbytes > self.max_bytes:
+                self._spill()
+
+    def _tempfile(self):
+        fd, fname = tempfile.mkstemp(prefix=TMP_PREFIX, dir=self.tmp_dir)
+        return os.fdopen(fd, "w", encoding="utf-8", newline="\n"), fname
+
+    def _spill(self):
+        with instrument.stage("spill"):
+            f, fname = self._tempfile()
+            with f:
+                for line in sorted(self.lines):
+                    f.write(line + "\n")
+            instrument.count(nodes=len(self.lines))
+        logging.debug("Spilled %s lines to %s", len(self.lines), fname)
+        self.runs.append(fname)
+        self.lines = set()
+        self.nbytes = 0
+
+    def finish(self, transform=None):
+        """
+        Merges all lines into one sorted file of unique lines, and returns it
+        as a SpillFile. If given, transform is applied to each line after
+        deduplication; it must preserve the sort order.
+        """
+        # Merge runs in batches until one merge of all of them is possible
+        while len(self.runs) >= MAX_MERGE_RUNS:
+            batch = self.runs[:MAX_MERGE_RUNS]
+            self.runs = self.runs[MAX_MERGE_RUNS:] + [self._merge(batch).fname]
+        in_memory = sorted(self.lines)
+        self.lines = set()
+        merged = self._merge(self.runs, in_memory, transform)
+        self.runs = []
+        return merged
+
+    def _merge(self, fnames, in_memory=(), transform=None):
+        """Merges sorted runs into one SpillFile, removing the runs."""
+        runs = [SpillFile(fname, None) for fname in fnames]
+        count = 0
+        with instrument.stage("merge"):
+            f, fname = self._tempfile()
+            with f:
+                prev = None
+                for line in heapq.merge(in_memory, *runs):
+                    if line == prev:
+                        continue
+                    prev = line
+                    f.write((transform(line) if transform else line) + "\n")
+                    count += 1
+            instrument.count(nodes=count)
+        for run in runs:
+            run.remove()
+        return SpillFile(fname, count)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import resource
+import threading
+import contextlib
+import collections
+
+# Optional per-stage instrumentation for the CLIs. When enabled (with
+# --instrument FILE or the BC_INSTRUMENT environment variable), every
+# instrument.stage() records wall time, CPU time, peak RSS and any counters
+# added with instrument.count() (e.g. bytes read, scans, nodes). Stages run in
+# forked pool workers are appended to a side file, and everything is written
+# as one JSON document when the main process exits.
+#
+# When instrumentation is disabled, stage() and count() do nothing.
+
+ENV_VAR = "BC_INSTRUMENT"
+
+# Counters for which a per-second rate is reported
+RATE_COUNTERS = ("scans", "nodes", "rows", "bytes_read", "bytes_decompressed")
+
+_path = None
+_tool = None
+_main_pid = None
+_records = []
+_records_lock = threading.Lock()
+_local = threading.local()
+
+def add_argument(parser):
+    """Adds the --instrument option to an argparse parser."""
+    parser.add_argument("--instrument", default=os.environ.get(ENV_VAR),
+      help="If specified, write per-stage timing and throughput data as JSON "
+           "to this file at exit (or set {}).".format(ENV_VAR))
+
+def setup(path, tool):
+    """Enables instrumentation for this process if path is not None."""
+    global _path, _tool, _main_pid
+    if not path:
+        return
+    _path = path
+    _tool = tool
+    _main_pid = os.getpid()
+    if os.path.exists(_workers_path()):
+        os.remove(_workers_path())
+    atexit.register(write)
+
+def enabled():
+    return _path is not None
+
+def _workers_path():
+    return _path + ".workers"
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+def _peak_rss_kb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+@contextlib.contextmanager
+def stage(name):
+    """Context manager recording one execution of the named stage."""
+    if _path is None:
+        yield
+        return
+    record = {
+        "stage": name,
+        "pid": os.getpid(),
+        "thread": threading.current_thread().name,
+        "counters": collections.Counter(),
+    }
+    stack = _stack()
+    stack.append(record)
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        record["wall_s"] = time.perf_counter() - wall_start
+        record["cpu_s"] = time.thread_time() - cpu_start
+        record["peak_rss_kb"] = _peak_rss_kb()
+        stack.pop()
+        _store(record)
+
+def count(**counters):
+    """Adds to the counters of the innermost active stage in this thread."""
+    if _path is None:
+        return
+    stack = _stack()
+    if stack:
+        stack[-1]["counters"].update(counters)
+
+def _store(record):
+    if os.getpid() == _main_pid:
+        with _records_lock:
+            _records.append(record)
+    else:
+        # Forked worker: append one line per record, which the main process
+        # collects at exit
+        with open(_workers_path(), "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+def _summarise(records):
+    """Sums records by stage name, adding per-second rates."""
+    summary = {}
+    for r in records:
+        s = summary.setdefault(r["stage"], {"calls": 0, "wall_s": 0.0,
+                                            "cpu_s": 0.0, "peak_rss_kb": 0,
+                                            "counters": collections.Counter()})
+        s["calls"] += 1
+        s["wall_s"] += r["wall_s"]
+        s["cpu_s"] += r["cpu_s"]
+        s["peak_rss_kb"] = max(s["peak_rss_kb"], r["peak_rss_kb"])
+        s["counters"].update(r["counters"])
+    for s in summary.values():
+        for counter in RATE_COUNTERS:
+            if counter in s["counters"] and s["wall_s"] > 0:
+                s[counter + "_per_s"] = s["counters"][counter] / s["wall_s"]
+    return summary
+
+def write():
+    """Writes collected records as JSON. Called automatically at exit."""
+    if _path is None or os.getpid() != _main_pid:
+        return
+    worker_records = []
+    if os.path.exists(_workers_path()):
+        with open(_workers_path()) as f:
+            worker_records = [json.loads(l) for l in f if l.strip()]
+        os.remove(_workers_path())
+    workers = collections.defaultdict(list)
+    for r in worker_records + _records:
+        workers["{}/{}".format(r["pid"], r["thread"])].append(r)
+    output = {
+        "tool": _tool,
+        "argv": sys.argv,
+        "stages": _summarise(_records),
+        "worker_stages": _summarise(worker_records),
+        "workers": {w: _summarise(rs) for w, rs in workers.items()},
+    }
+    logging.info("Writing instrumentation data to %s", _path)
+    with open(_path, "w") as f:
+        json.dump(output, f, indent=2)
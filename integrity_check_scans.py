@@ -10,12 +10,13 @@ import datetime
 import argparse
 import functools
 import collections
-import multiprocessing as mp
 
 from datetime import datetime
 from os import path
 
 import util
+import prefetch
+import instrument
 import load_scan
 
 # Takes a list of dates and scans on stdin or from a file, outputs scans that
@@ -36,6 +37,11 @@ if __name__ == "__main__":
     parser.add_argument("--concurrency", "-j", type=int, default=util.DEFAULT_CONCURRENCY,
       help="Number of MP workers to use for reading scanfiles concurrently."
       " (default={})".format(util.DEFAULT_CONCURRENCY))
+    parser.add_argument("--executor", "-x", choices=util.EXECUTORS, default="process",
+      help="Run workers as processes or threads (default=process)")
+    prefetch.add_argument(parser)
+    util.add_task_arguments(parser)
+    instrument.add_argument(parser)
 
     # Required args
     parser.add_argument("--format", "-f", choices=list(load_scan.FORMAT_LOADERS.keys()), 
@@ -48,6 +54,7 @@ if __name__ == "__main__":
 
     ARGS = parser.parse_args()
     logging.debug("Parsed args: %s", str(ARGS))
+    instrument.setup(ARGS.instrument, "integrity_check_scans")
 
     # Read all scan file paths from all input files
     date_scanfiles = collections.defaultdict(set)
@@ -65,26 +72,47 @@ if __name__ == "__main__":
     # Get correct loader for selected scanfile type
     loader_cls = load_scan.FORMAT_LOADERS[ARGS.format]
 
-    # Mutex for file writing
-    lock = mp.Lock()
-
-    def writerow(row):
-        with lock:
-          writer.writerow(row)
-
     def integrity_check(date_scanfiles: tuple):
-        date, scanfiles = date_scanfiles
+        # Returns the output rows for one date's scans, which are written by
+        # the parent, so that re-run stragglers don't write rows twice.
+        # buffers are only given if we're prefetching
+        date, scanfiles, *buffers = date_scanfiles
+        buffers = buffers[0] if buffers else {}
 
+        rows = []
         for sf in scanfiles:
-            l = loader_cls(sf)
+            with instrument.stage("integrity_check"):
+                l = loader_cls(sf, buffers=buffers.get(sf))
+                instrument.count(scans=1, nodes=len(l.nodes))
             res, err = l.integrity_pass, l.integrity_err
             if not res:
-                writerow(("FAIL", l.filedt(l.scanpath), sf, err,))
+                rows.append(("FAIL", l.filedt(l.scanpath), sf, err,))
             else:
-                writerow(("PASS", l.filedt(l.scanpath), sf,))
-
-    # Load scans for each date
-    with mp.Pool(ARGS.concurrency) as p:
-        p.map(integrity_check, sorted(date_scanfiles.items()))
+                rows.append(("PASS", l.filedt(l.scanpath), sf,))
+        return rows
+
+    tasks = sorted(date_scanfiles.items())
+    prefetcher = None
+    if ARGS.prefetch:
+        prefetcher = prefetch.Prefetcher(tasks,
+            lambda date_sfs: {sf: loader_cls.data_files(sf) for sf in date_sfs[1]},
+            max_bytes=ARGS.prefetch * 1024**2)
+        tasks = ((date, sfs, buffers) for ((date, sfs), buffers) in prefetcher)
+
+    # Load scans for each date. Dates which fail as a whole (e.g. time out)
+    # are reported as failures of each of their scans.
+    with instrument.stage("integrity_check_all"):
+        for (date, scanfiles), rows in zip(sorted(date_scanfiles.items()),
+            util.supervised_imap(
+                lambda: util.make_pool(ARGS.concurrency, ARGS.executor,
+                                       ARGS.max_tasks_per_child),
+                integrity_check, tasks, ARGS.concurrency,
+                timeout=ARGS.task_timeout, speculate=ARGS.speculate)):
+            if prefetcher is not None:
+                prefetcher.release()
+            if isinstance(rows, util.TaskFailure):
+                rows = [("FAIL", loader_cls.filedt(sf), sf, rows.reason)
+                        for sf in sorted(scanfiles)]
+            writer.writerows(rows)
 
     logging.debug("===FINISH===")
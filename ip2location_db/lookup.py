@@ -86,7 +86,10 @@ class IP2Loc:
 
   def lookupv4(self, ipv4:str, transform:bool=True):
     ipnum = int(ipaddress.IPv6Address("::ffff:"+ipv4))
-    res = dict(zip(FIELD_NAMES, self._query(ipnum)))
+    res = self._query(ipnum)
+    if res is None:
+      return None
+    res = dict(zip(FIELD_NAMES, res))
     if transform:
       for fname, t in FIELD_TRANSFORMS.items():
         res[fname] = t(res[fname])
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import io
 import os
 import re
 import sys
@@ -15,16 +16,31 @@ import collections
 from datetime import datetime
 from os import path
 
-sys.path.insert(0, "../btccrawlgo-processing")
-from processing.dataset import Dataset
-
 import util
+import instrument
 
 class LoadScan:
     NODE_PART_SEP = ":"
 
-    def __init__(self, scan_path):
+    def __init__(self, scan_path, family=None, buffers=None):
+        """
+        family: if 4, only nodes with IPv4 addresses are loaded (as if
+        drop_ipv6 was called after loading). If 6, only nodes with non-IPv4
+        addresses are loaded (as if drop_ipv4 was called after loading).
+        Filtering happens while parsing, so other nodes are never
+        materialised. If None, all nodes are loaded.
+
+        buffers: optional dict {file name -> raw file contents} of files in
+        the scan which have already been read (see prefetch.py). Other files
+        are read from disk.
+        """
         self.scanpath = scan_path
+        self.family = family
+        self.buffers = buffers or {}
+        # Number of contactable nodes in the scan, before family filtering
+        self.nb_nodes_read = 0
+        # Why reading the nodes failed, if it did
+        self.load_error = None
         self.integrity_pass, self.integrity_err = self._integrity_check(preload=True)
 
         if not self.integrity_pass:
@@ -38,10 +54,17 @@ class LoadScan:
             # until someone calls .load_uncontactable()
             try:
                 self.nodes = self._read_nodes()
-            except:
+            except Exception as e:
+                self.load_error = "{}: {}".format(type(e).__name__, e)
+                logging.error("Couldn't load nodes from %s: %s",
+                              self.scanpath, self.load_error)
                 self.nodes = []
             self.uncontactable_nodes = None
-            self.integrity_pass, self.integrity_err = self._integrity_check(preload=False)
+            if self.load_error is not None:
+                self.integrity_pass = False
+                self.integrity_err = "Load error: " + self.load_error
+            else:
+                self.integrity_pass, self.integrity_err = self._integrity_check(preload=False)
             if not self.integrity_pass:
                 logging.warning("Scan %s failed post-load integrity check! Reason: %s",
                         self.scanpath, self.integrity_err)
@@ -74,21 +97,57 @@ class LoadScan:
 
     def drop_ipv6(self):
         """Removes any node with a non-IPv4 address"""
-        self.nodes = list(filter(lambda n: util.is_ipv4(self.node_ip(n)),
-                                 self.nodes))
+        self.nodes = [n for n in self.nodes
+                      if util.ip_family(self.node_ip(n)) == 4]
         if self.uncontactable_nodes:
-            self.uncontactable_nodes = list(filter(lambda n: util.is_ipv4(self.node_ip(n)),
-                                                   self.uncontactable_nodes))
+            self.uncontactable_nodes = [n for n in self.uncontactable_nodes
+                                        if util.ip_family(self.node_ip(n)) == 4]
     
     def drop_ipv4(self):
         """Removes any node with an IPv4 address"""
-        self.nodes = list(filter(lambda n: not util.is_ipv4(self.node_ip(n)),
-                                 self.nodes))
+        self.nodes = [n for n in self.nodes
+                      if util.ip_family(self.node_ip(n)) != 4]
         if self.uncontactable_nodes:
-            self.uncontactable_nodes = list(filter(lambda n: not util.is_ipv4(self.node_ip(n)),
-                                                   self.uncontactable_nodes))
+            self.uncontactable_nodes = [n for n in self.uncontactable_nodes
+                                        if util.ip_family(self.node_ip(n)) != 4]
+
+    @classmethod
+    def data_files(cls, scan_path, uncontactable=False):
+        """
+        Returns the paths of the files read when loading the given scan (and
+        its uncontactable nodes if uncontactable is True), for prefetching.
+        """
+        raise NotImplementedError
+
+    def _disk_bytes(self, fname):
+        """Size of a file of the scan if it is read from disk, else 0."""
+        if path.basename(fname) in self.buffers:
+            return 0
+        return os.path.getsize(fname)
+
+    def _open(self, fname, opener, mode="rb"):
+        """
+        Opens a file of the scan with opener (e.g. lzma.open), reading it from
+        buffers if it has been prefetched.
+        """
+        buf = self.buffers.get(path.basename(fname))
+        if buf is not None:
+            return opener(io.BytesIO(buf), mode)
+        return opener(fname, mode)
+
+    def _family_filter(self):
+        """
+        Returns a function of an IP address string which is True if a node
+        with that address should be loaded, or None if all nodes are loaded.
+        """
+        if self.family is None:
+            return None
+        if self.family == 4:
+            return lambda ip: util.ip_family(ip) == 4
+        return lambda ip: util.ip_family(ip) != 4
     
-    def filedt(self, scanfile):
+    @classmethod
+    def filedt(cls, scanfile):
         """Extract UTC datetime from given scan file path"""
         raise NotImplementedError
 
@@ -110,11 +169,23 @@ class LoadScan:
 
 
 class LoadYethiScan(LoadScan):
-    def __init__(self, scan_path):
+    CONFIRMED_FILE = "confirmed.csv.xz"
+    EVENTS_FILE = "events.csv.xz"
+
+    def __init__(self, scan_path, family=None, buffers=None):
+        scan_path = util.yethi_scanpath(scan_path)
+        super().__init__(scan_path, family=family, buffers=buffers)
+
+    @classmethod
+    def data_files(cls, scan_path, uncontactable=False):
         scan_path = util.yethi_scanpath(scan_path)
-        super().__init__(scan_path)
+        fnames = [cls.CONFIRMED_FILE]
+        if uncontactable:
+            fnames.append(cls.EVENTS_FILE)
+        return [path.join(scan_path, f) for f in fnames]
 
-    def filedt(self, scanfile):
+    @classmethod
+    def filedt(cls, scanfile):
         return util.yethi_scanfile_dt(scanfile)
 
     @classmethod
@@ -152,7 +223,7 @@ class LoadYethiScan(LoadScan):
         except:
             return False, "Couldn't read every xz"
         # scan must contain more than MIN_NODES confirmed nodes
-        if not preload and len(self.nodes) < NB_MIN_NODES:
+        if not preload and self.nb_nodes_read < NB_MIN_NODES:
             return False, "Less than {} contactable nodes".format(NB_MIN_NODES)
         # all checks passed
         return True, None
@@ -160,36 +231,75 @@ class LoadYethiScan(LoadScan):
     def _read_nodes(self):
         """Reads contactable nodes from the Yethi scan data"""
         nodes = []
-        with lzma.open(path.join(self.scanpath, "confirmed.csv.xz"), "rt") as f:
+        keep = self._family_filter()
+        fname = path.join(self.scanpath, self.CONFIRMED_FILE)
+        with self._open(fname, lzma.open, "rt") as f:
             for l in f:
                 values = l.strip().replace(":", ";").split(";")
-                nodes.append(tuple(values))
+                self.nb_nodes_read += 1
+                if keep is None or keep(values[1]):
+                    nodes.append(tuple(values))
+            instrument.count(bytes_read=self._disk_bytes(fname),
+                             bytes_decompressed=f.buffer.tell())
         return nodes
 
     def _read_uncontactable_nodes(self):
         """Reads uncontactable nodes from the Yethi scan data"""
         nodes = []
-        with lzma.open(path.join(self.scanpath, "events.csv.xz"), "rt") as f:
+        keep = self._family_filter()
+        fname = path.join(self.scanpath, self.EVENTS_FILE)
+        with self._open(fname, lzma.open, "rt") as f:
             for l in f:
                 values = l.strip().split(",")
                 # We want only the uncontactable nodes
                 if values[0] == "UNCONTACTABLE" and values[-1] == "BOND":
-                    nodes.append(tuple(values[1:4]))
+                    if keep is None or keep(values[2]):
+                        nodes.append(tuple(values[1:4]))
+            instrument.count(bytes_read=self._disk_bytes(fname),
+                             bytes_decompressed=f.buffer.tell())
         return nodes
 
+# btccrawlgo-processing, whose Dataset loads BTC-style scans which have no
+# address file (see LoadBtcScan). It's checked out next to this repository.
+BTCCRAWLGO_PROCESSING_DIR = path.join(util.SCRIPT_DIR, "..", "btccrawlgo-processing")
+
+def btc_dataset():
+    """Imports btccrawlgo-processing's Dataset class (and pandas) on first use."""
+    if BTCCRAWLGO_PROCESSING_DIR not in sys.path:
+        sys.path.insert(0, BTCCRAWLGO_PROCESSING_DIR)
+    from processing.dataset import Dataset
+    return Dataset
+
 class LoadBtcScan(LoadScan):
-    def __init__(self, scan_path):
-        # use this property to flag that after loading the dataset, it
-        # contained no nodes (to avoid loading the dataset multiple times)
-        self.__empty = False
-        # cache the dataframe after loading the scan, so that when we want to
-        # do more with it later (e.g. load uncontactable_nodes, we still have
-        # it)
-        self.__df = None
-        super().__init__(scan_path)
-
-    def filedt(self, scanfile):
+    # File listing every address the crawler found, with (among other
+    # columns) whether it was reachable, i.e. the address_ipinfos table of
+    # btccrawlgo-processing's Dataset. It's read natively, which is much
+    # faster than building the Dataset's DataFrame; scans without it are
+    # loaded through the Dataset. load_scan.py --check-native compares the
+    # two on a scan.
+    ADDRESS_FILE = "address_ipinfos.csv.gz"
+    ADDRESS_COLUMN = "address"
+    REACHABLE_COLUMN = "proto_reachable"
+    # Values of the reachable column; rows with other (e.g. empty) values
+    # are neither reachable nor unreachable
+    REACHABLE_VALUES = {"True": True, "true": True, "1": True,
+                        "False": False, "false": False, "0": False}
+
+    def __init__(self, scan_path, family=None, buffers=None):
+        # cache the reachable and unreachable addresses after reading the
+        # scan, so that when we want to do more with it later (e.g. load
+        # uncontactable_nodes), we don't read it again
+        self.__addresses = None
+        super().__init__(scan_path, family=family, buffers=buffers)
+
+    @classmethod
+    def filedt(cls, scanfile):
         return util.btc_scanfile_dt(scanfile)
+
+    @classmethod
+    def data_files(cls, scan_path, uncontactable=False):
+        # Every gz file is read by the integrity check
+        return sorted(glob.glob(path.join(scan_path, "*.gz")))
     
     @classmethod
     def format_node(cls, node, omit_nodeid=False, omit_ip=False, omit_port=False):
@@ -208,14 +318,72 @@ class LoadBtcScan(LoadScan):
     def node_ip(self, node):
         return node[0]
 
-    def __load_df(self):
-        if self.__df is not None or self.__empty:
+    def __load_addresses(self):
+        """
+        Reads the reachable and unreachable addresses of the scan, natively
+        from the address file if there is one, otherwise through the Dataset.
+        """
+        if self.__addresses is not None:
+            return
+        fname = path.join(self.scanpath, self.ADDRESS_FILE)
+        if path.basename(fname) in self.buffers or path.isfile(fname):
+            self.__addresses = self.read_address_file()
             return
-        ds = Dataset()
+        try:
+            self.__addresses = self.read_dataset()
+        except ImportError as e:
+            raise FileNotFoundError("No {} in {}, and btccrawlgo-processing "
+                "can't be imported to load the scan ({})".format(
+                self.ADDRESS_FILE, self.scanpath, e))
+
+    def read_address_file(self):
+        """
+        Reads only the address and reachable columns of the address file, and
+        splits addresses into reachable and unreachable ones in one pass.
+        Returns {True: reachable addresses, False: unreachable addresses}.
+        """
+        addresses = {True: [], False: []}
+        fname = path.join(self.scanpath, self.ADDRESS_FILE)
+        with self._open(fname, gzip.open, "rt") as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            if self.ADDRESS_COLUMN not in header or self.REACHABLE_COLUMN not in header:
+                raise ValueError("{} has no {} and {} columns".format(fname,
+                    self.ADDRESS_COLUMN, self.REACHABLE_COLUMN))
+            address_i = header.index(self.ADDRESS_COLUMN)
+            reachable_i = header.index(self.REACHABLE_COLUMN)
+            for row in reader:
+                reachable = self.REACHABLE_VALUES.get(row[reachable_i])
+                if reachable is not None:
+                    addresses[reachable].append(row[address_i])
+            instrument.count(bytes_read=self._disk_bytes(fname),
+                             bytes_decompressed=f.buffer.tell())
+        return addresses
+
+    def read_dataset(self):
+        """
+        Like read_address_file, but loads the scan with btccrawlgo-processing's
+        Dataset.
+        """
+        ds = btc_dataset()()
         ds.load(self.scanpath.rstrip("/"))
-        if ds.address_ipinfos is None:
-            self.__empty = True
-        self.__df = ds.address_ipinfos
+        df = ds.address_ipinfos
+        if df is None:
+            return {True: [], False: []}
+        return {reachable: df[df[self.REACHABLE_COLUMN] == reachable][
+                    self.ADDRESS_COLUMN].tolist()
+                for reachable in (True, False)}
+
+    def check_native(self):
+        """
+        Reads the address file both natively and through the Dataset, and
+        returns [(reachable, addresses only read natively, addresses only read
+        by the Dataset)] for reachable and unreachable addresses.
+        """
+        native, dataset = self.read_address_file(), self.read_dataset()
+        return [(reachable, sorted(set(native[reachable]) - set(dataset[reachable])),
+                 sorted(set(dataset[reachable]) - set(native[reachable])))
+                for reachable in (True, False)]
 
     def _integrity_check(self, preload=True):
         NB_MIN_EXPECTED_FILES = 5
@@ -232,46 +400,44 @@ class LoadBtcScan(LoadScan):
         # should be able to read at least the first line of every gz file
         try:
             for gz in glob.glob(path.join(self.scanpath, "*.gz")):
-                with gzip.open(gz) as gzf:
-                    gzf.read()
+                with self._open(gz, gzip.open) as gzf:
+                    instrument.count(bytes_read=self._disk_bytes(gz),
+                                     bytes_decompressed=len(gzf.read()))
         except:
             return False, "Couldn't read every gz"
-        if not preload and len(self.nodes) < NB_MIN_NODES:
+        if not preload and self.nb_nodes_read < NB_MIN_NODES:
             return False, "Less than {} contactable nodes".format(NB_MIN_NODES)
         # all checks passed
         return True, None
     
     def _read_nodes(self):
-        self.__load_df()
-        df = self.__df
-        if df is None:
-            logging.warning("Empty nodeset for scan %s %s",
-                    self.filedt(self.scanpath),
-                    self.scanpath)
-            return []
-        reachable = df[df["proto_reachable"] == True]["address"]
-        if reachable is None or len(reachable) == 0:
+        self.__load_addresses()
+        reachable = self.__addresses[True]
+        if len(reachable) == 0:
             logging.warning("Empty nodeset for scan %s %s",
                     self.filedt(self.scanpath),
                     self.scanpath)
             return []
-        return sorted(util.parse_ip_port_pair(n) for n in reachable.tolist())
+        self.nb_nodes_read = len(reachable)
+        return self._parse_addresses(reachable)
 
     def _read_uncontactable_nodes(self):
-        self.__load_df()
-        df = self.__df
-        if df is None:
-            logging.warning("Empty uncontactable nodeset for scan %s %s",
-                    self.filedt(self.scanpath),
-                    self.scanpath)
-            return []
-        unreachable = df[df["proto_reachable"] == False]["address"]
-        if unreachable is None or len(unreachable) == 0:
+        self.__load_addresses()
+        unreachable = self.__addresses[False]
+        if len(unreachable) == 0:
             logging.warning("Empty uncontactable nodeset for scan %s %s",
                     self.filedt(self.scanpath),
                     self.scanpath)
             return []
-        return sorted(util.parse_ip_port_pair(n) for n in unreachable.tolist())
+        return self._parse_addresses(unreachable)
+
+    def _parse_addresses(self, addresses):
+        """Parses and family-filters a list of ip:port strings"""
+        keep = self._family_filter()
+        nodes = map(util.parse_ip_port_pair, addresses)
+        if keep is not None:
+            nodes = (n for n in nodes if keep(n[0]))
+        return sorted(nodes)
 
 # LTC and Dash use same scan file format as Bitcoin
 class LoadLtcScan(LoadBtcScan):
@@ -309,6 +475,16 @@ if __name__ == "__main__":
       help="If specified, load uncontactable nodes instead.")
     parser.add_argument("--integrity", "-i", action="store_true",
       help="If specified, just test integrity of the scan.")
+    parser.add_argument("--check-native", "-cn", action="store_true",
+      help="If specified, check that the native reader of BTC-style scans "
+           "reads the same addresses as btccrawlgo-processing's Dataset, "
+           "and output the reachability, address and reader of any "
+           "differences.")
+    parser.add_argument("--server", "-s", default=None,
+      help="If specified, load the scan through the query_server.py instance "
+           "at this URL (e.g. http://localhost:8642), which keeps scans loaded "
+           "between queries.")
+    instrument.add_argument(parser)
 
     # Required args
     parser.add_argument("--format", "-f", choices=list(FORMAT_LOADERS.keys()), 
@@ -320,6 +496,7 @@ if __name__ == "__main__":
 
     ARGS = parser.parse_args()
     logging.debug("Parsed args: %s", str(ARGS))
+    instrument.setup(ARGS.instrument, "load_scan")
 
     # Initialize TSV output writer
     writer = csv.writer(sys.stdout, delimiter=ARGS.delimiter,
@@ -328,9 +505,43 @@ if __name__ == "__main__":
     # Initialize correct loader for selected scanfile type
     loader_cls = FORMAT_LOADERS[ARGS.format]
 
+    # If a query server is given, let it do the work
+    if ARGS.server and not ARGS.integrity:
+        nodes = util.server_query(ARGS.server, "load", {
+            "format": ARGS.format,
+            "scan": path.abspath(ARGS.scan_path),
+            "keep_ipv6": ARGS.keep_ipv6,
+            "uncontactable": ARGS.uncontactable,
+        })
+        if ARGS.dedupe:
+            nodes = sorted(set(map(tuple, nodes)))
+        for n in nodes:
+            writer.writerow(n)
+        sys.exit(0)
+
+    if ARGS.check_native:
+        if not issubclass(loader_cls, LoadBtcScan):
+            parser.error("--check-native is only supported for BTC-style formats")
+        loader = loader_cls(ARGS.scan_path)
+        try:
+            results = loader.check_native()
+        except ImportError as e:
+            parser.error("--check-native needs btccrawlgo-processing in {} "
+                         "({})".format(BTCCRAWLGO_PROCESSING_DIR, e))
+        differences = 0
+        for reachable, native_only, dataset_only in results:
+            for address in native_only:
+                writer.writerow((reachable, address, "native"))
+            for address in dataset_only:
+                writer.writerow((reachable, address, "dataset"))
+            differences += len(native_only) + len(dataset_only)
+        sys.exit(1 if differences else 0)
+
     # If we're doing an integrity check only, then do that now
     if ARGS.integrity:
-        loader = loader_cls(ARGS.scan_path, )
+        with instrument.stage("integrity_check"):
+            loader = loader_cls(ARGS.scan_path, )
+            instrument.count(scans=1)
         result, err = loader.integrity_pass, loader.integrity_err
         if not result:
             writer.writerow(("FAIL", err,))
@@ -339,28 +550,31 @@ if __name__ == "__main__":
             writer.writerow(("PASS",))
             sys.exit(0)
 
-    loader = loader_cls(ARGS.scan_path)
+    with instrument.stage("load"):
+        # Only load IPv4 nodes unless we're keeping IPv6
+        loader = loader_cls(ARGS.scan_path,
+                            family=None if ARGS.keep_ipv6 else 4)
+        
+        # Load uncontactable nodes if we're doing that
+        if ARGS.uncontactable:
+            loader.load_uncontactable()
+        instrument.count(scans=1)
     
-    # Load uncontactable nodes if we're doing that
-    if ARGS.uncontactable:
-        loader.load_uncontactable()
+    with instrument.stage("filter"):
+        # Dedupe
+        if ARGS.dedupe:
+            loader.dedupe()
     
-    # Remove non-IPv4 if required
-    if not ARGS.keep_ipv6:
-        loader.drop_ipv6()
-
-    # Dedupe
-    if ARGS.dedupe:
-        loader.dedupe()
-    
-    # Write out nodes
-    # Uncontactable nodes if selected:
-    if ARGS.uncontactable:
-        for n in loader.uncontactable_nodes:
-            writer.writerow(n)
-    # Only confirmed nodes:
-    else:
-        for n in loader.nodes:
+    with instrument.stage("write"):
+        # Write out nodes
+        # Uncontactable nodes if selected:
+        if ARGS.uncontactable:
+            nodes = loader.uncontactable_nodes
+        # Only confirmed nodes:
+        else:
+            nodes = loader.nodes
+        for n in nodes:
             writer.writerow(n)
+        instrument.count(nodes=len(nodes))
 
     logging.debug("===FINISH===")
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+import ast
+import sys
+import csv
+import zlib
+import sqlite3
+import logging
+import argparse
+
+import util
+import nodedict
+
+csv.field_size_limit(sys.maxsize)
+
+# This script builds (and queries) an inverted index from nodes to the dates
+# on which each crawler saw them, from aggregate_scans.py outputs, e.g.
+#     2019-05-14	8.8.8.8;8.8.4.4
+# Optionally, the IP address and /24 prefix of each node are indexed too.
+# The index is an SQLite database holding, for every (kind, value, crawler),
+# a zlib-compressed bitmap of date indices. Queries are point lookups, prefix
+# scans, and boolean expressions of crawler names, e.g. "btc and not yethi".
+# Output format: TSV e.g.
+#     8.8.8.8	btc	2019-05-14;2019-05-15
+
+# Kinds of values which can be indexed. Nodes are always indexed.
+KINDS = ("node", "ip", "24prefix")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dates (
+  idx INTEGER PRIMARY KEY,
+  date TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+  kind TEXT NOT NULL,
+  value TEXT NOT NULL,
+  crawler TEXT NOT NULL,
+  bitmap BLOB NOT NULL,
+  PRIMARY KEY (kind, value, crawler)
+) WITHOUT ROWID;
+"""
+
+# Larger than any character in indexed values, to turn a prefix scan into a
+# range scan
+MAX_CHAR = "\U0010ffff"
+
+def encode_bitmap(bits: int):
+  """
+  Compresses a bitmap (an int, where bit i is set if date index i is in the
+  set).
+  >>> decode_bitmap(encode_bitmap(0b1011))
+  11
+  """
+  return zlib.compress(bits.to_bytes((bits.bit_length() + 7) // 8, "little"))
+
+def decode_bitmap(blob: bytes):
+  return int.from_bytes(zlib.decompress(blob), "little")
+
+def bit_indices(bits: int):
+  """
+  >>> bit_indices(0b1011)
+  [0, 1, 3]
+  """
+  return [i for i, b in enumerate(reversed(bin(bits)[2:])) if b == "1"]
+
+def node_ip(node: str):
+  """
+  Returns the IP address in a formatted node (see aggregate_scans.py), or
+  None if it doesn't contain one.
+  >>> node_ip("abcd:8.8.8.8:30303"), node_ip("8.8.8.8:8333"), node_ip("8.8.8.8")
+  ('8.8.8.8', '8.8.8.8', '8.8.8.8')
+  >>> node_ip("[2001:db8::1]:8333"), node_ip("abcd:30303")
+  ('[2001:db8::1]', None)
+  """
+  if "[" in node:
+    return node[node.index("["):node.index("]")+1]
+  for part in node.split(":"):
+    if util.ip_family(part) == 4:
+      return part
+  return None
+
+def parse_expression(expr: str, crawlers):
+  """
+  Parses a boolean expression of crawler names, using and, or, not and
+  parentheses. Raises ValueError for anything else.
+  >>> parse_expression("btc and not (yethi or ltc)", ["btc", "yethi", "ltc"]) is not None
+  True
+  >>> parse_expression("__import__('os')", ["btc"])
+  Traceback (most recent call last):
+  ...
+  ValueError: Unsupported expression: Call
+  """
+  tree = ast.parse(expr, mode="eval")
+  allowed = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp,
+             ast.Not, ast.Name, ast.Load)
+  for node in ast.walk(tree):
+    if not isinstance(node, allowed):
+      raise ValueError("Unsupported expression: {}".format(type(node).__name__))
+    if isinstance(node, ast.Name) and node.id not in crawlers:
+      raise ValueError("Unknown crawler: {}".format(node.id))
+  return tree
+
+def evaluate(tree, bitmaps: dict, all_dates: int):
+  """
+  Evaluates a parsed expression over {crawler -> bitmap}, returning the
+  bitmap of dates for which it holds. all_dates is the bitmap of all dates.
+  >>> tree = parse_expression("a and not b", ["a", "b"])
+  >>> bin(evaluate(tree, {"a": 0b111, "b": 0b010}, 0b1111))
+  '0b101'
+  """
+  if isinstance(tree, ast.Expression):
+    return evaluate(tree.body, bitmaps, all_dates)
+  if isinstance(tree, ast.Name):
+    return bitmaps.get(tree.id, 0)
+  if isinstance(tree, ast.UnaryOp):
+    return all_dates & ~evaluate(tree.operand, bitmaps, all_dates)
+  values = [evaluate(v, bitmaps, all_dates) for v in tree.values]
+  result = values[0]
+  for v in values[1:]:
+    result = result & v if isinstance(tree.op, ast.And) else result | v
+  return result
+
+class NodeIndex:
+  def __init__(self, fname: str):
+    self.db = sqlite3.connect(fname)
+    self.db.executescript(SCHEMA)
+    self.dates = dict(self.db.execute("SELECT idx, date FROM dates"))
+    self.date_idx = {d: i for i, d in self.dates.items()}
+
+  def close(self):
+    self.db.close()
+
+  def crawlers(self):
+    return [c for (c,) in self.db.execute(
+      "SELECT DISTINCT crawler FROM postings ORDER BY crawler")]
+
+  def _date_index(self, date):
+    i = self.date_idx.get(date)
+    if i is None:
+      i = len(self.dates)
+      self.db.execute("INSERT INTO dates (idx, date) VALUES (?, ?)", (i, date))
+      self.dates[i] = date
+      self.date_idx[date] = i
+    return i
+
+  def add_aggregate(self, crawler, rows, kinds=("node",), inner_delimiter=";",
+                    decode=None):
+    """
+    Adds the (date, nodes) rows of an aggregate_scans.py output of crawler
+    to the index, for the given kinds of values. decode optionally maps
+    nodes read (e.g. node dictionary IDs) to formatted nodes.
+    """
+    postings = {kind: {} for kind in kinds}
+    for (date, nodes) in rows:
+      bit = 1 << self._date_index(date)
+      for node in nodes.strip(inner_delimiter).split(inner_delimiter):
+        if not node:
+          continue
+        if decode is not None:
+          node = decode(node)
+        values = {"node": node}
+        if "ip" in kinds or "24prefix" in kinds:
+          ip = node_ip(node)
+          values["ip"] = ip
+          if ip is not None and util.ip_family(ip) == 4:
+            values["24prefix"] = util.ip_prefix(ip, 24)
+        for kind in kinds:
+          value = values.get(kind)
+          if value is not None:
+            postings[kind][value] = postings[kind].get(value, 0) | bit
+    # Merge with any existing postings of the crawler
+    for kind, table in postings.items():
+      logging.info("Writing %s %s postings for %s", len(table), kind, crawler)
+      for value, bits in table.items():
+        row = self.db.execute("SELECT bitmap FROM postings WHERE kind = ? "
+          "AND value = ? AND crawler = ?", (kind, value, crawler)).fetchone()
+        if row is not None:
+          bits |= decode_bitmap(row[0])
+        self.db.execute("INSERT OR REPLACE INTO postings VALUES (?, ?, ?, ?)",
+                        (kind, value, crawler, encode_bitmap(bits)))
+    self.db.commit()
+
+  def lookup(self, kind, value):
+    """Returns {crawler -> bitmap} for one value."""
+    return {crawler: decode_bitmap(blob) for (crawler, blob) in self.db.execute(
+      "SELECT crawler, bitmap FROM postings WHERE kind = ? AND value = ?",
+      (kind, value))}
+
+  def prefix_scan(self, kind, prefix):
+    """Yields (value, {crawler -> bitmap}) for values starting with prefix."""
+    value, bitmaps = None, {}
+    for (v, crawler, blob) in self.db.execute(
+        "SELECT value, crawler, bitmap FROM postings WHERE kind = ? AND "
+        "value >= ? AND value < ? ORDER BY value",
+        (kind, prefix, prefix + MAX_CHAR)):
+      if v != value and bitmaps:
+        yield value, bitmaps
+        bitmaps = {}
+      value = v
+      bitmaps[crawler] = decode_bitmap(blob)
+    if bitmaps:
+      yield value, bitmaps
+
+  def all_dates(self):
+    """Returns the bitmap of all indexed dates."""
+    return (1 << len(self.dates)) - 1
+
+  def bitmap_dates(self, bits):
+    """Returns the sorted dates of a bitmap."""
+    return sorted(self.dates[i] for i in bit_indices(bits))
+
+def parse_crawler_file(spec: str):
+  """
+  Parses an input specification of the form crawler=aggregate_file.
+  >>> parse_crawler_file("btc=btc.tsv")
+  ('btc', 'btc.tsv')
+  """
+  crawler, fname = spec.split("=", 1)
+  if not crawler.isidentifier():
+    raise ValueError("Crawler names must be identifiers: {}".format(crawler))
+  return crawler, fname
+
+if __name__ == "__main__":
+  # Configure logging module
+  logging.basicConfig(format=util.LOG_FMT, level=util.LOG_LEVEL)
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--index", "-x", required=True,
+    help="Path to the index (SQLite) file.")
+  parser.add_argument("--add", "-a", nargs="+", type=parse_crawler_file,
+    default=[], help="Add aggregate_scans.py outputs to the index, each in "
+    "the format crawler=file. Crawler names must be valid identifiers.")
+  parser.add_argument("--index-ips", "-ip", action="store_true",
+    help="When adding, also index the IP address of each node.")
+  parser.add_argument("--index-prefixes", "-p24", action="store_true",
+    help="When adding, also index the /24 prefix of each IPv4 node.")
+  parser.add_argument("--node-dict", "-nd", default=None,
+    help="If specified, added inputs contain integer node IDs from this node "
+    "dictionary file, which are decoded before indexing. They must have been "
+    "encoded with this dictionary (see aggregate_scans.py --node-dict).")
+  parser.add_argument("--delimiter", "-d", default="\t",
+    help="Input and output field delimiter (tab by default)")
+  parser.add_argument("--inner-delimiter", "-id", default=";",
+    help="Delimiter to use for lists within a field (; by default)")
+
+  parser.add_argument("--kind", "-k", choices=KINDS, default="node",
+    help="Kind of value to query (node by default).")
+  parser.add_argument("--lookup", "-l", nargs="*", default=[],
+    help="Output the dates on which each crawler saw these values.")
+  parser.add_argument("--prefix", "-pre", default=None,
+    help="Output the dates on which each crawler saw each value starting "
+    "with this prefix.")
+  parser.add_argument("--query", "-q", default=None,
+    help="Instead of one row per crawler, output one row per value with the "
+    "dates for which this boolean expression of crawler names holds, e.g. "
+    "\"btc and not (ltc or dash)\".")
+
+  ARGS = parser.parse_args()
+
+  idx = NodeIndex(ARGS.index)
+
+  if ARGS.add:
+    kinds = ["node"]
+    if ARGS.index_ips:
+      kinds.append("ip")
+    if ARGS.index_prefixes:
+      kinds.append("24prefix")
+    node_dict = nodedict.NodeDict(ARGS.node_dict) if ARGS.node_dict else None
+    if node_dict is not None:
+      for (_, fname) in ARGS.add:
+        try:
+          node_dict.check_output(fname)
+        except ValueError as e:
+          parser.error(str(e))
+    for (crawler, fname) in ARGS.add:
+      logging.info("Indexing %s as %s", fname, crawler)
+      with open(fname, "r") as inf:
+        idx.add_aggregate(crawler, csv.reader(inf, delimiter=ARGS.delimiter),
+                          kinds=kinds, inner_delimiter=ARGS.inner_delimiter,
+                          decode=node_dict.decode if node_dict else None)
+
+  tree = None
+  if ARGS.query:
+    try:
+      tree = parse_expression(ARGS.query, idx.crawlers())
+    except (SyntaxError, ValueError) as e:
+      parser.error("Invalid --query: {}".format(e))
+
+  writer = csv.writer(sys.stdout, delimiter=ARGS.delimiter,
+      lineterminator="\n")
+
+  def write_value(value, bitmaps):
+    if tree is not None:
+      bits = evaluate(tree, bitmaps, idx.all_dates())
+      if bits:
+        writer.writerow((value, ARGS.query,
+                         ARGS.inner_delimiter.join(idx.bitmap_dates(bits)),))
+      return
+    for crawler in sorted(bitmaps.keys()):
+      writer.writerow((value, crawler, ARGS.inner_delimiter.join(
+        idx.bitmap_dates(bitmaps[crawler])),))
+
+  for value in ARGS.lookup:
+    write_value(value, idx.lookup(ARGS.kind, value))
+
+  if ARGS.prefix is not None:
+    for (value, bitmaps) in idx.prefix_scan(ARGS.kind, ARGS.prefix):
+      write_value(value, bitmaps)
+
+  idx.close()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import fcntl
+import hashlib
+import logging
+
+# A dictionary encoding of node identifiers (e.g. "nodeid:ip:port" strings) as
+# dense integer IDs, shared between tools. The dictionary is persisted as a
+# text file containing one node string per line, where the ID of a node is its
+# line number (starting at 0). New nodes are only ever appended, so IDs are
+# stable and the file can be extended by later runs.
+#
+# Only one process may extend a dictionary file at a time: save raises if the
+# file grew since it was loaded, so runs sharing a dictionary must not assign
+# new IDs concurrently. aggregate_scans.py records the fingerprint of the
+# dictionary it encoded an output with in <output>.state, which tools reading
+# encoded outputs check with check_output.
+
+class NodeDict:
+  """
+  >>> nd = NodeDict()
+  >>> nd.encode_many(["a", "b", "a"])
+  [0, 1, 0]
+  >>> nd.decode(1), len(nd)
+  ('b', 2)
+  >>> nd.decode_many(["1", "0"])
+  ['b', 'a']
+  >>> fp = nd.fingerprint()
+  >>> nd.encode("c")
+  2
+  >>> nd.matches(fp), NodeDict().matches(fp)
+  (True, False)
+  """
+  def __init__(self, fname: str = None):
+    self.fname = fname
+    self.strings = []
+    self.ids = {}
+    if fname is not None and os.path.isfile(fname):
+      logging.info("Loading node dictionary %s", fname)
+      with open(fname, "r") as f:
+        for line in f:
+          self._add(line.rstrip("\n"))
+        self._saved_size = os.fstat(f.fileno()).st_size
+    else:
+      self._saved_size = 0
+    # Number of entries already persisted to fname, and the size of fname
+    # after persisting them
+    self._saved = len(self.strings)
+
+  def __len__(self):
+    return len(self.strings)
+
+  def __contains__(self, node):
+    return node in self.ids
+
+  def _add(self, node):
+    i = len(self.strings)
+    self.strings.append(node)
+    self.ids[node] = i
+    return i
+
+  def encode(self, node: str):
+    """Returns the ID for node, assigning a new ID if it hasn't been seen."""
+    i = self.ids.get(node)
+    if i is None:
+      if "\n" in node:
+        raise ValueError("Node strings must not contain newlines")
+      i = self._add(node)
+    return i
+
+  def encode_many(self, nodes):
+    return [self.encode(n) for n in nodes]
+
+  def decode(self, i):
+    """Returns the node string for ID i (an int or a decimal string)."""
+    return self.strings[int(i)]
+
+  def decode_many(self, ids):
+    return [self.strings[int(i)] for i in ids]
+
+  def fingerprint(self, n=None):
+    """
+    Returns a fingerprint ("<n>:<sha256>") of the first n entries (by default
+    all of them).
+    """
+    n = len(self.strings) if n is None else n
+    digest = hashlib.sha256()
+    for node in self.strings[:n]:
+      digest.update(node.encode() + b"\n")
+    return "{}:{}".format(n, digest.hexdigest())
+
+  def matches(self, fingerprint):
+    """
+    True if fingerprint is of this dictionary or of an earlier state of it,
+    so that IDs encoded with it decode the same with this dictionary.
+    """
+    n = int(fingerprint.split(":", 1)[0])
+    return n <= len(self.strings) and self.fingerprint(n) == fingerprint
+
+  def check_output(self, fname):
+    """
+    Raises ValueError unless the aggregate_scans.py output fname was encoded
+    with this dictionary, according to the fingerprint in its state file.
+    """
+    state = None
+    if os.path.isfile(fname + ".state"):
+      with open(fname + ".state", "r") as f:
+        state = json.load(f)
+    fingerprint = state.get("node_dict_fingerprint") if state else None
+    if fingerprint is None:
+      raise ValueError("{} has no recorded node dictionary".format(fname))
+    if not self.matches(fingerprint):
+      raise ValueError("{} was encoded with a different node dictionary "
+                       "than {}".format(fname, self.fname))
+
+  def save(self):
+    """
+    Appends any newly assigned nodes to the dictionary file. Raises an
+    exception if the file was extended by someone else since it was loaded,
+    since our new IDs would then clash with theirs.
+    """
+    if self.fname is None:
+      raise ValueError("NodeDict has no file name to save to")
+    if self._saved == len(self.strings):
+      return
+    with open(self.fname, "a") as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      # Our entries end where we last saved, so we only need the file size,
+      # rather than counting its lines, to tell if anyone else extended it
+      size = os.fstat(f.fileno()).st_size
+      if size != self._saved_size:
+        raise Exception("Node dictionary {} was modified concurrently "
+                        "({} bytes, expected {})".format(
+                          self.fname, size, self._saved_size))
+      for node in self.strings[self._saved:]:
+        f.write(node + "\n")
+      f.flush()
+      os.fsync(f.fileno())
+      self._saved = len(self.strings)
+      self._saved_size = f.tell()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import csv
+import logging
+import argparse
+import functools
+
+from os import path
+
+import util
+import compare
+import instrument
+import load_scan
+import select_scans
+import aggregate_scans
+
+# Runs select_scans.py -> aggregate_scans.py -> compare.py in one process
+# tree for one or more crawlers, passing node lists between the stages in
+# memory instead of through TSV files, and using one worker pool (and so one
+# set of per-worker ASN databases) for all crawlers.
+# Output format: same as compare.py, with crawler names in place of input
+# file names, e.g.
+#     key	yethi	btc	yethi;btc
+#     2019-05-14	2	3	1
+# Selections and aggregates can also be written out, in the same formats as
+# select_scans.py and aggregate_scans.py produce.
+
+def parse_crawler(spec: str):
+    """
+    Parses a crawler specification of the form name=format:scan_dir.
+    >>> parse_crawler("yethi=Yethi:/srv/yethi/results")
+    ('yethi', 'Yethi', '/srv/yethi/results')
+    """
+    name, rest = spec.split("=", 1)
+    fmt, scan_dir = rest.split(":", 1)
+    if fmt not in load_scan.FORMAT_LOADERS:
+        raise ValueError("Unknown format {} for crawler {}".format(fmt, name))
+    return name, fmt, scan_dir
+
+def select(fmt, scan_dir, not_before=None, not_after=None, downsample_targets=None):
+    """
+    Selects scans as select_scans.py does. Returns {date -> list of scanfiles}.
+    """
+    with instrument.stage("select"):
+        loader = select_scans.FORMAT_LOADERS[fmt](scan_dir)
+        instrument.count(scans=len(loader.scanfiles))
+        loader.filter(not_before, not_after)
+        if downsample_targets:
+            loader.downsample(targets=downsample_targets)
+        loader.sort()
+        return loader.scanfiles_by_date()
+
+def aggregate_and_count(task: tuple, compare_by="ip", unique=False,
+                        keep_nodelist=False, **kwargs):
+    """
+    Worker function: builds the node list for one (name, format, date,
+    scanfiles) task, and counts its values transformed as compare.py would.
+    Returns (name, date, nodelist or None, counter).
+    """
+    name, fmt, date, scanfiles = task
+    loader_cls = load_scan.FORMAT_LOADERS[fmt]
+    nodelist = aggregate_scans.build_nodelist(loader_cls, scanfiles, **kwargs)
+    with instrument.stage("count"):
+        counter = compare.count_values(nodelist, compare.IP_TRANSFORMS[compare_by],
+                                       unique)
+    return name, date, (nodelist if keep_nodelist else None), counter
+
+if __name__ == "__main__":
+    # Configure logging module
+    logging.basicConfig(format=util.LOG_FMT, level=util.LOG_LEVEL)
+
+    parser = argparse.ArgumentParser()
+
+    # Selection options (see select_scans.py)
+    parser.add_argument("--not-before", "-nb", default=None,
+      help="Don't include scan files before the given UTC ISO date/time string")
+    parser.add_argument("--not-after", "-na", default=None,
+      help="Don't include scan files after the given UTC ISO date/time string")
+    parser.add_argument("--downsample", "-ds", default="12:00:00",
+      help="Comma-separated list of 24-hour times in HH:MM:SS format. "
+           "Downsample scans by selecting closest scans to each of these times each day. "
+           "default=12:00:00. Set to False to disable.")
+
+    # Aggregation options (see aggregate_scans.py)
+    parser.add_argument("--keep-ipv6", "-k6", action="store_true",
+      help="If specified, node IPv6 addresses will be kept.")
+    parser.add_argument("--only-ipv6", "-v6", action="store_true",
+      help="If specified, only IPv6 addresses will be included.")
+    parser.add_argument("--omit-ip", "-oip", action="store_true",
+      help="If specified, nodes will exclude IP addresses.")
+    parser.add_argument("--omit-port", "-oport", action="store_true",
+      help="If specified, nodes will exclude port numbers.")
+    parser.add_argument("--omit-nodeid", "-onodeid", action="store_true",
+      help="If specified, nodes will exclude node IDs.")
+    parser.add_argument("--dedupe-output-nodes", "-dd", action="store_true",
+      help="If specified, nodes will appear uniquely in each aggregation.")
+
+    # Comparison options (see compare.py)
+    parser.add_argument("--compare", "-c", choices=sorted(compare.IP_TRANSFORMS.keys()),
+      default="ip", help="What to compare. Transforms other than ip expect "
+      "nodes to be IP addresses only (--omit-nodeid --omit-port).")
+    parser.add_argument("--unique", "-u", action="store_true",
+      help="If specified, remove duplicate values before comparing.")
+    parser.add_argument("--ignore-missing-keys", "-imk", action="store_true",
+      help="If set, dates missing for some crawlers will be ignored instead "
+           "of causing an exception.")
+
+    # Intermediate outputs
+    parser.add_argument("--write-selections", "-ws", default=None,
+      help="If specified, write select_scans.py output for each crawler to "
+           "<name>.select.tsv in this directory.")
+    parser.add_argument("--write-aggregates", "-wa", default=None,
+      help="If specified, write aggregate_scans.py output for each crawler to "
+           "<name>.tsv in this directory.")
+
+    parser.add_argument("--delimiter", "-d", default="\t",
+      help="Output field delimiter (tab by default)")
+    parser.add_argument("--inner-delimiter", "-id", default=";",
+      help="Delimiter to use for lists within a field (; by default)")
+    parser.add_argument("--concurrency", "-j", type=int, default=util.DEFAULT_CONCURRENCY,
+      help="Number of MP workers to use for reading scanfiles concurrently."
+      " (default={})".format(util.DEFAULT_CONCURRENCY))
+    parser.add_argument("--executor", "-x", choices=util.EXECUTORS, default="process",
+      help="Run workers as processes or threads (default=process)")
+    instrument.add_argument(parser)
+
+    # Required args
+    parser.add_argument("crawlers", nargs="+", type=parse_crawler,
+      help="Crawlers to compare, each in the format name=format:scan_dir, "
+           "e.g. yethi=Yethi:/srv/yethi/results")
+
+    logging.debug("===STARTUP===")
+
+    ARGS = parser.parse_args()
+    logging.debug("Parsed args: %s", str(ARGS))
+    instrument.setup(ARGS.instrument, "pipeline")
+
+    names = [name for (name, _, _) in ARGS.crawlers]
+    if len(set(names)) != len(names):
+        parser.error("Crawler names must be unique")
+
+    not_before_dt = util.str2dt(ARGS.not_before) if ARGS.not_before is not None else None
+    not_after_dt = util.str2dt(ARGS.not_after) if ARGS.not_after is not None else None
+    downsample_targets = None
+    if not ARGS.downsample.strip().upper().startswith("F"):
+        TIME_RE = re.compile('[0-9]{2}:[0-9]{2}:[0-9]{2}(,[0-9]{2}:[0-9]{2}:[0-9]{2})*')
+        if TIME_RE.fullmatch(ARGS.downsample.strip()):
+            downsample_targets = ARGS.downsample.strip().split(',')
+
+    # Select scans for every crawler, and build one list of tasks
+    tasks = []
+    for (name, fmt, scan_dir) in ARGS.crawlers:
+        sf_by_date = select(fmt, scan_dir, not_before_dt, not_after_dt,
+                            downsample_targets)
+        if ARGS.write_selections:
+            os.makedirs(ARGS.write_selections, exist_ok=True)
+            fname = path.join(ARGS.write_selections, name + ".select.tsv")
+            with open(fname, "w") as outf:
+                writer = csv.writer(outf, delimiter=ARGS.delimiter,
+                    lineterminator="\n")
+                for date in sorted(sf_by_date.keys()):
+                    writer.writerow((date, ARGS.inner_delimiter.join(sf_by_date[date]),))
+        for date in sorted(sf_by_date.keys()):
+            tasks.append((name, fmt, date, sorted(set(sf_by_date[date]))))
+
+    # Aggregate scans and count transformed values in the same workers
+    work = functools.partial(aggregate_and_count,
+                             compare_by=ARGS.compare,
+                             unique=ARGS.unique,
+                             keep_nodelist=ARGS.write_aggregates is not None,
+                             keep_ipv6=ARGS.keep_ipv6,
+                             only_ipv6=ARGS.only_ipv6,
+                             omit_nodeid=ARGS.omit_nodeid,
+                             omit_ip=ARGS.omit_ip,
+                             omit_port=ARGS.omit_port,
+                             dedupe_output_nodes=ARGS.dedupe_output_nodes)
+
+    # A mapping of {crawler name -> {date -> counter of identifiers}}
+    groups = {name: {} for name in names}
+    agg_writers = {}
+    agg_files = []
+    if ARGS.write_aggregates:
+        os.makedirs(ARGS.write_aggregates, exist_ok=True)
+        for name in names:
+            outf = open(path.join(ARGS.write_aggregates, name + ".tsv"), "w")
+            agg_files.append(outf)
+            agg_writers[name] = csv.writer(outf, delimiter=ARGS.delimiter,
+                lineterminator="\n")
+
+    with instrument.stage("aggregate"), util.make_pool(ARGS.concurrency, ARGS.executor) as p:
+        # Tasks are ordered by crawler and date, so aggregates are written in
+        # date order
+        for (name, date, nodelist, counter) in p.imap(work, tasks):
+            groups[name][date] = counter
+            if nodelist is not None:
+                agg_writers[name].writerow((date, ARGS.inner_delimiter.join(nodelist),))
+    for outf in agg_files:
+        outf.close()
+
+    # Only compare keys that all crawlers have
+    keys_seen = set().union(*(table.keys() for table in groups.values()))
+    keys = set(keys_seen)
+    for name, table in groups.items():
+        for k in sorted(keys_seen - table.keys()):
+            if ARGS.ignore_missing_keys:
+                logging.warning("Ignoring key %s missing in %s", k, name)
+            else:
+                logging.fatal("%s missing key %s", name, k)
+        keys &= table.keys()
+    if keys != keys_seen and not ARGS.ignore_missing_keys:
+        raise Exception("Key mismatch between crawlers")
+
+    # Write intersection cardinalities
+    combos = util.all_combinations(names)
+    outfields = ["key"]+[ARGS.inner_delimiter.join(combo) for combo in combos]
+    writer = csv.DictWriter(sys.stdout, fieldnames=outfields,
+        delimiter=ARGS.delimiter, lineterminator="\n")
+    writer.writeheader()
+    with instrument.stage("intersect"):
+        for key in sorted(keys):
+            writer.writerow(compare.cardinality_row(groups, key, combos,
+                                                    ARGS.inner_delimiter))
+
+    logging.debug("===FINISH===")
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import os
+import queue
+import logging
+import threading
+
+from os import path
+
+import instrument
+
+# Reads the files of scans ahead of the workers which load them. On spinning
+# disks, many workers each opening their own scan files makes the disk seek
+# back and forth between them; instead, one background thread reads the raw
+# (still compressed) files sequentially, in the order they will be needed and
+# in on-disk order within each task, and the contents are handed to the
+# workers, which only decompress and parse them (see LoadScan's buffers).
+#
+# Prefetched data is held in memory until the caller releases it, up to a
+# limit of max_bytes.
+
+DEFAULT_MAX_MB = 256
+
+_DONE = object()
+
+def add_argument(parser):
+    """Adds the --prefetch option to an argparse parser."""
+    parser.add_argument("--prefetch", "-pf", type=int, default=None,
+      metavar="MB", help="If specified, read scan files ahead sequentially "
+           "in one thread, holding at most this many MB in memory, and hand "
+           "them to the workers. Avoids disk seeks between workers on "
+           "spinning disks. {} is a reasonable value.".format(DEFAULT_MAX_MB))
+
+def disk_order(fnames):
+    """
+    Sorts file names by device and inode number, which approximates their
+    order on disk, falling back to path order for files we can't stat.
+    """
+    def key(fname):
+        try:
+            st = os.stat(fname)
+            return (0, st.st_dev, st.st_ino, fname)
+        except OSError:
+            return (1, 0, 0, fname)
+    return sorted(fnames, key=key)
+
+class Prefetcher:
+    """
+    Iterating over a Prefetcher yields (item, buffers) for each of items, in
+    order, where buffers is {key -> {file name -> raw file contents}} for the
+    {key -> list of file paths} returned by files(item). Files which can't be
+    read are left out of buffers, so that loaders read (and fail on) them as
+    usual.
+
+    The caller must call release() once it is done with each item, e.g. when
+    a worker has returned its result, to free up space for more prefetching.
+    Items are released in the order they were yielded.
+    """
+    def __init__(self, items, files, max_bytes=DEFAULT_MAX_MB * 1024**2):
+        self.items = items
+        self.files = files
+        self.max_bytes = max_bytes
+        self._queue = queue.Queue()
+        self._cond = threading.Condition()
+        # Sizes of items yielded but not released yet, oldest first
+        self._held = []
+        self._held_bytes = 0
+
+    def __iter__(self):
+        thread = threading.Thread(target=self._read_ahead, name="prefetch",
+                                  daemon=True)
+        thread.start()
+        while True:
+            entry = self._queue.get()
+            if entry is _DONE:
+                break
+            yield entry
+        thread.join()
+
+    def release(self):
+        """Frees the memory accounted to the oldest unreleased item."""
+        with self._cond:
+            self._held_bytes -= self._held.pop(0)
+            self._cond.notify()
+
+    def _read_ahead(self):
+        try:
+            for item in self.items:
+                fnames = self.files(item)
+                sizes = {}
+                for fname in (f for fnames_ in fnames.values() for f in fnames_):
+                    try:
+                        sizes[fname] = path.getsize(fname)
+                    except OSError:
+                        pass
+                nbytes = sum(sizes.values())
+                # Wait for space, but always allow one item through, even if
+                # it is larger than max_bytes on its own
+                with self._cond:
+                    self._cond.wait_for(lambda: not self._held or
+                        self._held_bytes + nbytes <= self.max_bytes)
+                    self._held.append(nbytes)
+                    self._held_bytes += nbytes
+                self._queue.put((item, self._read(fnames, sizes)))
+        finally:
+            self._queue.put(_DONE)
+
+    def _read(self, fnames, sizes):
+        contents = {}
+        with instrument.stage("prefetch"):
+            for fname in disk_order(sizes.keys()):
+                try:
+                    with open(fname, "rb") as f:
+                        contents[fname] = f.read()
+                    instrument.count(bytes_read=len(contents[fname]))
+                except OSError:
+                    logging.warning("Couldn't prefetch %s", fname)
+        return {key: {path.basename(f): contents[f] for f in fnames_
+                      if f in contents}
+                for key, fnames_ in fnames.items()}
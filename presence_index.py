@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import sys
+import csv
+import bisect
+import logging
+import argparse
+
+import util
+import nodedict
+
+csv.field_size_limit(sys.maxsize)
+
+# This script builds (and queries) an index storing, for every node across all
+# aggregated dates, the run-length encoded intervals of scan indices on which
+# the node was present.
+# Input format: TSV output of aggregate_scans.py, e.g.
+#     2019-05-14	8.8.8.8;8.8.4.4
+# The index is persisted as a pickle file.
+
+class PresenceIndex:
+  """
+  Maps each node to a sorted list of (first, last) intervals of scan indices
+  (positions in the sorted list of dates) on which the node was present.
+  >>> idx = PresenceIndex()
+  >>> idx.add_date("2019-01-01", ["a", "b"])
+  >>> idx.add_date("2019-01-02", ["a"])
+  >>> idx.add_date("2019-01-03", ["a", "b"])
+  >>> idx.intervals["b"]
+  [(0, 0), (2, 2)]
+  >>> idx.first_seen("b"), idx.last_seen("b")
+  ('2019-01-01', '2019-01-03')
+  >>> idx.uptime("a"), idx.longest_streak("a"), idx.longest_streak("b")
+  (3, 3, 1)
+  >>> idx.nodes_present(2, "2019-01-01", "2019-01-03")
+  ['a', 'b']
+  >>> idx.nodes_present(2, "2019-01-02", "2019-01-03")
+  ['a']
+  """
+  def __init__(self):
+    self.dates = []
+    self.intervals = {}
+
+  @classmethod
+  def from_date_nodes(cls, date_nodes: dict):
+    """
+    Builds an index from a dict {date -> iterable of nodes}.
+    """
+    idx = cls()
+    for date in sorted(date_nodes.keys()):
+      idx.add_date(date, date_nodes[date])
+    return idx
+
+  @classmethod
+  def load(cls, fname):
+    data = util.read_pickle(fname)
+    idx = cls()
+    idx.dates = data["dates"]
+    idx.intervals = data["intervals"]
+    return idx
+
+  def save(self, fname):
+    # Store plain data rather than the instance, so the index can be loaded
+    # regardless of which script wrote it
+    util.write_pickle({"dates": self.dates, "intervals": self.intervals}, fname)
+
+  def add_date(self, date, nodes):
+    """
+    Appends the nodes present on date to the index. Dates must be added in
+    ascending order.
+    """
+    if self.dates and date <= self.dates[-1]:
+      raise ValueError("Dates must be added in ascending order: "
+                       "{} after {}".format(date, self.dates[-1]))
+    i = len(self.dates)
+    self.dates.append(date)
+    for node in set(nodes):
+      runs = self.intervals.get(node)
+      if runs is None:
+        self.intervals[node] = [(i, i)]
+      elif runs[-1][1] == i - 1:
+        runs[-1] = (runs[-1][0], i)
+      else:
+        runs.append((i, i))
+
+  def first_seen(self, node):
+    """Returns the first date on which node was present."""
+    return self.dates[self.intervals[node][0][0]]
+
+  def last_seen(self, node):
+    """Returns the last date on which node was present."""
+    return self.dates[self.intervals[node][-1][1]]
+
+  def uptime(self, node):
+    """Returns the number of dates on which node was present."""
+    return sum(end - start + 1 for (start, end) in self.intervals[node])
+
+  def longest_streak(self, node):
+    """Returns the longest number of consecutive dates node was present."""
+    return max(end - start + 1 for (start, end) in self.intervals[node])
+
+  def _date_range(self, start_date, end_date):
+    """Returns the scan index range [i, j] for dates in [start_date, end_date]"""
+    i = bisect.bisect_left(self.dates, start_date)
+    j = bisect.bisect_right(self.dates, end_date) - 1
+    return i, j
+
+  def _presence_in_range(self, runs, i, j):
+    # Skip intervals ending before the range
+    first = bisect.bisect_left(runs, (i,))
+    if first > 0 and runs[first-1][1] >= i:
+      first -= 1
+    count = 0
+    for (start, end) in runs[first:]:
+      if start > j:
+        break
+      count += min(end, j) - max(start, i) + 1
+    return count
+
+  def nodes_present(self, k, start_date, end_date):
+    """
+    Returns a sorted list of nodes present on at least k of the dates in
+    [start_date, end_date].
+    """
+    i, j = self._date_range(start_date, end_date)
+    if j < i:
+      return []
+    return sorted(node for node, runs in self.intervals.items()
+                  if self._presence_in_range(runs, i, j) >= k)
+
+if __name__ == "__main__":
+  # Configure logging module
+  logging.basicConfig(format=util.LOG_FMT, level=util.LOG_LEVEL)
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--index", "-x", required=True,
+    help="Path to the index (pickle) file.")
+  parser.add_argument("--build", "-b", nargs="+", type=argparse.FileType("r"),
+    default=None, help="Build the index from these aggregate_scans.py outputs "
+    "(overwriting any existing index).")
+  parser.add_argument("--delimiter", "-d", default="\t",
+    help="Input and output field delimiter (tab by default)")
+  parser.add_argument("--inner-delimiter", "-id", default=";",
+    help="Delimiter to use for lists within a field (; by default)")
+  parser.add_argument("--node-dict", "-nd", default=None,
+    help="If specified, inputs contain integer node IDs from this node "
+    "dictionary file; nodes are decoded only for output. --build inputs "
+    "must have been encoded with this dictionary (see aggregate_scans.py "
+    "--node-dict).")
+  parser.add_argument("--node", "-n", nargs="*", default=[],
+    help="Output first seen, last seen, uptime and longest streak for nodes.")
+  parser.add_argument("--present-on", "-k", type=int, default=None,
+    help="Output nodes present on at least this many dates in "
+    "[--not-before, --not-after].")
+  parser.add_argument("--not-before", "-nb", default="",
+    help="Start date (inclusive) for --present-on.")
+  parser.add_argument("--not-after", "-na", default="9999-12-31",
+    help="End date (inclusive) for --present-on.")
+
+  ARGS = parser.parse_args()
+
+  node_dict = nodedict.NodeDict(ARGS.node_dict) if ARGS.node_dict else None
+  # Nodes are stored as integer IDs if we're using a node dictionary
+  parse_node = int if node_dict is not None else str
+  format_node = node_dict.decode if node_dict is not None else str
+
+  if ARGS.build:
+    if node_dict is not None:
+      for infile in ARGS.build:
+        try:
+          node_dict.check_output(infile.name)
+        except ValueError as e:
+          parser.error(str(e))
+    date_nodes = {}
+    for infile in ARGS.build:
+      logging.info("Reading input file %s", infile.name)
+      with infile as inf:
+        for (date, nodes) in csv.reader(inf, delimiter=ARGS.delimiter):
+          nodes = nodes.strip(ARGS.inner_delimiter).split(ARGS.inner_delimiter)
+          date_nodes.setdefault(date, set()).update(parse_node(n)
+                                                    for n in nodes if n)
+    idx = PresenceIndex.from_date_nodes(date_nodes)
+    idx.save(ARGS.index)
+  else:
+    idx = PresenceIndex.load(ARGS.index)
+
+  writer = csv.writer(sys.stdout, delimiter=ARGS.delimiter,
+      lineterminator="\n")
+
+  for nodestr in ARGS.node:
+    if node_dict is not None and nodestr not in node_dict:
+      logging.warning("Node %s not in node dictionary", nodestr)
+      continue
+    node = node_dict.encode(nodestr) if node_dict is not None else nodestr
+    if node not in idx.intervals:
+      logging.warning("Node %s not in index", nodestr)
+      continue
+    writer.writerow((nodestr, idx.first_seen(node), idx.last_seen(node),
+                     idx.uptime(node), idx.longest_streak(node),))
+
+  if ARGS.present_on is not None:
+    for node in idx.nodes_present(ARGS.present_on, ARGS.not_before,
+                                  ARGS.not_after):
+      writer.writerow((format_node(node),))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import logging
+import argparse
+import threading
+import collections
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import util
+import rowindex
+import corenodes
+import load_scan
+import aggregate_scans
+
+from compare import IP_TRANSFORMS, GEO_TRANSFORMS, count_values, cardinality_row
+
+# A long-running query service, which keeps loaded scans, parsed aggregate
+# rows, core node tables and reference databases (ASN, geolocation) resident
+# between queries, so that many small queries (e.g. from notebooks) don't pay
+# for startup and reloading each time. Listens on localhost only.
+#
+# Queries are HTTP POST requests to /<endpoint> with a JSON object of
+# parameters, and return a JSON result (or {"error": message} with status
+# 400). Endpoints:
+#   load       {"format", "scan", "keep_ipv6", "uncontactable"}
+#   aggregate  {"format", "scans", "keep_ipv6", "only_ipv6", "mode",
+#               "omit_nodeid", "omit_ip", "omit_port", "dedupe_output_nodes"}
+#   compare    {"files": [[name, path], ...], "keys", "compare", "unique",
+#               "ignore_missing_keys"}
+#   core       {"file", "start", "end", "percentile", "invert"}
+#   enrich     {"ips", "transform"}
+#   stats      {}
+# load_scan.py and compare.py act as clients with --server URL, and
+# util.server_query() can be used from other code.
+
+DEFAULT_PORT = 8642
+DEFAULT_CACHE_SIZE = 256
+
+class LRUCache:
+  """
+  Thread-safe cache of up to maxsize entries, evicting the least recently
+  used entry first.
+  >>> c = LRUCache(2)
+  >>> c.get("a", lambda: 1), c.get("b", lambda: 2), c.get("a", lambda: 3)
+  (1, 2, 1)
+  >>> c.get("c", lambda: 4), c.get("b", lambda: 5)
+  (4, 5)
+  >>> c.hits, c.misses
+  (1, 4)
+  """
+  def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+    self.maxsize = maxsize
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key, compute):
+    """Returns the cached value for key, computing it if it isn't cached."""
+    with self.lock:
+      if key in self.entries:
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+      self.misses += 1
+    # Compute without holding the lock, so other queries aren't blocked;
+    # concurrent misses for the same key may compute it twice
+    value = compute()
+    with self.lock:
+      self.entries[key] = value
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+    return value
+
+def file_stamp(fname):
+  st = os.stat(fname)
+  return st.st_size, st.st_mtime_ns
+
+class QueryService:
+  def __init__(self, cache_size=DEFAULT_CACHE_SIZE, delimiter="\t",
+               inner_delimiter=";"):
+    self.cache = LRUCache(cache_size)
+    self.delimiter = delimiter
+    self.inner_delimiter = inner_delimiter
+
+  def _loader_cls(self, fmt):
+    if fmt not in load_scan.FORMAT_LOADERS:
+      raise ValueError("Unknown format {}".format(fmt))
+    return load_scan.FORMAT_LOADERS[fmt]
+
+  def _load_nodes(self, fmt, scan, keep_ipv6=False, only_ipv6=False,
+                  uncontactable=False):
+    loader_cls = self._loader_cls(fmt)
+    return self.cache.get(("load", fmt, scan, keep_ipv6, only_ipv6, uncontactable),
+      lambda: aggregate_scans.load_nodes(loader_cls, scan, keep_ipv6=keep_ipv6,
+                                         only_ipv6=only_ipv6,
+                                         uncontactable=uncontactable))
+
+  def load(self, format, scan, keep_ipv6=False, uncontactable=False):
+    nodes, uncontactable_nodes = self._load_nodes(format, scan,
+      keep_ipv6=keep_ipv6, uncontactable=uncontactable)
+    return uncontactable_nodes if uncontactable else nodes
+
+  def aggregate(self, format, scans, keep_ipv6=False, only_ipv6=False,
+                mode="confirmed", **format_kwargs):
+    if mode not in aggregate_scans.MODES:
+      raise ValueError("Unknown mode {}".format(mode))
+    loader_cls = self._loader_cls(format)
+    nodeset, uncontactable_nodeset = set(), set()
+    for sf in sorted(set(scans)):
+      nodes, uncontactable_nodes = self._load_nodes(format, sf,
+        keep_ipv6=keep_ipv6, only_ipv6=only_ipv6,
+        uncontactable=(mode != "confirmed"))
+      if mode != "uncontactable":
+        nodeset.update(nodes)
+      if mode != "confirmed":
+        uncontactable_nodeset.update(uncontactable_nodes)
+    if mode == "confirmed":
+      return aggregate_scans.format_nodes(loader_cls, nodeset, **format_kwargs)
+    if mode == "uncontactable":
+      return aggregate_scans.format_nodes(loader_cls, uncontactable_nodeset,
+                                          **format_kwargs)
+    return (aggregate_scans.format_nodes(loader_cls, nodeset, **format_kwargs),
+            aggregate_scans.format_nodes(loader_cls, uncontactable_nodeset,
+                                         **format_kwargs))
+
+  def _row_counter(self, fname, stamp, index, key, transform, unique):
+    def count():
+      (row,) = rowindex.read_rows(fname, [key], index, self.delimiter)
+      valuelist = row[1].strip().strip(self.inner_delimiter).split(
+        self.inner_delimiter)
+      if transform in GEO_TRANSFORMS:
+        util.geoip_many(valuelist)
+      return count_values(valuelist, IP_TRANSFORMS[transform], unique)
+    return self.cache.get(("row", fname, stamp, key, transform, unique), count)
+
+  def compare(self, files, keys=None, compare="ip", unique=False,
+              ignore_missing_keys=False):
+    if compare not in IP_TRANSFORMS:
+      raise ValueError("Unknown transform {}".format(compare))
+    if compare in GEO_TRANSFORMS:
+      util.check_geoip_db()
+    groups = {}
+    for (name, fname) in files:
+      stamp = file_stamp(fname)
+      index = self.cache.get(("index", fname, stamp),
+        lambda: rowindex.load_index(fname, self.delimiter))
+      wanted = index.keys() if keys is None else [k for k in keys if k in index]
+      groups[name] = {k: self._row_counter(fname, stamp, index, k, compare, unique)
+                      for k in wanted}
+    keys_seen = set().union(*(table.keys() for table in groups.values()))
+    common = set(keys_seen)
+    for table in groups.values():
+      common &= table.keys()
+    if common != keys_seen and not ignore_missing_keys:
+      raise ValueError("Key mismatch in input files: {}".format(
+        ", ".join(sorted(keys_seen - common))))
+    combos = util.all_combinations([name for (name, _) in files])
+    fields = ["key"] + [self.inner_delimiter.join(c) for c in combos]
+    return {"fields": fields,
+            "rows": [cardinality_row(groups, k, combos, self.inner_delimiter)
+                     for k in sorted(common)]}
+
+  def _core_nodes(self, fname):
+    stamp = file_stamp(fname)
+    def build():
+      date_nodes = {}
+      with open(fname, "r") as f:
+        for line in f:
+          date, nodes = line.rstrip("\n").split(self.delimiter)[:2]
+          date_nodes[date] = nodes.strip(self.inner_delimiter).split(
+            self.inner_delimiter)
+      return corenodes.CoreNodes(date_nodes)
+    return self.cache.get(("core", fname, stamp), build)
+
+  def core(self, file, start, end, percentile=0.9, invert=False):
+    total, nodes = self._core_nodes(file).core(start, end, percentile=percentile,
+                                               invert=invert)
+    return {"total": total, "nodes": nodes}
+
+  def enrich(self, ips, transform="asn"):
+    if transform not in IP_TRANSFORMS:
+      raise ValueError("Unknown transform {}".format(transform))
+    # Reference databases (e.g. util.asn_db) stay loaded in this process
+    if transform in GEO_TRANSFORMS:
+      util.check_geoip_db()
+      util.geoip_many(ips)
+    return [IP_TRANSFORMS[transform](ip) for ip in ips]
+
+  def stats(self):
+    return {"entries": len(self.cache.entries), "maxsize": self.cache.maxsize,
+            "hits": self.cache.hits, "misses": self.cache.misses}
+
+ENDPOINTS = ("load", "aggregate", "compare", "core", "enrich", "stats")
+
+class QueryHandler(BaseHTTPRequestHandler):
+  service = None
+
+  def _respond(self, status, result):
+    body = json.dumps(result).encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_POST(self):
+    endpoint = self.path.strip("/")
+    if endpoint not in ENDPOINTS:
+      self._respond(404, {"error": "Unknown endpoint {}".format(endpoint)})
+      return
+    try:
+      length = int(self.headers.get("Content-Length", 0))
+      params = json.loads(self.rfile.read(length) or b"{}")
+      result = getattr(self.service, endpoint)(**params)
+    except Exception as e:
+      logging.exception("Query %s failed", endpoint)
+      self._respond(400, {"error": "{}: {}".format(type(e).__name__, e)})
+      return
+    self._respond(200, result)
+
+  def log_message(self, format, *args):
+    logging.info("%s - %s", self.address_string(), format % args)
+
+if __name__ == "__main__":
+  # Configure logging module
+  logging.basicConfig(format=util.LOG_FMT, level=util.LOG_LEVEL)
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--port", "-p", type=int, default=DEFAULT_PORT,
+    help="Port to listen on, on localhost (default={})".format(DEFAULT_PORT))
+  parser.add_argument("--cache-size", "-cs", type=int, default=DEFAULT_CACHE_SIZE,
+    help="Maximum number of loaded scans, aggregate rows and tables to keep "
+    "in memory (default={})".format(DEFAULT_CACHE_SIZE))
+  parser.add_argument("--delimiter", "-d", default="\t",
+    help="Field delimiter of aggregate files (tab by default)")
+  parser.add_argument("--inner-delimiter", "-id", default=";",
+    help="Delimiter for lists within a field (; by default)")
+  parser.add_argument("--geoip-db", "-gdb", default=util.GEOIP_DB,
+    help="IP2Location SQLite database for the geo transforms "
+    "(default={})".format(util.GEOIP_DB))
+  parser.add_argument("--geoip-cache", "-gc", default=None,
+    help="If specified, also cache looked up locations in this SQLite file, "
+    "which is reused by later runs.")
+
+  ARGS = parser.parse_args()
+  util.GEOIP_DB = ARGS.geoip_db
+  util.GEOIP_CACHE = ARGS.geoip_cache
+  if not os.path.isfile(util.GEOIP_DB):
+    logging.warning("No IP2Location database %s, geo queries will fail",
+                    util.GEOIP_DB)
+
+  QueryHandler.service = QueryService(ARGS.cache_size, ARGS.delimiter,
+                                      ARGS.inner_delimiter)
+  server = ThreadingHTTPServer(("127.0.0.1", ARGS.port), QueryHandler)
+  logging.warning("Listening on http://127.0.0.1:%s", ARGS.port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
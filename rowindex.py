@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import os
+import csv
+import sys
+import logging
+import argparse
+
+import util
+
+csv.field_size_limit(sys.maxsize)
+
+# Sidecar index of the rows of a TSV file such as aggregate_scans.py output,
+# mapping the key of each row (its first field, e.g. a date) to the byte
+# offset and length of the row, so that single rows can be read without
+# parsing the whole file. The index of <file> is stored in <file>.idx, and is
+# rebuilt when the file's size or modification time change.
+
+INDEX_SUFFIX = ".idx"
+
+def index_path(fname):
+  return fname + INDEX_SUFFIX
+
+def _file_stamp(fname):
+  st = os.stat(fname)
+  return st.st_size, st.st_mtime_ns
+
+def build_index(fname, delimiter="\t"):
+  """Returns {key -> (offset, length)} for every row of fname."""
+  rows = {}
+  sep = delimiter.encode()
+  offset = 0
+  with open(fname, "rb") as f:
+    for line in f:
+      key = line.split(sep, 1)[0].rstrip(b"\r\n").decode()
+      rows[key] = (offset, len(line))
+      offset += len(line)
+  return rows
+
+def load_index(fname, delimiter="\t"):
+  """
+  Returns the row index of fname, reading it from the sidecar index if that
+  is up to date, and otherwise building (and trying to save) it.
+  """
+  stamp = _file_stamp(fname)
+  idxname = index_path(fname)
+  if os.path.isfile(idxname):
+    idx = util.read_pickle(idxname)
+    if idx["stamp"] == stamp and idx["delimiter"] == delimiter:
+      return idx["rows"]
+    logging.info("Row index %s is out of date", idxname)
+  logging.info("Building row index for %s", fname)
+  rows = build_index(fname, delimiter)
+  try:
+    util.write_pickle({"stamp": stamp, "delimiter": delimiter, "rows": rows},
+                      idxname)
+  except OSError:
+    logging.warning("Couldn't write row index %s", idxname)
+  return rows
+
+def indexable(f):
+  """True if the open file f is a regular file, which we can index."""
+  try:
+    return os.path.isfile(f.name)
+  except (AttributeError, TypeError):
+    return False
+
+def read_rows(fname, keys, index, delimiter="\t"):
+  """
+  Returns the parsed rows of fname with the given keys, in file order. Keys
+  missing from the index are skipped.
+  """
+  locations = sorted(index[k] for k in keys if k in index)
+  rows = []
+  with open(fname, "rb") as f:
+    for (offset, length) in locations:
+      f.seek(offset)
+      line = f.read(length).decode()
+      rows.extend(csv.reader([line], delimiter=delimiter))
+  return rows
+
+if __name__ == "__main__":
+  # Configure logging module
+  logging.basicConfig(format=util.LOG_FMT, level=util.LOG_LEVEL)
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--delimiter", "-d", default="\t",
+    help="Input field delimiter (tab by default)")
+  parser.add_argument("infiles", nargs="+",
+    help="TSV files to build row indexes for, if missing or out of date.")
+
+  ARGS = parser.parse_args()
+
+  for fname in ARGS.infiles:
+    load_index(fname, ARGS.delimiter)
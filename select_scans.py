@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 
+import os
 import re
 import sys
 import csv
 import glob
+import json
+import hashlib
 import logging
 import datetime
 import argparse
@@ -13,6 +16,79 @@ from datetime import datetime
 from os import path
 
 import util
+import load_scan
+import instrument
+
+# Number of bytes read from each end of each data file to fingerprint a scan
+FINGERPRINT_BYTES = 1 << 16
+
+def fingerprint(fnames, nbytes=FINGERPRINT_BYTES):
+    """
+    Returns a cheap content fingerprint of a scan: a hash of the name, size,
+    and first and last nbytes of each of its data files. Missing files are
+    skipped, and a scan without any data files has no fingerprint.
+    >>> fingerprint([]) is None
+    True
+    """
+    h = hashlib.sha1()
+    found = False
+    for fname in sorted(fnames, key=path.basename):
+        try:
+            f = open(fname, "rb")
+        except FileNotFoundError:
+            continue
+        found = True
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            h.update("{}\0{}\0".format(path.basename(fname), size).encode())
+            h.update(f.read(nbytes))
+            if size > nbytes:
+                f.seek(max(nbytes, size - nbytes))
+                h.update(f.read(nbytes))
+    return h.hexdigest() if found else None
+
+def file_stamps(fnames):
+    """Returns [path, size, mtime] of each existing file in fnames."""
+    stamps = []
+    for fname in fnames:
+        try:
+            st = os.stat(fname)
+        except FileNotFoundError:
+            continue
+        stamps.append([fname, st.st_size, st.st_mtime_ns])
+    return stamps
+
+class FingerprintCache:
+    """
+    Scan fingerprints, kept in a JSON file between runs. A cached fingerprint
+    is reused as long as the sizes and modification times of the scan's data
+    files are unchanged.
+    """
+    def __init__(self, fname=None):
+        self.fname = fname
+        self.entries = {}
+        self.changed = False
+        if fname is not None and path.exists(fname):
+            with open(fname, "r") as f:
+                self.entries = json.load(f)
+
+    def get(self, scanfile, fnames):
+        stamps = file_stamps(fnames)
+        entry = self.entries.get(scanfile)
+        if entry is not None and entry["stamps"] == stamps:
+            return entry["fingerprint"]
+        fp = fingerprint(fnames)
+        self.entries[scanfile] = {"stamps": stamps, "fingerprint": fp}
+        self.changed = True
+        return fp
+
+    def save(self):
+        if self.fname is None or not self.changed:
+            return
+        with open(self.fname + ".tmp", "w") as f:
+            json.dump(self.entries, f)
+        os.replace(self.fname + ".tmp", self.fname)
+        self.changed = False
 
 # Class that handles all logic of enumerating, downsampling, and filtering
 # files/directories from the results of one scanner.
@@ -29,6 +105,10 @@ class ScansLoader:
         """Extract UTC datetime from given scan file path"""
         raise NotImplementedError
 
+    def data_files(self, scanfile):
+        """Paths of the data files of a scan, which are fingerprinted."""
+        raise NotImplementedError
+
     def campaigns(self, max_allowed_dist_days=4):
         """
         Returns a list of campaigns in the form (start_date, end_date)
@@ -72,6 +152,29 @@ class ScansLoader:
         # Run the filters and return a new list
         self.scanfiles = list(filtered)
 
+    def dedupe(self, cache=None):
+        """
+        Remove scan files whose content fingerprint equals that of an earlier
+        (by time, then path) scan file, e.g. copies of a scan in several
+        directories. Scans without data files are never dropped. Returns a
+        list of (dropped, kept, fingerprint).
+        """
+        cache = cache or FingerprintCache()
+        kept = {}
+        dropped = []
+        for sf in sorted(self.scanfiles, key=lambda sf: (self.filedt(sf), sf)):
+            fp = cache.get(sf, self.data_files(sf))
+            if fp is None:
+                logging.warning("No data files in %s, not deduplicating it", sf)
+            elif fp in kept:
+                logging.warning("Dropping %s, a duplicate of %s", sf, kept[fp])
+                dropped.append((sf, kept[fp], fp))
+            else:
+                kept[fp] = sf
+        dropped_sfs = {d[0] for d in dropped}
+        self.scanfiles = [sf for sf in self.scanfiles if sf not in dropped_sfs]
+        return dropped
+
     def downsample(self, targets=("12:00:00")):
         """Downsample scan files by taking nearest scan to each target time in
         24-hour HH:MM:SS format in each UTC day. This is NOT order-preserving."""
@@ -125,6 +228,9 @@ class YethiScansLoader(ScansLoader):
     def filedt(self, scanfile):
         return util.yethi_scanfile_dt(scanfile)
 
+    def data_files(self, scanfile):
+        return load_scan.LoadYethiScan.data_files(scanfile, uncontactable=True)
+
     def _list_scanfiles(self):
         return list(map(util.yethi_scanpath,
                         glob.glob(path.join(self.scans_dir,
@@ -137,6 +243,9 @@ class BtcScansLoader(ScansLoader):
     def filedt(self, scanfile):
         return util.btc_scanfile_dt(scanfile)
 
+    def data_files(self, scanfile):
+        return load_scan.LoadBtcScan.data_files(scanfile)
+
     def _list_scanfiles(self):
         return list(map(lambda f: f.rstrip("/"),
             glob.glob(path.join(self.scans_dir, self.FILE_GLOB))))
@@ -188,6 +297,19 @@ if __name__ == "__main__":
     parser.add_argument("--campaign-dist", "-cd", default=4, type=int,
       help="Scans more than this number of days apart will be considered "
            "to be separate campaigns. Default value is 4.")
+    parser.add_argument("--dedupe", "-dd", action="store_true",
+      help="If given, scans with the same content (e.g. the same scan copied "
+           "into several directories) are only output once, keeping the "
+           "earliest. Scans are compared by a fingerprint of the sizes and "
+           "first and last bytes of their data files.")
+    parser.add_argument("--fingerprint-cache", "-fc", default=None,
+      help="With --dedupe: JSON file in which to cache scan fingerprints "
+           "between runs. Fingerprints of scans whose files are unchanged "
+           "are not recomputed.")
+    parser.add_argument("--dedupe-report", "-dr", default=None,
+      help="With --dedupe: write each dropped scan file, the scan file it "
+           "duplicates and their fingerprint to this TSV file.")
+    instrument.add_argument(parser)
 
     # Required args
     parser.add_argument("--format", "-f", choices=list(FORMAT_LOADERS.keys()), 
@@ -198,6 +320,9 @@ if __name__ == "__main__":
     logging.debug("===STARTUP===")
 
     ARGS = parser.parse_args()
+    if not ARGS.dedupe and (ARGS.fingerprint_cache or ARGS.dedupe_report):
+        parser.error("--fingerprint-cache and --dedupe-report require --dedupe")
+    instrument.setup(ARGS.instrument, "select_scans")
 
     # Initialize TSV output writer
     writer = csv.writer(sys.stdout, delimiter=ARGS.delimiter,
@@ -205,12 +330,29 @@ if __name__ == "__main__":
 
     # Initialize correct loader for selected scanfile type
     loader_cls = FORMAT_LOADERS[ARGS.format]
-    loader = loader_cls(ARGS.scan_dir)
+    with instrument.stage("list"):
+        loader = loader_cls(ARGS.scan_dir)
+        instrument.count(scans=len(loader.scanfiles))
 
     # Filter
-    not_before_dt = util.str2dt(ARGS.not_before) if ARGS.not_before is not None else None
-    not_after_dt = util.str2dt(ARGS.not_after) if ARGS.not_after is not None else None
-    loader.filter(not_before_dt, not_after_dt)
+    with instrument.stage("filter"):
+        not_before_dt = util.str2dt(ARGS.not_before) if ARGS.not_before is not None else None
+        not_after_dt = util.str2dt(ARGS.not_after) if ARGS.not_after is not None else None
+        instrument.count(scans=len(loader.scanfiles))
+        loader.filter(not_before_dt, not_after_dt)
+
+    # Collapse duplicate scans
+    if ARGS.dedupe:
+        with instrument.stage("dedupe"):
+            instrument.count(scans=len(loader.scanfiles))
+            cache = FingerprintCache(ARGS.fingerprint_cache)
+            dropped = loader.dedupe(cache)
+            cache.save()
+        logging.info("Dropped %s duplicate scans", len(dropped))
+        if ARGS.dedupe_report:
+            with open(ARGS.dedupe_report, "w") as f:
+                csv.writer(f, delimiter=ARGS.delimiter,
+                           lineterminator="\n").writerows(dropped)
 
     # Downsample
     if not ARGS.downsample.strip().upper().startswith("F"):
@@ -218,25 +360,31 @@ if __name__ == "__main__":
         if TIME_RE.fullmatch(ARGS.downsample.strip()):
             downsample_targets = ARGS.downsample.strip().split(',')
             logging.info("Downsampling to times: %s", ", ".join(downsample_targets))
-            loader.downsample(targets=downsample_targets)
+            with instrument.stage("downsample"):
+                instrument.count(scans=len(loader.scanfiles))
+                loader.downsample(targets=downsample_targets)
 
     # Sort by time
-    loader.sort()
+    with instrument.stage("sort"):
+        instrument.count(scans=len(loader.scanfiles))
+        loader.sort()
 
     # Produce output
-    if ARGS.campaigns:
-        camp = loader.campaigns(ARGS.campaign_dist)
-        for c in camp:
-            writer.writerow(c)
-    elif ARGS.each_scan:
-        for iso_sf in loader.scanfiles_and_isotimes():
-            writer.writerow(iso_sf)
-    else:
-        sf_by_date = loader.scanfiles_by_date()
-        # Ensure output rows are ordered by ISO date
-        for date in sorted(sf_by_date.keys()):
-            scanfiles = sf_by_date[date]
-            scanfiles_data = ARGS.inner_delimiter.join(scanfiles)
-            writer.writerow((date, scanfiles_data,))
+    with instrument.stage("write"):
+        instrument.count(scans=len(loader.scanfiles))
+        if ARGS.campaigns:
+            camp = loader.campaigns(ARGS.campaign_dist)
+            for c in camp:
+                writer.writerow(c)
+        elif ARGS.each_scan:
+            for iso_sf in loader.scanfiles_and_isotimes():
+                writer.writerow(iso_sf)
+        else:
+            sf_by_date = loader.scanfiles_by_date()
+            # Ensure output rows are ordered by ISO date
+            for date in sorted(sf_by_date.keys()):
+                scanfiles = sf_by_date[date]
+                scanfiles_data = ARGS.inner_delimiter.join(scanfiles)
+                writer.writerow((date, scanfiles_data,))
 
     logging.debug("===FINISH===")
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import collections
+
+from array import array
+from multiprocessing import shared_memory, resource_tracker
+
+# Transport of large worker results (lists of strings, Counters) through
+# shared memory instead of pickling them through the pool's pipe. A worker
+# puts its result into a new shared memory segment and returns a small
+# handle; the parent takes the result from the segment, which unlinks it.
+#
+# Strings are stored as one UTF-8 buffer, joined by a separator which must
+# not occur in them. Counters are stored as such a string table of keys
+# followed by an array of their counts.
+#
+# Segments whose handles are never taken (e.g. if the parent dies) are left
+# in /dev/shm.
+
+def _create(nbytes):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+    # The segment outlives this process: the parent unlinks it once it has
+    # taken the result, so it mustn't be cleaned up when this worker exits
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+def _attach(name):
+    return shared_memory.SharedMemory(name=name)
+
+class SharedStrings:
+    """
+    Handle to a list of strings in shared memory.
+    >>> h = SharedStrings.put(["b", "a"], sep=";")
+    >>> len(h), h.take()
+    (2, ['b', 'a'])
+    >>> SharedStrings.put([]).take()
+    []
+    """
+    def __init__(self, name, nbytes, count, sep):
+        self.name = name
+        self.nbytes = nbytes
+        self.count = count
+        self.sep = sep
+
+    @classmethod
+    def put(cls, strings, sep="\n"):
+        strings = list(strings)
+        data = sep.join(strings).encode()
+        shm = _create(len(data))
+        shm.buf[:len(data)] = data
+        handle = cls(shm.name, len(data), len(strings), sep)
+        shm.close()
+        return handle
+
+    def __len__(self):
+        return self.count
+
+    def _consume(self, func):
+        shm = _attach(self.name)
+        try:
+            with shm.buf[:self.nbytes] as data:
+                return func(data)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def take(self):
+        """Returns the list of strings, and frees the shared memory."""
+        if self.count == 0:
+            self._consume(lambda data: None)
+            return []
+        return self._consume(lambda data: str(data, "utf-8").split(self.sep))
+
+    def write_to(self, f):
+        """
+        Writes the strings, joined by the separator, to the text file f
+        without decoding them, and frees the shared memory.
+        """
+        f.flush()
+        self._consume(f.buffer.write)
+
+class SharedCounter:
+    """
+    Handle to a Counter with str or int keys in shared memory.
+    >>> c = collections.Counter({"8.8.8.8": 2, "1.1.1.1": 1})
+    >>> SharedCounter.put(c).take() == c
+    True
+    >>> SharedCounter.put(collections.Counter({1: 3})).take()
+    Counter({1: 3})
+    """
+    def __init__(self, name, keys_nbytes, count, int_keys):
+        self.name = name
+        self.keys_nbytes = keys_nbytes
+        self.count = count
+        self.int_keys = int_keys
+
+    @classmethod
+    def put(cls, counter):
+        """
+        Returns a handle to counter in shared memory, or counter itself if it
+        has keys other than strings or ints.
+        """
+        keys = list(counter.keys())
+        int_keys = all(type(k) is int for k in keys)
+        if not int_keys and not all(type(k) is str for k in keys):
+            return counter
+        keydata = "\n".join(map(str, keys)).encode()
+        counts = array("Q", (counter[k] for k in keys))
+        # Align the counts to their item size
+        offset = -(-len(keydata) // counts.itemsize) * counts.itemsize
+        shm = _create(offset + len(counts) * counts.itemsize)
+        shm.buf[:len(keydata)] = keydata
+        shm.buf[offset:offset + len(counts) * counts.itemsize] = counts.tobytes()
+        handle = cls(shm.name, len(keydata), len(keys), int_keys)
+        shm.close()
+        return handle
+
+    def __len__(self):
+        return self.count
+
+    def take(self):
+        """Returns the Counter, and frees the shared memory."""
+        shm = _attach(self.name)
+        try:
+            if self.count == 0:
+                return collections.Counter()
+            keys = str(shm.buf[:self.keys_nbytes], "utf-8").split("\n")
+            if self.int_keys:
+                keys = map(int, keys)
+            offset = -(-self.keys_nbytes // 8) * 8
+            with shm.buf[offset:offset + 8 * self.count] as data:
+                with data.cast("Q") as counts:
+                    return collections.Counter(dict(zip(keys, counts)))
+        finally:
+            shm.close()
+            shm.unlink()
+
+def take(result):
+    """Returns the value of a handle, or result itself if it isn't one."""
+    if isinstance(result, (SharedStrings, SharedCounter)):
+        return result.take()
+    return result
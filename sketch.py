@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import math
+import heapq
+import hashlib
+
+from array import array
+
+# K minimum values (KMV) sketches of sets, for estimating the cardinalities
+# of sets and their intersections without keeping the sets themselves. A
+# sketch keeps the k smallest 64-bit hashes of the values in a set. The
+# intersection of several sets is estimated from the hashes the sketches have
+# in common below the smallest of their k-th hashes ("theta"), as in theta
+# sketches. Sketches of sets with fewer than k values are exact.
+
+HASH_RANGE = 2**64
+DEFAULT_K = 4096
+
+# z-score for the reported confidence intervals (95%)
+Z = 1.96
+
+def hash_value(value):
+  """
+  Returns a 64-bit hash of str(value), which is stable across processes.
+  >>> hash_value("8.8.8.8") == hash_value("8.8.8.8")
+  True
+  >>> hash_value(1) == hash_value("1")
+  True
+  """
+  digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+  return int.from_bytes(digest, "big")
+
+class KMVSketch:
+  """
+  >>> s = KMVSketch.from_values(range(10), k=16)
+  >>> s.estimate()
+  (10, 0.0)
+  >>> s = KMVSketch.from_values(range(10000), k=1024)
+  >>> est, err = s.estimate()
+  >>> abs(est - 10000) < err
+  True
+  """
+  __slots__ = ("k", "hashes")
+
+  def __init__(self, k, hashes):
+    self.k = k
+    # The (at most) k smallest hashes, sorted
+    self.hashes = array("Q", hashes)
+
+  @classmethod
+  def from_values(cls, values, k=DEFAULT_K):
+    return cls(k, heapq.nsmallest(k, {hash_value(v) for v in values}))
+
+  def __len__(self):
+    return len(self.hashes)
+
+  @property
+  def theta(self):
+    """Hashes below theta are kept if their values are in the set."""
+    if len(self.hashes) < self.k:
+      return HASH_RANGE
+    return self.hashes[-1]
+
+  def estimate(self):
+    """Returns (estimated cardinality, 95% error bound) of the set."""
+    return intersection([self])
+
+def intersection(sketches):
+  """
+  Returns (estimated cardinality, 95% error bound) of the intersection of the
+  sets of the given sketches. The bound is 0 if the estimate is exact.
+  >>> a = KMVSketch.from_values(range(0, 20000), k=2048)
+  >>> b = KMVSketch.from_values(range(10000, 30000), k=2048)
+  >>> est, err = intersection([a, b])
+  >>> abs(est - 10000) < err
+  True
+  >>> intersection([KMVSketch.from_values("abc"), KMVSketch.from_values("bcd")])
+  (2, 0.0)
+  """
+  theta = min(s.theta for s in sketches)
+  common = None
+  for s in sketches:
+    below = set(h for h in s.hashes if h < theta)
+    common = below if common is None else common & below
+  m = len(common)
+  if theta == HASH_RANGE:
+    return m, 0.0
+  # Each value of the intersection has a hash below theta with probability
+  # p, so m is binomially distributed. Use at least m=1 for the error bound,
+  # so that an empty sample doesn't claim to be exact.
+  p = theta / HASH_RANGE
+  return round(m / p), Z * math.sqrt(max(m, 1) * (1 - p)) / p
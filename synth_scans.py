@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import csv
+import gzip
+import lzma
+import random
+import logging
+import argparse
+import shutil
+import calendar
+
+from datetime import timedelta
+from os import path
+
+import util
+import load_scan
+
+# Generates synthetic scan trees in the same layouts as our crawlers write, for
+# benchmarking and testing the tools without access to real scan data:
+#   Yethi: <out_dir>/<unixtime>/confirmed.csv.xz, events.csv.xz, ...
+#   BTC-style: <out_dir>/log-YYYY-MM-DDTHH-MM-SS/done, address_ipinfos.csv.gz, ...
+# The files btccrawlgo writes besides its address file aren't documented here,
+# so BTC-style scans are only as real as the scan given with --like, whose
+# files they copy.
+
+# Yethi scans contain more files than the confirmed and events files we read;
+# the integrity check only requires at least 11 files in the scan directory.
+YETHI_NB_FILLER_FILES = 9
+
+# File in BTC-style scans listing each address and whether it was reachable.
+# Without a real scan to copy, the crawler's further gz files are filled with
+# placeholders so that scans pass the integrity check (at least 5 files,
+# including "done").
+BTC_ADDRESS_FILE = load_scan.LoadBtcScan.ADDRESS_FILE
+BTC_ADDRESS_HEADER = [load_scan.LoadBtcScan.ADDRESS_COLUMN,
+                      load_scan.LoadBtcScan.REACHABLE_COLUMN]
+BTC_FILLER_FILES = ("peers.csv.gz", "versions.csv.gz", "addrs.csv.gz")
+BTC_DONE_FILE = "done"
+
+DEFAULT_PORTS = {
+    "Yethi": "30303",
+    "BTC": "8333",
+    "LTC": "9333",
+    "Dash": "9999",
+    "ZEC": "8233",
+}
+
+class SyntheticNetwork:
+    """
+    A population of nodes, each with a fixed probability of being contactable
+    in any given scan. A share of nodes is stable ("core" nodes), the rest
+    churn, so downsampling, aggregation and core-node computations see
+    realistic overlap between scans.
+    """
+    def __init__(self, nb_nodes, fmt="Yethi", core_fraction=0.3,
+                 ipv6_fraction=0.0, seed=0):
+        self.fmt = fmt
+        self.rand = random.Random(seed)
+        port = DEFAULT_PORTS[fmt]
+        self.nodes = []
+        for _ in range(nb_nodes):
+            nodeid = "%0128x" % self.rand.getrandbits(512)
+            if self.rand.random() < ipv6_fraction:
+                ip = "[2001:db8:{:x}:{:x}::{:x}]".format(
+                    self.rand.getrandbits(16), self.rand.getrandbits(16),
+                    self.rand.getrandbits(16))
+            else:
+                ip = "{}.{}.{}.{}".format(self.rand.randint(1, 223),
+                                          *(self.rand.randint(0, 255)
+                                            for _ in range(3)))
+            if self.rand.random() < core_fraction:
+                p = self.rand.uniform(0.9, 1.0)
+            else:
+                p = self.rand.uniform(0.05, 0.6)
+            self.nodes.append(((nodeid, ip, port), p))
+
+    def scan(self):
+        """Returns (contactable, uncontactable) node lists for one scan."""
+        contactable, uncontactable = [], []
+        for node, p in self.nodes:
+            if self.rand.random() < p:
+                contactable.append(node)
+            else:
+                uncontactable.append(node)
+        return contactable, uncontactable
+
+
+def write_yethi_scan(out_dir, dt, contactable, uncontactable):
+    scan_dir = path.join(out_dir, str(calendar.timegm(dt.utctimetuple())))
+    os.makedirs(scan_dir, exist_ok=True)
+    with lzma.open(path.join(scan_dir, "confirmed.csv.xz"), "wt") as f:
+        for node in contactable:
+            f.write(":".join(node) + "\n")
+    with lzma.open(path.join(scan_dir, "events.csv.xz"), "wt") as f:
+        for node in contactable:
+            f.write(",".join(("CONTACTED",) + node + ("PING",)) + "\n")
+        for node in uncontactable:
+            f.write(",".join(("UNCONTACTABLE",) + node + ("BOND",)) + "\n")
+    for i in range(YETHI_NB_FILLER_FILES):
+        with lzma.open(path.join(scan_dir, "filler{}.csv.xz".format(i)), "wt"):
+            pass
+    return scan_dir
+
+
+class BtcLayout:
+    """
+    The files of a BTC-style scan besides its address file, and the columns of
+    the address file. By default these are placeholders; from_scan copies them
+    from a real btccrawlgo scan.
+    """
+    def __init__(self, header=BTC_ADDRESS_HEADER, files=None):
+        self.header = header
+        # {file name: path of the real file to copy, or None for an empty gz}
+        self.files = files if files is not None else dict.fromkeys(BTC_FILLER_FILES)
+        self.files.setdefault(BTC_DONE_FILE, None)
+
+    @classmethod
+    def from_scan(cls, scan_dir):
+        """
+        Takes the layout of the given real scan, which must have an address
+        file with address and reachable columns.
+        """
+        fname = path.join(scan_dir, BTC_ADDRESS_FILE)
+        with gzip.open(fname, "rt") as f:
+            header = next(csv.reader(f), [])
+        if not all(column in header for column in BTC_ADDRESS_HEADER):
+            raise ValueError("{} has no {} columns".format(fname,
+                                                           " and ".join(BTC_ADDRESS_HEADER)))
+        return cls(header, {fname: path.join(scan_dir, fname)
+                            for fname in os.listdir(scan_dir)
+                            if fname != BTC_ADDRESS_FILE})
+
+    def write_scan(self, out_dir, dt, contactable, uncontactable):
+        scan_dir = path.join(out_dir, dt.strftime("log-%Y-%m-%dT%H-%M-%S"))
+        os.makedirs(scan_dir, exist_ok=True)
+        address_i = self.header.index(BTC_ADDRESS_HEADER[0])
+        reachable_i = self.header.index(BTC_ADDRESS_HEADER[1])
+        with gzip.open(path.join(scan_dir, BTC_ADDRESS_FILE), "wt", newline="") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(self.header)
+            row = [""] * len(self.header)
+            for reachable, nodes in ((True, contactable), (False, uncontactable)):
+                row[reachable_i] = reachable
+                for (_, ip, port) in nodes:
+                    row[address_i] = "{}:{}".format(ip, port)
+                    writer.writerow(row)
+        for fname, real_file in self.files.items():
+            if real_file is not None:
+                shutil.copyfile(real_file, path.join(scan_dir, fname))
+            elif fname.endswith(".gz"):
+                with gzip.open(path.join(scan_dir, fname), "wt"):
+                    pass
+            else:
+                open(path.join(scan_dir, fname), "w").close()
+        return scan_dir
+
+
+def check_btc_scan(scan_dir):
+    """
+    Checks that a synthetic BTC-style scan loads the same natively as through
+    btccrawlgo-processing's Dataset. Returns False (with a warning) if the
+    Dataset can't be imported, and raises ValueError if they differ.
+    """
+    try:
+        diffs = load_scan.LoadBtcScan(scan_dir).check_native()
+    except ImportError as e:
+        logging.warning("Can't import btccrawlgo-processing (%s), so the layout of "
+                        "synthetic BTC-style scans is unverified", e)
+        return False
+    for reachable, native_only, dataset_only in diffs:
+        if native_only or dataset_only:
+            raise ValueError("{} loads differently through the Dataset: {} "
+                             "{} addresses only read natively, {} only by the "
+                             "Dataset".format(scan_dir, len(native_only),
+                                              "reachable" if reachable else "unreachable",
+                                              len(dataset_only)))
+    return True
+
+
+def generate(out_dir, fmt="Yethi", start="2019-01-01", days=7,
+             scans_per_day=4, nb_nodes=1000, core_fraction=0.3,
+             ipv6_fraction=0.0, seed=0, btc_layout=None):
+    """
+    Writes days*scans_per_day synthetic scans of the given format to out_dir,
+    evenly spaced over each day. BTC-style scans have the given BtcLayout
+    (placeholders by default). Returns the list of scan directories.
+    """
+    network = SyntheticNetwork(nb_nodes, fmt=fmt, core_fraction=core_fraction,
+                               ipv6_fraction=ipv6_fraction, seed=seed)
+    if fmt == "Yethi":
+        write_scan = write_yethi_scan
+    else:
+        write_scan = (btc_layout or BtcLayout()).write_scan
+    start_dt = util.str2dt(start)
+    interval = timedelta(days=1) / scans_per_day
+    scan_dirs = []
+    for day in range(days):
+        for i in range(scans_per_day):
+            dt = start_dt + timedelta(days=day) + i * interval
+            logging.info("Writing synthetic scan %s", dt.isoformat())
+            contactable, uncontactable = network.scan()
+            scan_dirs.append(write_scan(out_dir, dt, contactable, uncontactable))
+    return scan_dirs
+
+
+if __name__ == "__main__":
+    # Configure logging module
+    logging.basicConfig(format=util.LOG_FMT, level=util.LOG_LEVEL)
+
+    parser = argparse.ArgumentParser()
+
+    # Optional args
+    parser.add_argument("--start", "-s", default="2019-01-01",
+      help="UTC ISO date of the first scan (2019-01-01 by default)")
+    parser.add_argument("--days", "-n", type=int, default=7,
+      help="Number of days of scans to generate (7 by default)")
+    parser.add_argument("--scans-per-day", "-spd", type=int, default=4,
+      help="Number of scans per day (4 by default)")
+    parser.add_argument("--nodes", "-N", type=int, default=1000,
+      help="Number of nodes in the synthetic network (1000 by default)")
+    parser.add_argument("--core-fraction", "-cf", type=float, default=0.3,
+      help="Fraction of nodes which are almost always contactable (0.3 by default)")
+    parser.add_argument("--ipv6-fraction", "-v6", type=float, default=0.0,
+      help="Fraction of nodes with IPv6 addresses (0 by default). Only "
+           "supported by BTC-style formats.")
+    parser.add_argument("--seed", type=int, default=0,
+      help="Random seed (0 by default)")
+    parser.add_argument("--like", "-l", default=None,
+      help="Real btccrawlgo scan directory whose files and address file "
+           "columns BTC-style scans copy. Without it, the crawler's other "
+           "files are empty placeholders.")
+
+    # Required args
+    parser.add_argument("--format", "-f", choices=sorted(DEFAULT_PORTS.keys()),
+      help="Format of scan files to generate.", required=True)
+    parser.add_argument("out_dir",
+      help="Directory to write scans to (created if missing).")
+
+    ARGS = parser.parse_args()
+
+    if ARGS.format == "Yethi" and ARGS.ipv6_fraction > 0:
+        parser.error("IPv6 nodes are not supported in Yethi scans")
+    btc_layout = None
+    if ARGS.like is not None:
+        if ARGS.format == "Yethi":
+            parser.error("--like is only supported by BTC-style formats")
+        try:
+            btc_layout = BtcLayout.from_scan(ARGS.like)
+        except (OSError, ValueError) as e:
+            parser.error("Can't copy the layout of {}: {}".format(ARGS.like, e))
+
+    scan_dirs = generate(ARGS.out_dir, fmt=ARGS.format, start=ARGS.start,
+                         days=ARGS.days, scans_per_day=ARGS.scans_per_day,
+                         nb_nodes=ARGS.nodes,
+                         core_fraction=ARGS.core_fraction,
+                         ipv6_fraction=ARGS.ipv6_fraction, seed=ARGS.seed,
+                         btc_layout=btc_layout)
+    if ARGS.format != "Yethi" and scan_dirs:
+        try:
+            check_btc_scan(scan_dirs[0])
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(1)
+    for scan_dir in scan_dirs:
+        print(scan_dir)
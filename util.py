@@ -2,14 +2,14 @@
 
 import os
 import re
-import pyasn
+import time
+import json
 import pickle
 import bisect
 import logging
-import doctest
 import itertools
+import threading
 import ipaddress
-import multiprocessing as mp
 
 from collections import Counter
 from datetime import datetime, timedelta
@@ -20,16 +20,29 @@ ASN_DB_FNAME = "ipasn.dat.gz"
 IPASN_DIR = os.path.join(SCRIPT_DIR, "asn")
 IPASN6_DIR = os.path.join(SCRIPT_DIR, "asn")
 
+# IP2Location database (see ip2location_db/load_data.sh), and an optional
+# SQLite file in which geoip lookups are cached between runs
+GEOIP_DB = os.path.join(SCRIPT_DIR, "ip2location_db", "ip2location.sqlite")
+GEOIP_CACHE = None
+
 LOG_FMT = "%(asctime)s:%(levelname)s:%(name)s:%(message)s"
 LOG_LEVEL = logging.WARNING
 
-DEFAULT_CONCURRENCY = max(1, mp.cpu_count() - 2)
+# Heavy or rarely needed modules (pyasn, multiprocessing, urllib) are
+# imported in the functions which use them, to keep startup fast for the CLIs
+# which import this module
+
+DEFAULT_CONCURRENCY = max(1, (os.cpu_count() or 1) - 2)
+
+# Worker pool types for make_pool: processes (the default) or threads
+EXECUTORS = ("process", "thread")
 
 # Regexp matches paths ending with a number, e.g. /foo/12345/ or /foo/1234
 YETHI_TS_DIR = re.compile("[0-9]+/*$")
 
 __asn_db = {}
 __asn6_db = {}
+__asn_db_lock = threading.Lock()
 
 def asn_db(date: str = None):
   """
@@ -40,23 +53,279 @@ def asn_db(date: str = None):
   if date is None:
     date = (datetime.today() - timedelta(days=1)).strftime("%Y-%m-%d")
     logging.warning("No date specified for ASN DB, using %s", date)
-  if date not in __asn_db:
-    # IPASN not loaded -- load it now
-    path = os.path.join(IPASN_DIR, date, ASN_DB_FNAME)
-    path6 = os.path.join(IPASN6_DIR, date, ASN_DB_FNAME)
-    logging.info("Loading IPASN IPv4 database %s", path)
-    logging.info("Loading IPASN IPv6 database %s", path6)
+  # The IPv6 DB is loaded last, so if it's present, both are. Only take the
+  # lock if we need to load, so threads don't contend on every lookup.
+  if date not in __asn6_db:
+    with __asn_db_lock:
+      if date not in __asn6_db:
+        # IPASN not loaded -- load it now
+        import pyasn
+        path = os.path.join(IPASN_DIR, date, ASN_DB_FNAME)
+        path6 = os.path.join(IPASN6_DIR, date, ASN_DB_FNAME)
+        logging.info("Loading IPASN IPv4 database %s", path)
+        logging.info("Loading IPASN IPv6 database %s", path6)
+        try:
+          __asn_db[date] = pyasn.pyasn(path)
+        except OSError as e:
+          logging.error("Could not load IPASN IPv4 database %s", path)
+          raise e
+        try:
+          __asn6_db[date] = pyasn.pyasn(path6)
+        except OSError as e:
+          logging.error("Could not load IPASN IPv6 database %s", path6)
+          raise e
+  return __asn_db[date], __asn6_db[date]
+
+def make_pool(concurrency: int, executor: str = "process",
+              maxtasksperchild: int = None):
+    """
+    Returns a worker pool with the multiprocessing.Pool interface, using
+    processes or threads depending on executor (one of EXECUTORS). Process
+    workers are replaced after maxtasksperchild tasks, if given, to return
+    their memory to the system.
+    """
+    import multiprocessing as mp
+    if executor == "thread":
+        import multiprocessing.pool
+        return mp.pool.ThreadPool(concurrency)
+    return mp.Pool(concurrency, maxtasksperchild=maxtasksperchild)
+
+def add_task_arguments(parser):
+    """
+    Adds options controlling worker pools run with supervised_imap to an
+    argparse parser.
+    """
+    parser.add_argument("--task-timeout", "-tt", type=float, default=None,
+      metavar="SECONDS", help="If specified, give up on a task (e.g. a date's "
+           "scans) which runs for longer than this, report it as failed and "
+           "carry on.")
+    parser.add_argument("--max-tasks-per-child", "-mtpc", type=int, default=None,
+      help="If specified, replace each process worker after this many tasks, "
+           "returning its memory to the system.")
+    parser.add_argument("--speculate", "-sp", type=float, default=None,
+      metavar="FACTOR", help="If specified, once all tasks are started, idle "
+           "workers re-run tasks running for more than FACTOR times the "
+           "median task duration, and the first copy to finish is used.")
+
+# Marks the end of the tasks in supervised_imap
+_FED = object()
+
+class TaskFailure:
+    """Yielded by supervised_imap in place of the result of a failed task."""
+    def __init__(self, task, reason: str):
+        self.task = task
+        self.reason = reason
+
+def supervised_imap(pool_factory, func, tasks, concurrency: int,
+                    timeout: float = None, speculate: float = None,
+                    discard=None, poll: float = 0.5):
+    """
+    Like pool.imap(func, tasks) on the pool returned by pool_factory(), but
+    isolating failures, and yielding a TaskFailure instead of the result of
+    a task which raised an exception or ran for more than timeout seconds.
+    At most concurrency tasks are in flight, so a task starts about when it
+    is submitted.
+
+    Timed out tasks are abandoned. Their workers can't be reclaimed one by
+    one, so once half of them are stuck, the pool is replaced and the tasks
+    in flight are resubmitted. (Thread workers can't be stopped; they keep
+    running in the background.)
+
+    If speculate is given, then once all tasks have been submitted, idle
+    workers re-run tasks which have been running for more than speculate
+    times the median task duration so far, and the first copy to finish is
+    used.
+
+    Results which are never yielded (of unused copies, of copies which
+    finish in a replaced pool, or when the generator is closed early) are
+    passed to discard, if given, to free their resources. Copies still
+    running when their pool is terminated are killed, so anything they had
+    allocated for their result (e.g. spill files or shared memory segments)
+    is leaked.
+    >>> list(supervised_imap(lambda: make_pool(2, "thread"), abs, [-1, 2, -3], 2))
+    [1, 2, 3]
+    >>> [r.reason for r in supervised_imap(lambda: make_pool(1, "thread"), abs, ["a"], 1)]
+    ["TypeError: bad operand type for abs(): 'str'"]
+
+    Tasks are pulled from tasks in another thread, so the iterator may block
+    until earlier results have been consumed (e.g. a prefetch.Prefetcher
+    whose budget is smaller than concurrency tasks).
+    >>> budget = threading.Semaphore(1)
+    >>> def budgeted(tasks):
+    ...     for task in tasks:
+    ...         budget.acquire()
+    ...         yield task
+    >>> results = []
+    >>> for r in supervised_imap(lambda: make_pool(4, "thread"), abs, budgeted([-1, 2, -3]), 4):
+    ...     budget.release()
+    ...     results.append(r)
+    >>> results
+    [1, 2, 3]
+    """
+    import queue
+    import statistics
+    pool = pool_factory()
+    # Tasks in flight: {index -> (task, [(start time, AsyncResult), ...])}
+    running = {}
+    # Finished tasks waiting to be yielded in order: {index -> result}
+    finished = {}
+    # Unused copies of finished tasks, and copies of timed out tasks
+    unused, stuck = [], []
+    durations = []
+    submitted, yielded = 0, 0
+    exhausted = False
+    # Set whenever a copy finishes, to wake us up
+    wake = threading.Event()
+
+    def submit(task):
+        return pool.apply_async(func, (task,), callback=lambda _: wake.set(),
+                                error_callback=lambda _: wake.set())
+
+    def reap(copies):
+        # Discards the results of copies which have finished
+        for ar in [ar for ar in copies if ar.ready()]:
+            copies.remove(ar)
+            if discard is not None and ar.successful():
+                discard(ar.get())
+
+    # Tasks pulled from tasks by the feeder thread, one for each request
+    # (release of wanted), followed by _FED or the exception raised by tasks
+    pulled = queue.Queue()
+    wanted = threading.Semaphore(0)
+    requested = 0
+    feeder = None
+    closed = False
+
+    def feed():
+        try:
+            for task in tasks:
+                pulled.put(task)
+                wake.set()
+                wanted.acquire()
+                if closed:
+                    return
+        except Exception as e:
+            pulled.put(e)
+        else:
+            pulled.put(_FED)
+        wake.set()
+
+    def retire(old_pool, copies):
+        # Terminates old_pool, then discards the results of copies which
+        # finished in it, including any delivered while it was terminating
+        old_pool.terminate()
+        reap(copies)
+
     try:
-      __asn_db[date] = pyasn.pyasn(path)
-    except OSError as e:
-      logging.error("Could not load IPASN IPv4 database %s", path)
-      raise e
+        while True:
+            wake.clear()
+            now = time.monotonic()
+            for i, (task, copies) in list(running.items()):
+                done = next((c for c in copies if c[1].ready()), None)
+                if done is not None:
+                    start, ar = done
+                    try:
+                        finished[i] = ar.get()
+                        durations.append(now - start)
+                    except Exception as e:
+                        finished[i] = TaskFailure(task,
+                            "{}: {}".format(type(e).__name__, e))
+                    unused.extend(c[1] for c in copies if c is not done)
+                    del running[i]
+                elif timeout is not None and now - copies[0][0] > timeout:
+                    logging.error("Task %s timed out after %ss", i, timeout)
+                    finished[i] = TaskFailure(task,
+                        "Timed out after {}s".format(timeout))
+                    stuck.extend(c[1] for c in copies)
+                    del running[i]
+            reap(unused)
+            reap(stuck)
+
+            while yielded in finished:
+                yield finished.pop(yielded)
+                yielded += 1
+            if exhausted and not running and not finished:
+                return
+
+            if len(stuck) >= max(1, concurrency // 2):
+                logging.warning("%s workers are stuck on timed out tasks, "
+                                "replacing the pool", len(stuck))
+                retire(pool, unused + stuck +
+                       [ar for _, copies in running.values() for _, ar in copies])
+                pool = pool_factory()
+                unused, stuck = [], []
+                for i, (task, _) in running.items():
+                    running[i] = (task, [(time.monotonic(), submit(task))])
+
+            busy = (sum(len(copies) for _, copies in running.values()) +
+                    len(unused) + len(stuck))
+            while busy < concurrency and not exhausted:
+                try:
+                    task = pulled.get_nowait()
+                except queue.Empty:
+                    break
+                if task is _FED:
+                    exhausted = True
+                    break
+                if isinstance(task, Exception):
+                    raise task
+                requested -= 1
+                running[submitted] = (task, [(now, submit(task))])
+                submitted += 1
+                busy += 1
+            # Ask for tasks for the remaining free workers, without waiting
+            # for them; they wake us up when they arrive
+            if not exhausted and busy + requested < concurrency:
+                if feeder is None:
+                    feeder = threading.Thread(target=feed, name="tasks", daemon=True)
+                    feeder.start()
+                    requested += 1
+                for _ in range(concurrency - busy - requested):
+                    wanted.release()
+                    requested += 1
+
+            if speculate is not None and exhausted and durations:
+                threshold = speculate * statistics.median(durations)
+                for i, (task, copies) in sorted(running.items()):
+                    if busy >= concurrency:
+                        break
+                    if len(copies) == 1 and now - copies[0][0] > threshold:
+                        logging.warning("Task %s is straggling, running it again", i)
+                        copies.append((now, submit(task)))
+                        busy += 1
+
+            # Wait for a copy to finish, or for poll seconds to check for
+            # timeouts and stragglers
+            wake.wait(poll)
+    finally:
+        # Stop the feeder if it is waiting for a request. If it is blocked in
+        # the task iterator, it is left behind (it's a daemon thread).
+        closed = True
+        wanted.release()
+        retire(pool, unused + stuck +
+               [ar for _, copies in running.values() for _, ar in copies])
+        if discard is not None:
+            for result in finished.values():
+                if not isinstance(result, TaskFailure):
+                    discard(result)
+
+def server_query(server: str, endpoint: str, params: dict):
+    """
+    Sends a query to a query_server.py instance at the given base URL (e.g.
+    http://localhost:8642), and returns its decoded JSON result. Raises an
+    exception with the server's error message if the query fails.
+    """
+    import urllib.error
+    import urllib.request
+    req = urllib.request.Request(server.rstrip("/") + "/" + endpoint,
+                                 data=json.dumps(params).encode(),
+                                 headers={"Content-Type": "application/json"})
     try:
-      __asn6_db[date] = pyasn.pyasn(path6)
-    except OSError as e:
-      logging.error("Could not load IPASN IPv6 database %s", path6)
-      raise e
-  return __asn_db[date], __asn6_db[date]
+        with urllib.request.urlopen(req) as resp:
+            return json.load(resp)
+    except urllib.error.HTTPError as e:
+        raise Exception("Query {} failed: {}".format(endpoint,
+                        json.load(e).get("error", e.reason)))
 
 def time2dt(timestr:str, daystr:str):
     """timestr should be 24-hour time string in format HH:MM:SS
@@ -109,6 +378,27 @@ def is_ipv4(ip: str):
     except:
         return False
 
+def ip_family(ip: str):
+    """
+    Classifies an IP address string from scan data by its syntax alone, which
+    is much cheaper than is_ipv4. Returns 4 for dotted quads, 6 for (possibly
+    bracketed) IPv6 addresses, and None for anything else (e.g. onion
+    addresses).
+    >>> ip_family("8.8.8.8")
+    4
+    >>> ip_family("[2001:56b:dda9:4b00:49f9:121b:aa9e:de30]")
+    6
+    >>> ip_family("2001:56b::1")
+    6
+    >>> ip_family("foo.onion") is None
+    True
+    """
+    if ip.startswith("[") or ":" in ip:
+        return 6
+    if ip.count(".") == 3 and ip.replace(".", "").isdigit():
+        return 4
+    return None
+
 def yethi_scanpath(scanfile: str):
     """
     Takes a path to a Yethi scan dir or a file in that dir, and returns the
@@ -187,7 +477,7 @@ def ip2asn(ip: str, date: str = None):
   """
   try:
     asndb, asndb6 = asn_db(date)
-    if is_ipv4(ip):
+    if ip_family(ip) == 4:
       asn = asndb.lookup(ip)
     else:
       asn = asndb6.lookup(ip.strip("[]"))
@@ -198,9 +488,117 @@ def ip2asn(ip: str, date: str = None):
     logging.error("util.ip2asn: error resolving ASN for IP %s: %s", ip, ex)
     return None
 
-def geoip(ip):
-  # TODO
-  raise NotImplementedError
+# Fields of a geoip location: country code, region (as country/region, since
+# region names aren't unique) and IP2Location usage type code, e.g. DCH
+GEOIP_FIELDS = ("country", "region", "usage")
+
+GEOIP_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (db TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS geoip (
+  ip TEXT PRIMARY KEY,
+  country TEXT,
+  region TEXT,
+  usage TEXT
+) WITHOUT ROWID;
+"""
+
+# Locations resolved by this process, {ip -> (country, region, usage)}. Forked
+# workers inherit the locations resolved before the fork.
+__geoip = {}
+__geoip_lock = threading.Lock()
+# SQLite connections can't be shared between threads or processes, so each
+# thread opens its own, again after a fork
+__geoip_local = threading.local()
+
+def _geoip_dbs():
+  """Returns this thread's IP2Loc database and cache connection (or None)."""
+  local = __geoip_local
+  if getattr(local, "pid", None) != os.getpid():
+    import sqlite3
+    from ip2location_db.lookup import IP2Loc
+    check_geoip_db()
+    local.db = IP2Loc(GEOIP_DB)
+    local.cache = None
+    if GEOIP_CACHE is not None:
+      local.cache = sqlite3.connect(GEOIP_CACHE, timeout=60)
+      local.cache.executescript(GEOIP_CACHE_SCHEMA)
+      # Cached locations are only valid for the database they came from
+      st = os.stat(GEOIP_DB)
+      stamp = json.dumps([os.path.realpath(GEOIP_DB), st.st_size, st.st_mtime_ns])
+      if local.cache.execute("SELECT db FROM meta").fetchall() != [(stamp,)]:
+        logging.info("Clearing geoip cache %s", GEOIP_CACHE)
+        local.cache.execute("DELETE FROM geoip")
+        local.cache.execute("DELETE FROM meta")
+        local.cache.execute("INSERT INTO meta VALUES (?)", (stamp,))
+        local.cache.commit()
+    local.pid = os.getpid()
+  return local.db, local.cache
+
+def check_geoip_db():
+  """Raises FileNotFoundError if the IP2Location database is missing."""
+  if not os.path.isfile(GEOIP_DB):
+    raise FileNotFoundError("No IP2Location database {} (see "
+                            "ip2location_db/load_data.sh)".format(GEOIP_DB))
+
+def _geoip_location(record):
+  """
+  Returns the (country, region, usage) of an IP2Location record, with
+  unknown ("-") fields as None.
+  >>> _geoip_location({"country_code": "US", "region_name": "California",
+  ...                  "usage_type": "DCH"})
+  ('US', 'US/California', 'DCH')
+  >>> _geoip_location(None)
+  (None, None, None)
+  """
+  if record is None:
+    return (None, None, None)
+  known = lambda v: v if v and v != "-" else None
+  country = known(record["country_code"])
+  region = known(record["region_name"])
+  if country is not None and region is not None:
+    region = country + "/" + region
+  return (country, region, known(record["usage_type"]))
+
+def geoip_many(ips, field: str = "country"):
+  """
+  Returns {ip -> location field} (see GEOIP_FIELDS) for the distinct IP
+  addresses in ips, resolving those not yet cached in one batch, in address
+  order. Only IPv4 addresses are in the database; others map to None.
+  """
+  i = GEOIP_FIELDS.index(field)
+  missing = sorted({ip for ip in ips if ip not in __geoip},
+                   key=lambda ip: (ip_family(ip) != 4, ip))
+  if missing:
+    try:
+      db, cache = _geoip_dbs()
+      found = {}
+      if cache is not None:
+        for n in range(0, len(missing), 500):
+          chunk = missing[n:n+500]
+          found.update((row[0], row[1:]) for row in cache.execute(
+            "SELECT * FROM geoip WHERE ip IN ({})".format(",".join("?" * len(chunk))),
+            chunk))
+      resolved = {ip: _geoip_location(db.lookupv4(ip, transform=False))
+                  if ip_family(ip) == 4 else (None, None, None)
+                  for ip in missing if ip not in found}
+      if cache is not None and resolved:
+        cache.executemany("INSERT OR REPLACE INTO geoip VALUES (?, ?, ?, ?)",
+                          ((ip,) + loc for ip, loc in resolved.items()))
+        cache.commit()
+      with __geoip_lock:
+        __geoip.update(found)
+        __geoip.update(resolved)
+    except Exception as ex:
+      logging.error("util.geoip: error resolving locations of %s IPs: %s",
+                    len(missing), ex)
+  return {ip: __geoip[ip][i] if ip in __geoip else None for ip in set(ips)}
+
+def geoip(ip: str, field: str = "country"):
+  """
+  Return a location field (see GEOIP_FIELDS) of an IP address, e.g. its
+  country code. Use geoip_many to resolve many addresses at once.
+  """
+  return geoip_many([ip], field)[ip]
 
 def ip_prefix(ip, prefix):
   """
@@ -258,4 +656,5 @@ def values_in_range(l, start, end):
   return l[i:j]
 
 if __name__ == "__main__":
+    import doctest
     doctest.testmod()
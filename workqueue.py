@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+import os
+import csv
+import sys
+import json
+import time
+import shutil
+import socket
+import logging
+import argparse
+import threading
+import subprocess
+
+import util
+import aggregate_scans
+
+# A work queue in a shared directory (e.g. on NFS), for spreading
+# aggregate_scans.py or integrity_check_scans.py runs over several hosts.
+#
+#   submit  splits (date, scanfiles) input (see select_scans.py) into shards
+#           of consecutive dates, and records the command to run on each
+#   work    claims shards, runs the command on each, and stores its output;
+#           any number of workers may run, on any host sharing the queue
+#   merge   concatenates the outputs in shard order, i.e. in date order,
+#           once all shards are done
+#   status  lists the state of each shard
+#
+# A worker holds a lease on the shard it runs, by creating leases/<n> and
+# renewing its modification time. A lease which hasn't been renewed for the
+# lease time (e.g. because its host died) is taken over by another worker.
+# Outputs are moved into results/ atomically, so a shard which was taken over
+# and finished twice just has its (identical) output replaced. Failed runs
+# are recorded in failed/ with their logs in logs/, and a shard is given up
+# after --max-attempts failures. Lease times should be well above any clock
+# skew between the hosts.
+
+ACTIONS = ("submit", "work", "merge", "status")
+SUBDIRS = ("shards", "leases", "results", "failed", "logs")
+
+DEFAULT_SHARD_SIZE = 7
+DEFAULT_LEASE = 600
+DEFAULT_POLL = 30
+DEFAULT_MAX_ATTEMPTS = 3
+
+def owner_id():
+    return "{}-{}".format(socket.gethostname(), os.getpid())
+
+class WorkQueue:
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "queue.json"), "r") as f:
+            meta = json.load(f)
+        self.command = meta["command"]
+        self.cwd = meta["cwd"]
+        self.shards = meta["shards"]
+
+    @classmethod
+    def create(cls, path, date_scanfiles, command, shard_size=DEFAULT_SHARD_SIZE,
+               delimiter="\t", inner_delimiter=";"):
+        """
+        Creates a queue in the new directory path, splitting date_scanfiles
+        ({date -> scanfiles}) into shards of shard_size dates. command (a list
+        of arguments) is run in the current directory with a shard's input
+        file appended, and must write its output to stdout.
+        """
+        os.makedirs(path)
+        for d in SUBDIRS:
+            os.mkdir(os.path.join(path, d))
+        dates = sorted(date_scanfiles.keys())
+        shards = [dates[i:i+shard_size] for i in range(0, len(dates), shard_size)]
+        for n, shard in enumerate(shards):
+            with open(os.path.join(path, "shards", "{:06d}.tsv".format(n)), "w") as f:
+                writer = csv.writer(f, delimiter=delimiter, lineterminator="\n")
+                for date in shard:
+                    writer.writerow((date,
+                        inner_delimiter.join(sorted(date_scanfiles[date])),))
+        # Written last, so workers only see complete queues
+        meta = {"command": command, "cwd": os.getcwd(), "shards": len(shards),
+                "dates": [[s[0], s[-1]] for s in shards]}
+        with open(os.path.join(path, "queue.json.tmp"), "w") as f:
+            json.dump(meta, f)
+        os.replace(os.path.join(path, "queue.json.tmp"),
+                   os.path.join(path, "queue.json"))
+        return cls(path)
+
+    def _file(self, subdir, n, suffix=""):
+        return os.path.join(self.path, subdir, "{:06d}{}".format(n, suffix))
+
+    def attempts(self, n):
+        prefix = "{:06d}-".format(n)
+        return sum(1 for f in os.listdir(os.path.join(self.path, "failed"))
+                   if f.startswith(prefix))
+
+    def lease_age(self, n):
+        """Seconds since the lease on shard n was renewed, or None."""
+        try:
+            return time.time() - os.stat(self._file("leases", n)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def state(self, n, lease=DEFAULT_LEASE, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        if os.path.exists(self._file("results", n, ".tsv")):
+            return "done"
+        if self.attempts(n) >= max_attempts:
+            return "failed"
+        age = self.lease_age(n)
+        if age is not None and age < lease:
+            return "leased"
+        return "pending"
+
+    def claim(self, n, owner, lease=DEFAULT_LEASE):
+        """Tries to take the lease on shard n. Returns True if we got it."""
+        lease_file = self._file("leases", n)
+        try:
+            st = os.stat(lease_file)
+        except FileNotFoundError:
+            st = None
+        if st is not None and time.time() - st.st_mtime >= lease:
+            # Take over an abandoned lease by moving it aside. Another worker
+            # which saw the same lease may have taken it over already, and
+            # we may have moved its new lease instead; if so, put it back.
+            stale = lease_file + ".stale-" + owner
+            try:
+                os.rename(lease_file, stale)
+            except FileNotFoundError:
+                return False
+            if os.stat(stale).st_mtime_ns != st.st_mtime_ns:
+                try:
+                    os.link(stale, lease_file)
+                except FileExistsError:
+                    # A third worker claimed the shard while the lease was
+                    # aside, so it may run twice; its output is the same
+                    logging.warning("Lost a lease on shard %s to a race", n)
+                os.remove(stale)
+                return False
+            os.remove(stale)
+            logging.warning("Taking over abandoned lease on shard %s", n)
+        try:
+            fd = os.open(lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(owner)
+        return True
+
+    def release(self, n, owner):
+        """Removes the lease on shard n, if it is still ours."""
+        lease_file = self._file("leases", n)
+        try:
+            with open(lease_file, "r") as f:
+                if f.read() == owner:
+                    os.remove(lease_file)
+        except FileNotFoundError:
+            pass
+
+    def run(self, n, owner, lease=DEFAULT_LEASE):
+        """
+        Runs the command on shard n, renewing our lease meanwhile. Returns
+        True if the shard is done.
+        """
+        stop = threading.Event()
+        def renew():
+            while not stop.wait(lease / 4):
+                try:
+                    os.utime(self._file("leases", n))
+                except FileNotFoundError:
+                    pass
+
+        attempt = "{}-{}".format(owner, time.time_ns())
+        tmp = self._file("results", n, ".tsv.tmp-" + attempt)
+        log = self._file("logs", n, "-{}.log".format(attempt))
+        heartbeat = threading.Thread(target=renew, name="lease", daemon=True)
+        heartbeat.start()
+        try:
+            with open(tmp, "w") as outf, open(log, "w") as logf:
+                rc = subprocess.run(self.command + [self._file("shards", n, ".tsv")],
+                                    cwd=self.cwd, stdout=outf, stderr=logf).returncode
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        if rc != 0:
+            os.remove(tmp)
+            with open(self._file("failed", n, "-" + attempt), "w") as f:
+                f.write("exit status {}, log in {}\n".format(rc, log))
+            logging.error("Shard %s failed with exit status %s, log in %s",
+                          n, rc, log)
+        else:
+            os.replace(tmp, self._file("results", n, ".tsv"))
+            os.remove(log)
+        self.release(n, owner)
+        return rc == 0
+
+    def work(self, owner=None, lease=DEFAULT_LEASE, poll=DEFAULT_POLL,
+             max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        Claims and runs shards until every shard is done or failed, waiting
+        for shards leased by other workers in case their leases expire.
+        Returns the number of shards this worker ran.
+        """
+        owner = owner or owner_id()
+        ran = 0
+        while True:
+            states = [self.state(n, lease, max_attempts) for n in range(self.shards)]
+            pending = [n for n, s in enumerate(states) if s == "pending"]
+            if not pending and "leased" not in states:
+                return ran
+            claimed = next((n for n in pending if self.claim(n, owner, lease)), None)
+            if claimed is None:
+                time.sleep(poll)
+                continue
+            logging.info("Running shard %s of %s", claimed, self.shards)
+            self.run(claimed, owner, lease)
+            ran += 1
+
+    def missing(self):
+        return [n for n in range(self.shards)
+                if not os.path.exists(self._file("results", n, ".tsv"))]
+
+    def merge(self, outf):
+        """Writes the outputs of all shards, in order, to the binary file outf."""
+        missing = self.missing()
+        if missing:
+            raise ValueError("Shards not done: {}".format(
+                ", ".join(map(str, missing))))
+        for n in range(self.shards):
+            with open(self._file("results", n, ".tsv"), "rb") as f:
+                shutil.copyfileobj(f, outf)
+
+if __name__ == "__main__":
+    # Configure logging module
+    logging.basicConfig(format=util.LOG_FMT, level=util.LOG_LEVEL)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", choices=ACTIONS)
+    parser.add_argument("queue", help="Queue directory, shared by all hosts. "
+      "With submit, it is followed by -- and the command to run on each shard, "
+      "e.g. -- python3 aggregate_scans.py -f Yethi -j 8. The command gets the "
+      "shard's input file as its last argument, and must write to stdout.")
+    parser.add_argument("--input", "-i", nargs="*", type=argparse.FileType("r"),
+      default=[sys.stdin], help="With submit: files containing dates and scan "
+           "files, as select_scans.py outputs (stdin by default).")
+    parser.add_argument("--shard-size", "-n", type=int, default=DEFAULT_SHARD_SIZE,
+      help="With submit: number of dates per shard (default={})".format(
+          DEFAULT_SHARD_SIZE))
+    parser.add_argument("--lease", "-l", type=int, default=DEFAULT_LEASE,
+      help="Seconds after which an unrenewed lease is considered abandoned "
+           "(default={})".format(DEFAULT_LEASE))
+    parser.add_argument("--poll", "-p", type=int, default=DEFAULT_POLL,
+      help="With work: seconds to wait between checks for claimable shards "
+           "(default={})".format(DEFAULT_POLL))
+    parser.add_argument("--max-attempts", "-ma", type=int, default=DEFAULT_MAX_ATTEMPTS,
+      help="Number of failed runs after which a shard is given up "
+           "(default={})".format(DEFAULT_MAX_ATTEMPTS))
+    parser.add_argument("--output", "-o", default=None,
+      help="With merge: write output to this file instead of stdout.")
+    parser.add_argument("--delimiter", "-d", default="\t",
+      help="Input field delimiter (tab by default)")
+    parser.add_argument("--inner-delimiter", "-id", default=";",
+      help="Delimiter for lists within a field (; by default)")
+
+    # Everything after -- is the command, which may have options of its own
+    argv = sys.argv[1:]
+    command = []
+    if "--" in argv:
+        argv, command = argv[:argv.index("--")], argv[argv.index("--")+1:]
+    ARGS = parser.parse_args(argv)
+
+    if ARGS.action == "submit":
+        if not command:
+            parser.error("submit requires a command, after --")
+        date_scanfiles = aggregate_scans.read_date_scanfiles(ARGS.input,
+            ARGS.delimiter, ARGS.inner_delimiter)
+        q = WorkQueue.create(ARGS.queue, date_scanfiles, command,
+                             shard_size=ARGS.shard_size, delimiter=ARGS.delimiter,
+                             inner_delimiter=ARGS.inner_delimiter)
+        logging.info("Submitted %s dates in %s shards to %s",
+                     len(date_scanfiles), q.shards, ARGS.queue)
+    elif command:
+        parser.error("A command is only accepted with submit")
+
+    q = WorkQueue(ARGS.queue)
+    if ARGS.action == "work":
+        ran = q.work(lease=ARGS.lease, poll=ARGS.poll,
+                     max_attempts=ARGS.max_attempts)
+        logging.info("Ran %s shards", ran)
+        failed = [n for n in range(q.shards)
+                  if q.state(n, ARGS.lease, ARGS.max_attempts) == "failed"]
+        if failed:
+            logging.error("Shards given up after %s attempts: %s",
+                          ARGS.max_attempts, ", ".join(map(str, failed)))
+            sys.exit(1)
+
+    elif ARGS.action == "merge":
+        try:
+            if ARGS.output:
+                with open(ARGS.output + ".tmp", "wb") as outf:
+                    q.merge(outf)
+                os.replace(ARGS.output + ".tmp", ARGS.output)
+            else:
+                q.merge(sys.stdout.buffer)
+        except ValueError as e:
+            if ARGS.output:
+                os.remove(ARGS.output + ".tmp")
+            logging.error("%s", e)
+            sys.exit(1)
+
+    elif ARGS.action == "status":
+        with open(os.path.join(ARGS.queue, "queue.json"), "r") as f:
+            dates = json.load(f)["dates"]
+        writer = csv.writer(sys.stdout, delimiter=ARGS.delimiter,
+                            lineterminator="\n")
+        for n in range(q.shards):
+            writer.writerow((n, dates[n][0], dates[n][1],
+                             q.state(n, ARGS.lease, ARGS.max_attempts),
+                             q.attempts(n),))